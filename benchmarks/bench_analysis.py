@@ -0,0 +1,105 @@
+"""
+Time of data.data_utils.analyze_interactions on the MathConverse interactions resampled to about a million turns
+(the text columns shortened), against the row-wise way: ast.literal_eval of every rating list, a per-turn DataFrame
+from explode, pandas group-bys, and one resample + group-by per bootstrap replicate.
+The point estimates of both must agree.
+
+    python -m benchmarks.bench_analysis --turns 1000000
+"""
+import ast
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data.data_utils.analyze_interactions import Interactions, answer_all, rating_trajectories
+
+interactions_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "data", "mathconverse_parsed_interactions.csv")
+
+
+def scaled_interactions(turns, seed=0):
+    """The real conversations drawn with replacement until there are `turns` turns, under new participant ids"""
+    frame = pd.read_csv(interactions_path)
+    lengths = frame["helpfulness_ratings"].map(lambda s: len(ast.literal_eval(s))).to_numpy()
+    n_rows = int(np.ceil(turns / lengths.mean()))
+    rng = np.random.default_rng(seed)
+    scaled = frame.iloc[rng.integers(0, len(frame), n_rows)].reset_index(drop=True)
+    # Participants of 3 conversations, as in the study
+    scaled["uid"] = [f"participant-{i // 3}" for i in range(n_rows)]
+    for column in ["human_interactions", "model_responses"]:
+        scaled[column] = scaled[column].str.slice(0, 80)
+    return scaled
+
+
+def row_wise_trajectories(path, n_boot, max_turns=10, seed=0):
+    """
+    Mean helpfulness per (model, turn), and bootstrap replicates drawn one at a time
+    :return: means, replicates, seconds up to the means, seconds per replicate
+    """
+    start = time.perf_counter()
+    frame = pd.read_csv(path)
+    frame["helpfulness_ratings"] = frame["helpfulness_ratings"].map(ast.literal_eval)
+    frame["conversation"] = np.arange(len(frame))
+    turns = frame[["conversation", "model", "helpfulness_ratings"]].explode("helpfulness_ratings")
+    turns = turns.dropna(subset=["helpfulness_ratings"])
+    turns["turn"] = turns.groupby("conversation").cumcount()
+    turns = turns[turns["turn"] < max_turns]
+    turns["helpfulness_ratings"] = turns["helpfulness_ratings"].astype(float)
+    means = turns.groupby(["model", "turn"])["helpfulness_ratings"].mean()
+    base_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    turns = turns.reset_index(drop=True)
+    lengths = turns.groupby("conversation").size().to_numpy()
+    starts = np.cumsum(lengths) - lengths
+    replicates = []
+    for _ in range(n_boot):
+        drawn = rng.integers(0, len(lengths), len(lengths))
+        rows = np.repeat(starts[drawn] - np.cumsum(lengths[drawn]) + lengths[drawn], lengths[drawn]) \
+            + np.arange(lengths[drawn].sum())
+        replicates.append(turns.iloc[rows].groupby(["model", "turn"])["helpfulness_ratings"].mean())
+    return means, replicates, base_time, (time.perf_counter() - start) / n_boot
+
+
+def timed(label, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{label:48s}{elapsed:9.3f} s")
+    return result, elapsed
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=1_000_000)
+    parser.add_argument("--n-boot", type=int, default=1000)
+    parser.add_argument("--row-wise-boot", type=int, default=20,
+                        help="bootstrap replicates actually run row-wise, the time being extrapolated to --n-boot")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "interactions.csv")
+        scaled_interactions(args.turns).to_csv(path)
+        print(f"{os.path.getsize(path) / 1e6:.0f} MB csv")
+
+        data, load_time = timed("load (columnar)", Interactions.from_csv, path)
+        print(f"{data.n_conversations} conversations, {len(data.turn)} turns, "
+              f"{len(data.labels['participant'])} participants")
+        trajectories, _ = timed(f"rating trajectories, {args.n_boot} replicates", rating_trajectories, data,
+                                n_boot=args.n_boot)
+        _, all_time = timed(f"all questions, {args.n_boot} replicates", answer_all, data, n_boot=args.n_boot)
+
+        means, _, base_time, per_replicate = row_wise_trajectories(path, args.row_wise_boot)
+        print(f"{'row-wise load and trajectories':48s}{base_time:9.3f} s")
+        print(f"{'row-wise bootstrap, per replicate':48s}{per_replicate:9.3f} s")
+        print(f"{f'row-wise trajectories, {args.n_boot} replicates (extrapolated)':48s}"
+              f"{base_time + per_replicate * args.n_boot:9.1f} s")
+
+    vectorised = trajectories["helpfulness"]
+    assert np.allclose(vectorised.loc[means.index].to_numpy(), means.to_numpy()), "point estimates differ"
+    print("point estimates agree")
@@ -0,0 +1,43 @@
+"""
+Opening-turn latency with and without the response cache: several participants paste the same problem statement
+as their first query, against the local mock OpenAI server.
+
+    python -m benchmarks.bench_cache --first-token-latency 2 --participants 10
+"""
+import os
+import tempfile
+import time
+
+import model_generate
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+from response_cache import ResponseCache
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--first-token-latency", type=float, default=2.)
+    parser.add_argument("--participants", type=int, default=10)
+    parser.add_argument("--problem", default="./data/problems/p23_eulers_theorem.md")
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency)
+    shared_backend.api_base = server.url + "/v1"
+    with open(args.problem) as f:
+        problem_statement = f.read()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        model_generate.response_cache = ResponseCache(os.path.join(cache_dir, "cache.sqlite"))
+        for model in ["chatgpt4", "chatgpt", "instructgpt"]:
+            latencies = []
+            for _ in range(args.participants):
+                start = time.perf_counter()
+                model_generate.chatbot_generate(problem_statement, Conversation(), model)
+                latencies.append(time.perf_counter() - start)
+            print(f"{model:12s} first participant {latencies[0] * 1000:9.1f} ms   "
+                  f"later participants (mean) {sum(latencies[1:]) / len(latencies[1:]) * 1000:7.2f} ms")
+        print("cache stats:", model_generate.response_cache.stats())
+        print("upstream requests:", server.hits)
+    server.shutdown()
@@ -0,0 +1,106 @@
+"""
+Throughput of data.data_utils.clean_up_markdown on a synthetic ProofWiki-like dump (paragraphs of text and math
+with [[Definition:x|y]], [[x]] and [[Axiom:x|y]] links): the former script's algorithm (a list of indices to
+delete, tested for every character) on growing inputs to show its quadratic growth, then the regular expression
+pass on the whole dump, in one process and on a process pool over its chunks.
+
+    python -m benchmarks.bench_clean_markdown --megabytes 100
+"""
+import os
+import random
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from data.data_utils.clean_up_markdown import clean_file, clean_text
+
+words = ["let", "group", "be", "a", "such", "that", "for", "all", "then", "there", "exists", "unique", "element"]
+concepts = ["Group", "Ring", "Field", "Vector Space", "Topological Space", "Measure Space", "Subgroup", "Ideal"]
+
+
+def synthetic_dump(size, seed=0):
+    rng = random.Random(seed)
+    paragraphs, length = [], 0
+    while length < size:
+        pieces = []
+        for _ in range(rng.randint(20, 60)):
+            kind = rng.random()
+            concept = rng.choice(concepts)
+            if kind < 0.08:
+                pieces.append(f"[[Definition:{concept}|{concept.lower()}]]")
+            elif kind < 0.12:
+                pieces.append(f"[[{concept} is Closed]]")
+            elif kind < 0.14:
+                pieces.append(f"[[Axiom:{concept} Axioms|{concept.lower()} axioms]]")
+            elif kind < 0.2:
+                pieces.append(f"$\\left[{{a, [b, c]}}\\right] \\in {concept[0]}$")
+            else:
+                pieces.append(rng.choice(words))
+        paragraph = " ".join(pieces)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def original_clean(text):
+    """The former clean_up_markdown.py, on one text"""
+    indices_to_del = []
+    for m in re.finditer(r"\[\[Definition:", text):
+        start_m = m.start()
+        first_divisor = text[start_m:].find("|")
+        first_end = text[start_m:].find("]]")
+        indices_to_del.extend(list(range(start_m, start_m + first_divisor + 1)))
+        indices_to_del.extend([start_m + first_end, start_m + first_end + 1])
+    return "".join([c for i, c in enumerate(text) if i not in indices_to_del])
+
+
+def seconds(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=float, default=100)
+    parser.add_argument("--jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    print(f"{'input':28s}{'seconds':>10s}{'MB/s':>10s}")
+    for kilobytes in [10, 20, 40]:
+        text = synthetic_dump(kilobytes * 1000)
+        elapsed = seconds(original_clean, text)
+        print(f"{f'former, {kilobytes} kB':28s}{elapsed:10.3f}{len(text) / elapsed / 1e6:10.3f}")
+        # Same result on the links the former script handled
+        definitions_only = re.sub(r"\[\[(?!Definition:)[^\]]*\]\]", "", text)
+        assert original_clean(definitions_only) == clean_text(definitions_only)
+
+    # Math is kept, links in between two dollar amounts are not taken for math
+    for case, expected in [
+        ("$[a, [b, c]]$ in [[Definition:Group|a group]]", "$[a, [b, c]]$ in a group"),
+        ("costs $5 and is a [[Group]] with $x$", "costs $5 and is a Group with $x$"),
+        ("costs $5 to $10 in [[Ring]]s", "costs $5 to $10 in Rings"),
+        ("$$\n[[x]]\n$$ and $ [[y]] $", "$$\n[[x]]\n$$ and $ y $"),
+    ]:
+        assert clean_text(case) == expected, (case, clean_text(case))
+
+    text = synthetic_dump(int(args.megabytes * 1e6))
+    elapsed = seconds(clean_text, text)
+    print(f"{f'regex, {args.megabytes:g} MB':28s}{elapsed:10.3f}{len(text) / elapsed / 1e6:10.1f}")
+    cleaned = clean_text(text)
+    assert "[[" not in cleaned and "]]" not in cleaned.replace("c]}\\right]", "")
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "proofwiki_dump.md")
+        with open(path, "w") as f:
+            f.write(text)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            clean_file(path, pool)
+        elapsed = time.perf_counter() - start
+        print(f"{f'file + pool, {args.megabytes:g} MB':28s}{elapsed:10.3f}{len(text) / elapsed / 1e6:10.1f}")
+        with open(path) as f:
+            assert f.read() == cleaned
+    print(f"{os.cpu_count()} cpus")
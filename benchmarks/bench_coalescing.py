@@ -0,0 +1,101 @@
+"""
+Single-flight check: a cohort of participants paste the same problem statement as their first query at the same
+moment, through the blocking, streaming and async chat handlers, against the local mock OpenAI server, which counts
+its upstream hits. With coalescing, each model must be called once and every participant get the same reply;
+without it (--no-coalesce), every participant calls the model. The response cache is disabled throughout.
+
+    python -m benchmarks.bench_coalescing --participants 30 --first-token-latency 1
+"""
+import asyncio
+import threading
+import time
+
+import model_generate
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+
+models = ["chatgpt", "chatgpt4", "instructgpt"]
+
+
+def blocking_participant(statement, model):
+    pairs = model_generate.chatbot_generate(statement, Conversation(), model)[0]
+    return pairs[-1][1]
+
+
+def streaming_participant(statement, model):
+    for outputs in model_generate.chatbot_generate_stream(statement, Conversation(), model):
+        pass
+    return outputs[0][-1][1]
+
+
+def async_participants(statement, participants):
+    async def participant(model):
+        pairs = (await model_generate.chatbot_generate_async(statement, Conversation(), model))[0]
+        return pairs[-1][1]
+    async def cohort():
+        return await asyncio.gather(*[participant(model) for model in participants])
+    return asyncio.run(cohort())
+
+
+def run_cohort(statement, participants):
+    """Every participant sends the statement at once; :return: {model: [replies]}, wall time"""
+    handlers = [blocking_participant, streaming_participant, None]
+    assignments = [(models[i % len(models)], handlers[(i // len(models)) % len(handlers)]) for i in range(participants)]
+    replies = {model: [] for model in models}
+    lock = threading.Lock()
+    barrier = threading.Barrier(sum(handler is not None for _, handler in assignments) + 1)
+
+    def run(model, handler):
+        barrier.wait()
+        reply = handler(statement, model)
+        with lock:
+            replies[model].append(reply)
+
+    def run_async(async_models):
+        barrier.wait()
+        for model, reply in zip(async_models, async_participants(statement, async_models)):
+            with lock:
+                replies[model].append(reply)
+
+    threads = [threading.Thread(target=run, args=assignment) for assignment in assignments if assignment[1] is not None]
+    threads.append(threading.Thread(target=run_async, args=([model for model, handler in assignments if handler is None],)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return replies, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=30)
+    parser.add_argument("--first-token-latency", type=float, default=1.)
+    parser.add_argument("--tokens-per-second", type=float, default=100.)
+    parser.add_argument("--problem", default="./data/problems/p23_eulers_theorem.md")
+    parser.add_argument("--no-coalesce", action="store_true", help="every request calls the model")
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second)
+    shared_backend.api_base = server.url + "/v1"
+    model_generate.response_cache.enabled = False
+    model_generate.COALESCE_IDENTICAL_REQUESTS = not args.no_coalesce
+    with open(args.problem) as f:
+        statement = f.read()
+
+    replies, wall_time = run_cohort(statement, args.participants)
+    print(f"{args.participants} participants in {wall_time:.2f}s, upstream requests: {server.hits}")
+    print("single flight stats:", model_generate.single_flight.stats())
+    for model in models:
+        assert len(set(replies[model])) == 1, f"{model}: participants got different replies"
+    expected = args.participants if args.no_coalesce else len(models)
+    assert server.hits == expected, f"{server.hits} upstream requests, expected {expected}"
+
+    # Once landed, a flight is not joined any more: the same request later calls the model again
+    hits = server.hits
+    model_generate.chatbot_generate(statement, Conversation(), models[0])
+    assert server.hits == hits + 1 and not model_generate.single_flight.in_flight
+    print(f"OK: {expected} upstream requests for {args.participants} participants, identical replies per model")
+    server.shutdown()
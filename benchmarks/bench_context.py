@@ -0,0 +1,69 @@
+"""
+Prompt tokens and latency of each turn of a long conversation, under each context policy (context_window.py), against
+the local mock OpenAI server, which takes longer to answer longer prompts (--prompt-tokens-per-second).
+
+    python -m benchmarks.bench_context --turns 20 --reply-tokens 512 --prompt-tokens-per-second 20000
+"""
+import time
+
+import model_generate
+from context_window import ContextPolicy, context_policies
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+
+question = ("Let G be a finite group and H a subgroup of index {turn}. Explain, step by step, why H contains a normal "
+            "subgroup of G whose index divides {turn}!, and how this applies to groups of order pq for primes p < q. ")
+
+
+def run_conversation(model, turns):
+    """
+    :return: the replies of the conversation, and the time of selecting the context of its last turn, counting the
+        tokens of every message, then with the tokens counted on the turns as in a session
+    """
+    conversation = Conversation()
+    for turn in range(turns):
+        model_generate.chatbot_generate(question.format(turn=turn + 2) * 3, conversation, model)
+    # the time of prepare_context alone, on the last turn, with the tokens of its messages still to count
+    last_turn = Conversation.from_list(conversation.to_list()[:-1])
+    for turn in last_turn.turns:
+        turn.tokens = None
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        model_generate.prepare_context(last_turn, model_generate.actual_model_names[model])
+        times.append(time.perf_counter() - start)
+    return [turn for turn in conversation.turns if turn.role == "assistant"], times
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--reply-tokens", type=int, default=512)
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=20000.)
+    parser.add_argument("--model", default="chatgpt", choices=list(model_generate.actual_model_names))
+    args = parser.parse_args()
+
+    server = start_mock_server(reply_tokens=args.reply_tokens, prompt_tokens_per_second=args.prompt_tokens_per_second)
+    shared_backend.api_base = server.url + "/v1"
+    model_generate.response_cache.enabled = False
+    budget = model_generate.context_budget(model_generate.actual_model_names[args.model])
+
+    replies = {}
+    for policy in context_policies:
+        model_generate.context_policy = ContextPolicy(policy)
+        replies[policy], (cold, counted) = run_conversation(args.model, args.turns)
+        print(f"{policy}: prepare_context on the last turn {cold * 1000:.2f} ms counting every message, "
+              f"{counted * 1000:.2f} ms with the tokens counted on the turns")
+
+    print(f"\n{args.model}, prompt budget {budget} tokens")
+    print("turn  history | " + " | ".join(f"{policy:>9s} tokens  dropped  latency" for policy in context_policies))
+    for turn in range(args.turns):
+        records = [replies[policy][turn] for policy in context_policies]
+        print(f"{turn + 1:4d} {records[0].history_tokens:8d} | " + " | ".join(
+            f"{r.prompt_tokens:16d} {r.dropped_messages:8d} {r.latency * 1000:6.0f}ms" for r in records))
+    for policy in context_policies:
+        over = sum(r.prompt_tokens > budget for r in replies[policy])
+        print(f"{policy}: {over} turns over the budget")
+    server.shutdown()
@@ -0,0 +1,80 @@
+"""
+Time to load the corpus at startup (the problems in both formats and the prompt examples, as experiment.py loads
+them on import), in fresh interpreters: from the data directories, then from the corpus bundle.
+Also checks that both give the same problems and prompts, and that a file edited after the build is read from disk.
+
+    python -m benchmarks.bench_corpus_import --runs 20
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from data.data_utils.corpus_bundle import build_bundle, default_bundle_path, repo_root
+
+load_script = """
+import time
+start = time.perf_counter()
+from data.data_utils import corpus_bundle
+if {disable_bundle}:
+    corpus_bundle._bundles[corpus_bundle.default_bundle_path] = None
+from data.data_utils.load_problems import load_problems
+from data.data_utils.load_prompts import get_prompt_examples
+corpus = (load_problems("./data/problems_html/"), load_problems("./data/problems/"),
+          get_prompt_examples("./data/prompts/"))
+elapsed = time.perf_counter() - start
+import hashlib, json
+print(hashlib.sha256(json.dumps(corpus, sort_keys=True).encode()).hexdigest(), elapsed)
+"""
+
+
+def load_in_subprocess(disable_bundle):
+    """(digest of the loaded corpus, seconds from the first import to the loaded corpus)"""
+    output = subprocess.run([sys.executable, "-c", load_script.format(disable_bundle=disable_bundle)], cwd=repo_root,
+                            capture_output=True, text=True, check=True).stdout
+    digest, elapsed = output.strip().splitlines()[-1].split()
+    return digest, float(elapsed)
+
+
+def median_load(disable_bundle, runs):
+    results = [load_in_subprocess(disable_bundle) for _ in range(runs)]
+    assert len({digest for digest, _ in results}) == 1
+    return results[0][0], statistics.median(elapsed for _, elapsed in results)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    had_bundle = os.path.exists(default_bundle_path)
+    start = time.perf_counter()
+    build_bundle()
+    print(f"{'build bundle':32s}{(time.perf_counter() - start) * 1e3:9.1f} ms "
+          f"({os.path.getsize(default_bundle_path) / 1e3:.0f} kB)")
+    try:
+        directories_digest, directories_time = median_load(True, args.runs)
+        bundle_digest, bundle_time = median_load(False, args.runs)
+        print(f"{'load from directories':32s}{directories_time * 1e3:9.1f} ms")
+        print(f"{'load from bundle':32s}{bundle_time * 1e3:9.1f} ms")
+        assert directories_digest == bundle_digest, "the bundle gives a different corpus"
+
+        # An edited file must be read from disk, not from the bundle
+        path = os.path.join(repo_root, "data", "prompts", sorted(os.listdir(os.path.join(repo_root, "data", "prompts")))[0])
+        with open(path) as f:
+            original = f.read()
+        stat = os.stat(path)
+        try:
+            with open(path, "w") as f:
+                f.write(original + "\n% edited")
+            assert load_in_subprocess(False)[0] == load_in_subprocess(True)[0] != bundle_digest
+        finally:
+            with open(path, "w") as f:
+                f.write(original)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        print("same corpus from both; edited files read from disk")
+    finally:
+        if not had_bundle:
+            os.remove(default_bundle_path)
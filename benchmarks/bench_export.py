@@ -0,0 +1,124 @@
+"""
+Export time of data.data_utils.export_interactions on a synthetic save tree of N sessions (in the directory layout
+of earlier versions of experiment.py, half in the original flat conversation format) plus a result store of
+N sessions: the first export, a re-run with nothing new, a re-run after new sessions were added, and a re-run after
+some sessions changed.
+
+    python -m benchmarks.bench_export --sessions 10000
+"""
+import json
+import os
+import random
+import tempfile
+import time
+
+from constants import usefulness_options, correctness_options, solo_solve_options, RESULT_STORE_FILENAME
+from data.data_utils.export_interactions import export, load_export
+from result_store import ResultStore
+
+model_names = ["chatgpt", "instructgpt", "chatgpt4"]
+rank_choices = ["1 (Most preferrable math assistant)", "2", "3 (Least preferrable math assistant)"]
+
+
+def synthetic_session(idx, rng):
+    """[(kind, data, problem_set_index, model)] of a session with 1 to 3 rated problem sets"""
+    problem_order = rng.sample(range(18), 3)
+    records = [
+        ("user_survey_metadata", {"mth_bkgrd": "Current undergraduate studying mathematics",
+                                  "ai_play_bkgrd": "A couple of times a month", "selected_topic": "Topology"},
+         None, None),
+        ("problem_ordering", {"problem_order": problem_order}, None, None),
+    ]
+    for problem_set_index in problem_order[:rng.randint(1, 3)]:
+        for model in model_names:
+            n_turns = rng.randint(1, 6)
+            turns = [{"user": f"User: question {t} of session {idx}", "ai": f"AI: answer {t} " + "x" * 400,
+                      "helpfulness": rng.choice(usefulness_options), "correctness": rng.choice(correctness_options)}
+                     for t in range(n_turns)]
+            records.append(("solo_solve", {"solo_solve": rng.choice(solo_solve_options)}, problem_set_index, model))
+            records.append(("problem_details", {"id": 1, "name": f"problem_{problem_set_index}.html",
+                                                "text": "p" * 500, "category": "Topology"}, problem_set_index, model))
+            records.append(("conversation_rating", {"turns": turns, "time_taken": rng.uniform(10, 600)},
+                            problem_set_index, model))
+        records.append(("model_ranks", dict(zip(model_names, rng.sample(rank_choices, 3)),
+                                            model_presentation_order=model_names), problem_set_index, None))
+    return records
+
+
+def original_conversation(conversation):
+    # The flat list of the first version of experiment.py: 20 (user, ai, helpfulness, correctness) slots + time
+    flat = []
+    for t in range(20):
+        if t < len(conversation["turns"]):
+            turn = conversation["turns"][t]
+            flat.extend([turn["user"], turn["ai"], turn["helpfulness"], turn["correctness"]])
+        else:
+            flat.extend(["", "", None, None])
+    return flat + [conversation["time_taken"]]
+
+
+def write_tree_session(root, uid, records, original_format):
+    for kind, data, problem_set_index, model in records:
+        parts = [root]
+        if problem_set_index is not None:
+            parts.append(f"problem_set_index_{problem_set_index}")
+        if model is not None:
+            parts.append(model)
+        path = os.path.join(*parts, uid)
+        os.makedirs(path, exist_ok=True)
+        if kind == "conversation_rating" and original_format:
+            data = original_conversation(data)
+        with open(os.path.join(path, f"{kind}.json"), "w") as f:
+            json.dump(data, f)
+
+
+def timed(label, *args):
+    start = time.perf_counter()
+    counts = export(*args)
+    print(f"{label:36s}{time.perf_counter() - start:8.2f} s   {counts['rows']:8d} rows  "
+          f"{counts['read']:7d} sessions read")
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10000, help="sessions in the tree, and again in the store")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as export_dir:
+        start = time.perf_counter()
+        for idx in range(args.sessions):
+            write_tree_session(root, f"tree-{idx}", synthetic_session(idx, rng), original_format=idx % 2 == 0)
+        store = ResultStore(os.path.join(root, RESULT_STORE_FILENAME))
+        for idx in range(args.sessions):
+            for kind, data, problem_set_index, model in synthetic_session(idx, rng):
+                store.write(f"store-{idx}", kind, data, problem_set_index, model)
+        store.flush()
+        print(f"generated {2 * args.sessions} sessions in {time.perf_counter() - start:.1f}s")
+
+        output = os.path.join(export_dir, "interactions.csv")
+        timed("first export", root, output, None, args.workers)
+        timed("re-run, nothing new", root, output, None, args.workers)
+
+        for idx in range(args.sessions, args.sessions + args.sessions // 100):
+            write_tree_session(root, f"tree-{idx}", synthetic_session(idx, rng), original_format=False)
+            for kind, data, problem_set_index, model in synthetic_session(idx, rng):
+                store.write(f"store-{idx}", kind, data, problem_set_index, model)
+        store.flush()
+        timed("re-run, 1% new sessions", root, output, None, args.workers)
+
+        for idx in range(0, args.sessions, 100):
+            path = os.path.join(root, f"tree-{idx}", "user_survey_metadata.json")
+            with open(path, "w") as f:
+                json.dump({"mth_bkgrd": "changed", "ai_play_bkgrd": "changed", "selected_topic": "Algebra"}, f)
+        timed("re-run, 1% changed sessions", root, output, None, args.workers)
+        store.close()
+
+        exported = load_export(output)
+        assert exported["uid"].nunique() == 2 * (args.sessions + args.sessions // 100)
+        assert (exported[exported["uid"] == "tree-0"]["mth_bkgrd"] == "changed").all()
+        print(exported.iloc[0][["model", "helpfulness_ratings", "solo_solve", "final_prefs", "seen_problem_sets"]]
+              .to_dict())
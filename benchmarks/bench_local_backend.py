@@ -0,0 +1,110 @@
+"""
+Offline run of both studies on the local model backend (local_backend.py): no server, no network, no API key.
+
+- experiment.py: N participants go through their first problem set at the same time, headless (multi_session.py)
+- minimal_neurology_study.py: N participants ask Neura a few questions each through its streaming chat handler
+
+Checks that no HTTP request was made and that the studies saw the simulated speed that was asked for: the time to
+the first piece and the tokens per second of the streamed Neura replies.
+
+    python -m benchmarks.bench_local_backend --sessions 20 --first-token-latency 0.2 --tokens-per-second 40
+"""
+import os
+
+# The shared backend is created when model_backend is first imported
+os.environ["MODEL_BACKEND"] = "local"
+
+import asyncio
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import experiment
+import model_generate
+from benchmarks import multi_session
+from benchmarks.neurology import import_neurology_study
+from constants import RESULT_STORE_FILENAME
+from local_backend import LocalModelBackend
+from mock_openai_server import Distribution
+from model_backend import shared_backend
+from result_store import ResultStore
+
+minimal_neurology_study = import_neurology_study()
+
+
+def run_experiment(sessions, turns, think_time):
+    experiment.unique_saving_path = tempfile.mkdtemp(prefix="checkmate_offline_")
+    experiment.result_store = ResultStore(os.path.join(experiment.unique_saving_path, RESULT_STORE_FILENAME))
+    try:
+        records, errors, wall_time = asyncio.run(multi_session.run(sessions, turns, think_time))
+    finally:
+        experiment.result_store.close()
+        shutil.rmtree(experiment.unique_saving_path, ignore_errors=True)
+    print(f"  experiment: {sessions} participants through their first problem set in {wall_time:.2f}s, "
+          f"{len(errors)} with errors")
+    assert not errors, errors
+
+
+async def neura_participant(idx, questions):
+    """:return: (seconds to the first piece, tokens per second) of each reply"""
+    case_text = minimal_neurology_study.problem_texts[idx % len(minimal_neurology_study.problem_texts)]["text"]
+    history, speeds = [], []
+    for question in range(questions):
+        start = time.perf_counter()
+        times = []
+        async for history, _ in minimal_neurology_study.neura_chatbot_stream_async(
+            f"Participant {idx}, question {question}: what is the most likely localisation?", history, case_text,
+            f"neura-{idx}"
+        ):
+            times.append(time.perf_counter())
+        # Every yield but the last (the full reply again) brought one more piece
+        pieces = times[:-1]
+        speeds.append((pieces[0] - start, (len(pieces) - 1) / (pieces[-1] - pieces[0])))
+    return speeds
+
+
+def run_neurology(sessions, questions):
+    async def cohort():
+        return await asyncio.gather(*[neura_participant(i, questions) for i in range(sessions)])
+    start = time.perf_counter()
+    speeds = np.array([speed for participant in asyncio.run(cohort()) for speed in participant])
+    print(f"  neurology study: {sessions} participants x {questions} questions in {time.perf_counter() - start:.2f}s,"
+          f" first piece p50 {np.median(speeds[:, 0]):.2f}s, {np.median(speeds[:, 1]):.1f} tokens/s (median)")
+    return speeds
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=2, help="chat turns with each model of the experiment")
+    parser.add_argument("--questions", type=int, default=3, help="questions to Neura")
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--first-token-latency", type=Distribution.parse, default="0.2",
+                        help="seconds, a number or a distribution, e.g. lognormal:0.2:0.3")
+    parser.add_argument("--tokens-per-second", type=Distribution.parse, default="40",
+                        help="a number or a distribution, e.g. normal:40:5")
+    parser.add_argument("--reply-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    assert isinstance(shared_backend, LocalModelBackend)
+    shared_backend.config.update(first_token_latency=args.first_token_latency,
+                                 tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens)
+    model_generate.response_cache.enabled = False
+    print(f"local backend: first piece after {args.first_token_latency} s, {args.tokens_per_second} tokens/s, "
+          f"replies of {args.reply_tokens} tokens")
+
+    run_experiment(args.sessions, args.turns, args.think_time)
+    speeds = run_neurology(args.sessions, args.questions)
+    print(f"  {shared_backend.hits} requests answered in process, "
+          f"HTTP session opened: {shared_backend._session is not None}")
+    assert shared_backend._session is None, "the local backend made HTTP requests"
+    # The measured speed must be the one asked for (give or take the scheduling of the event loops)
+    if args.first_token_latency.kind == "constant":
+        latency = args.first_token_latency.params[0]
+        assert abs(np.median(speeds[:, 0]) - latency) < 0.05 + 0.2 * latency, "not the latency asked for"
+    if args.tokens_per_second.kind == "constant":
+        assert abs(np.median(speeds[:, 1]) / args.tokens_per_second.params[0] - 1) < 0.2, "not the speed asked for"
+    print("OK: both studies ran offline at the simulated speed")
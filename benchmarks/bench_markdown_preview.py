@@ -0,0 +1,196 @@
+"""
+Markdown and LaTeX preview of the messages typed to the models (markdown_preview.py), against the former handler that
+built a gr.Markdown to validate the text (closing its pyplot figures) before the gr.Markdown preview rendered it again:
+
+- latency of a preview of the participants' messages of data/mathconverse_parsed_interactions.csv: former handler,
+  first render, same text again (memoised), and a message typed a few characters at a time (its formulas drawn once)
+- live preview through the app's event graph (benchmarks/headless.py): keystrokes faster than the debounce are rendered
+  once, after the last one, and a pause renders what was typed so far; typing to another model meanwhile does not
+  hold back the preview of the first
+- memory of a process that rendered text with the preview, a formula as well (which imports matplotlib, but not
+  pyplot), and with matplotlib.pyplot imported as well
+
+    python -m benchmarks.bench_markdown_preview --messages 200
+"""
+import os
+
+# The shared backend is created when model_backend is first imported
+os.environ.setdefault("MODEL_BACKEND", "local")
+
+import ast
+import asyncio
+import logging
+import subprocess
+import sys
+import time
+
+import gradio as gr
+import numpy as np
+import pandas as pd
+
+import experiment
+from benchmarks.headless import HeadlessSession
+from benchmarks.multi_session import Components
+from constants import MARKDOWN_PREVIEW_DEBOUNCE
+from markdown_preview import markdown_preview
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+interactions_csv = os.path.join(root, "data", "mathconverse_parsed_interactions.csv")
+
+
+def participant_messages(n):
+    """The first n messages of the participants to the models, with formulas first"""
+    frame = pd.read_csv(interactions_csv, usecols=["human_interactions"])
+    messages = []
+    for interactions in frame["human_interactions"]:
+        for message in ast.literal_eval(interactions):
+            messages.append(message[len("User: "):] if message.startswith("User: ") else message)
+    messages.sort(key=lambda message: "$" not in message)
+    return messages[:n]
+
+
+def former_preview(text, visualiser):
+    """What the former render_markdown handler and the gr.Markdown preview did with the text"""
+    import matplotlib.pyplot as plt
+    try:
+        trial = gr.Markdown(text)
+        del trial
+        plt.close()
+    except ValueError as e:
+        plt.close()
+        text = str(e)
+    # gr.Markdown renders its value before sending it to the page
+    return visualiser.postprocess(text)
+
+
+def timed(function, texts):
+    """Milliseconds of function on each text"""
+    times = []
+    for text in texts:
+        start = time.perf_counter()
+        function(text)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def typed(text, characters):
+    """The text as it stands after every few characters typed"""
+    return [text[:end] for end in range(characters, len(text), characters)] + [text]
+
+
+def preview_latency(messages, characters):
+    visualiser = gr.Markdown()
+    markdown_preview.clear()
+    latencies = {
+        "former handler": timed(lambda text: former_preview(text, visualiser), messages),
+        "first render": timed(markdown_preview.render, messages),
+        "same text again": timed(markdown_preview.render, messages),
+    }
+    markdown_preview.clear()
+    keystrokes = [prefix for message in messages if "$" in message for prefix in typed(message, characters)]
+    latencies[f"typing, every {characters} characters"] = timed(markdown_preview.render, keystrokes)
+    return latencies
+
+
+async def live_preview(keystrokes, interval, pause):
+    """
+    A participant types keystrokes interval seconds apart, pausing for pause seconds half way
+    :return: the previews rendered, and the seconds from the last keystroke to the final preview
+    """
+    c = Components(experiment.demo)
+    txt = c.txt[0]
+    dependency = next(d for d in experiment.demo.dependencies if d["targets"] == [txt._id] and d["trigger"] == "change")
+    visualiser = dependency["outputs"][0]
+    session = HeadlessSession(experiment.demo)
+    markdown_preview.clear()
+    renders = sum(markdown_preview.previews.counters.values())
+
+    events = []
+    for i, text in enumerate(keystrokes):
+        session.set(txt, text)
+        events.append(asyncio.create_task(session.trigger(txt, event="change")))
+        await asyncio.sleep(pause if i == len(keystrokes) // 2 else interval)
+    last_keystroke = time.perf_counter()
+    await asyncio.gather(*events)
+    after_last = time.perf_counter() - last_keystroke
+    assert session.values[visualiser] == markdown_preview.render(keystrokes[-1]), "not the preview of the final text"
+    renders = sum(markdown_preview.previews.counters.values()) - renders - 1
+    return renders, after_last
+
+
+async def live_preview_across_tabs(first, second):
+    """The participant types first to the first model, then second to the second one within the debounce"""
+    c = Components(experiment.demo)
+    session = HeadlessSession(experiment.demo)
+    events, visualisers = [], []
+    for txt, text in [(c.txt[0], first), (c.txt[1], second)]:
+        dependency = next(d for d in experiment.demo.dependencies if d["targets"] == [txt._id] and d["trigger"] == "change")
+        visualisers.append(dependency["outputs"][0])
+        session.set(txt, text)
+        events.append(asyncio.create_task(session.trigger(txt, event="change")))
+        await asyncio.sleep(MARKDOWN_PREVIEW_DEBOUNCE / 4)
+    await asyncio.gather(*events)
+    return [session.values.get(visualiser) for visualiser in visualisers]
+
+
+def resident_memory(statements):
+    """Bytes of memory of a new python process that ran statements"""
+    code = f"import os\n{statements}\n" \
+           "print(int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+    return int(output.split()[-1])
+
+
+def memory():
+    text = "from markdown_preview import markdown_preview\nmarkdown_preview.render('**x**')"
+    formula = text + "\nmarkdown_preview.render('$x^2$')"
+    with_pyplot = formula + "\nimport matplotlib.pyplot"
+    gradio_pyplot = subprocess.run(
+        [sys.executable, "-c", "import sys, gradio; print('matplotlib.pyplot' in sys.modules)"],
+        cwd=root, capture_output=True, text=True, check=True
+    ).stdout.split()[-1] == "True"
+    sizes = {name: min(resident_memory(statements) for _ in range(3))
+             for name, statements in [("text", text), ("formula", formula), ("with_pyplot", with_pyplot)]}
+    return dict(sizes, gradio_imports_pyplot=gradio_pyplot)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200, help="messages of the participants to preview")
+    parser.add_argument("--characters", type=int, default=5, help="characters typed between two previews")
+    parser.add_argument("--keystrokes", type=int, default=40, help="keystrokes of the live preview")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between two keystrokes")
+    args = parser.parse_args()
+
+    # Characters mathtext has no glyph for (e.g. zero width spaces pasted with the formulas) are logged
+    logging.getLogger("matplotlib").setLevel(logging.ERROR)
+    messages = participant_messages(args.messages)
+    print(f"preview of {len(messages)} messages of the participants "
+          f"({sum('$' in message for message in messages)} with formulas)")
+    for name, latencies in preview_latency(messages, args.characters).items():
+        print(f"  {name:28s} n={len(latencies):5d}  p50 {np.median(latencies):8.3f} ms  "
+              f"p90 {np.percentile(latencies, 90):8.3f} ms  p99 {np.percentile(latencies, 99):8.3f} ms")
+
+    message = next(message for message in messages if "$" in message and len(message) > args.keystrokes)
+    keystrokes = [message[:len(message) * (i + 1) // args.keystrokes] for i in range(args.keystrokes)]
+    pause = 2 * MARKDOWN_PREVIEW_DEBOUNCE
+    renders, after_last = asyncio.run(live_preview(keystrokes, args.interval, pause))
+    print(f"live preview: {args.keystrokes} keystrokes {args.interval * 1000:.0f} ms apart with a pause of "
+          f"{pause:.1f}s half way: {renders} previews rendered, the last {after_last * 1000:.0f} ms after the last "
+          f"keystroke "
+          f"(debounce {MARKDOWN_PREVIEW_DEBOUNCE * 1000:.0f} ms)")
+    assert renders == 2, "the live preview must render once per pause in the typing"
+    previews = asyncio.run(live_preview_across_tabs(keystrokes[-1], "**to the second model**"))
+    assert previews == [markdown_preview.render(keystrokes[-1]), markdown_preview.render("**to the second model**")], \
+        "typing to a model must not hold back the preview of another"
+    print("live preview of two models typed to within the debounce: both rendered")
+
+    sizes = memory()
+    print(f"memory of a process that rendered text: {sizes['text'] / 1e6:.1f} MB, a formula: "
+          f"{sizes['formula'] / 1e6:.1f} MB, with matplotlib.pyplot imported as well: "
+          f"{sizes['with_pyplot'] / 1e6:.1f} MB "
+          f"({(sizes['with_pyplot'] - sizes['formula']) / 1e6:.1f} MB saved without pyplot, "
+          f"{(sizes['with_pyplot'] - sizes['text']) / 1e6:.1f} MB until a formula is previewed)")
+    if sizes["gradio_imports_pyplot"]:
+        print("  note: this version of gradio imports matplotlib.pyplot itself, so the app process still holds it")
@@ -0,0 +1,178 @@
+"""
+Overhead of the metrics of the hot paths (metrics.py), and their exporters.
+
+- cost of one timed call, for each kind of instrumented function, with the metrics on and off
+- the participant simulator (simulate_participants.py) with the metrics off and on, alternately: the CPU time the
+  process spent per participant, and an estimate of the share of it spent recording metrics (the number of
+  recorded values times their cost), which must stay under 1%
+- the Prometheus endpoint and the JSON lines dump serve what was recorded during the simulation
+
+    python -m benchmarks.bench_metrics --participants 20 --rounds 3
+"""
+import os
+
+# The shared backend is created when model_backend is first imported
+os.environ.setdefault("MODEL_BACKEND", "local")
+
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+
+import experiment
+import model_generate
+from benchmarks import simulate_participants
+from constants import RESULT_STORE_FILENAME
+from metrics import metrics, start_metrics_server, start_metrics_dump
+from model_backend import shared_backend
+from result_store import ResultStore
+
+
+def call_cost(n=100000):
+    """Microseconds of one call of an instrumented function, off and on, for each kind of function"""
+    def plain():
+        return 1
+
+    async def coroutine():
+        return 1
+
+    def generator():
+        yield 1
+
+    async def async_generator():
+        yield 1
+
+    async def run_coroutines(function):
+        for _ in range(n // 10):
+            await function()
+
+    async def run_async_generators(function):
+        for _ in range(n // 10):
+            async for _ in function():
+                pass
+
+    runs = {
+        "plain": (plain, lambda f: [f() for _ in range(n)], n),
+        "coroutine": (coroutine, lambda f: asyncio.run(run_coroutines(f)), n // 10),
+        "generator": (generator, lambda f: [list(f()) for _ in range(n // 10)], n // 10),
+        "async generator": (async_generator, lambda f: asyncio.run(run_async_generators(f)), n // 10),
+    }
+    costs = {}
+    for kind, (function, run, calls) in runs.items():
+        times = []
+        for timed in [function, metrics.instrument(f"bench_{kind}")(function)]:
+            start = time.perf_counter()
+            run(timed)
+            times.append((time.perf_counter() - start) / calls * 1e6)
+        metrics.enabled = False
+        start = time.perf_counter()
+        run(metrics.instrument(f"bench_{kind}")(function))
+        off = (time.perf_counter() - start) / calls * 1e6
+        metrics.enabled = True
+        costs[kind] = {"bare_us": times[0], "off_us": off, "on_us": times[1], "overhead_us": times[1] - times[0]}
+    metrics.reset()
+    return costs
+
+
+def counting(method, calls):
+    def count(*args, **kwargs):
+        calls[0] += 1
+        return method(*args, **kwargs)
+    return count
+
+
+def simulate(participants, turns, rounds):
+    """
+    CPU seconds per participant of each run of the simulator with the metrics off and on, and the values recorded (observations
+    and increments) per participant when on; counting them adds to the CPU time with the metrics on
+    """
+    cpu = {False: [], True: []}
+    calls = [0]
+    inc, observe = metrics.inc, metrics.observe
+    metrics.inc, metrics.observe = counting(inc, calls), counting(observe, calls)
+    try:
+        for _ in range(rounds):
+            for enabled in [False, True]:
+                metrics.enabled = enabled
+                before = calls[0]
+                start = time.process_time()
+                level = asyncio.run(simulate_participants.run_level(participants, turns, think_time=0.))
+                cpu[enabled].append((time.process_time() - start) / participants)
+                assert level["failed"] == 0, level["failures"]
+                if not enabled:
+                    # Counters still count with the timing off
+                    calls[0] = before
+    finally:
+        metrics.inc, metrics.observe = inc, observe
+        metrics.enabled = True
+    return {enabled: np.array(times) for enabled, times in cpu.items()}, calls[0] / rounds / participants
+
+
+def check_exporters():
+    server = start_metrics_server(port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+    with urllib.request.urlopen(url) as response:
+        text = response.read().decode("utf-8")
+    server.shutdown()
+    for series in ['checkmate_call_seconds_bucket{call="chatbot_generate_stream",le="+Inf"}',
+                   'checkmate_call_seconds_count{call="finish_rating"}', "checkmate_model_requests_total",
+                   "checkmate_model_tokens_total", "checkmate_response_cache_hits", "checkmate_results_saved_total"]:
+        assert series in text, f"{series} not served"
+    print(f"  {url}: {len(text.splitlines())} lines, e.g.")
+    for line in text.splitlines():
+        if 'call="chatbot_generate_stream"' in line and ("_count" in line or "_sum" in line):
+            print(f"    {line}")
+
+    directory = tempfile.mkdtemp(prefix="metrics_dump_")
+    path = os.path.join(directory, "metrics.jsonl")
+    stop = start_metrics_dump(path, interval=0.1)
+    time.sleep(0.35)
+    stop.set()
+    with open(path) as f:
+        snapshots = [json.loads(line) for line in f]
+    shutil.rmtree(directory)
+    assert snapshots and snapshots[-1]["histograms"], "nothing dumped"
+    chat = snapshots[-1]["histograms"]['checkmate_call_seconds{call="chatbot_generate_stream"}']
+    print(f"  {path}: {len(snapshots)} snapshots, chatbot_generate_stream count {chat['count']} "
+          f"p50 {chat['p50'] * 1000:.0f} ms p95 {chat['p95'] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=3, help="runs of the simulator with the metrics off and on")
+    args = parser.parse_args()
+
+    print("cost of a timed call")
+    costs = call_cost()
+    for kind, cost in costs.items():
+        print(f"  {kind:16s} bare {cost['bare_us']:6.2f} us, metrics off {cost['off_us']:6.2f} us, "
+              f"on {cost['on_us']:6.2f} us (+{cost['overhead_us']:.2f} us)")
+
+    # The models answer at once, for the simulator to spend its time in the app rather than waiting
+    shared_backend.config.update(first_token_latency=0., tokens_per_second=0., reply_tokens=64)
+    model_generate.response_cache.enabled = False
+    experiment.unique_saving_path = tempfile.mkdtemp(prefix="checkmate_metrics_")
+    experiment.result_store = ResultStore(os.path.join(experiment.unique_saving_path, RESULT_STORE_FILENAME))
+    try:
+        cpu, recorded = simulate(args.participants, args.turns, args.rounds)
+        experiment.result_store.flush()
+        print(f"simulator, {args.participants} participants, median of {args.rounds} runs")
+        off, on = np.median(cpu[False]), np.median(cpu[True])
+        print(f"  CPU per participant: metrics off {off * 1000:.1f} ms, on {on * 1000:.1f} ms ({on / off - 1:+.1%}; "
+              f"the runs with the metrics off vary by {np.ptp(cpu[False]) / off:.1%})")
+        estimate = recorded * max(cost["overhead_us"] for cost in costs.values()) / 1e6 / on
+        print(f"  {recorded:.0f} values recorded per participant, at most {estimate:.2%} of its CPU time")
+        assert estimate < 0.01, "the metrics cost more than 1% of the CPU time"
+        print("exporters")
+        check_exporters()
+    finally:
+        experiment.result_store.close()
+        shutil.rmtree(experiment.unique_saving_path, ignore_errors=True)
+    print("OK: the metrics cost under 1% of the simulator's CPU time")
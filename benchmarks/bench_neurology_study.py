@@ -0,0 +1,221 @@
+"""
+Load benchmark of minimal_neurology_study.py, the counterpart of simulate_participants.py for the experiment:
+simulated participants go through the study at the same time, start -> 4 cases (Neura/Oxford x Easy/Hard), asking
+Neura a few questions in the Neura cases -> answers of each case saved with save_responses. For each level of
+concurrency, reports
+- the latency of the chat turns (and of their first update), with the case text in the system prompt, and the size
+  of that prompt
+- the cost of converting the case HTML to markdown (case_markdown, run by load_case at every case switch)
+- the cost of save_responses, and the throughput of the result store committing the saved answers
+- the breakdown by phase of the time the participants spent in the study: case switches, chat, saving, thinking
+
+The study's event handlers need gradio 4 (async generator handlers), so they are not driven through the Blocks like
+the experiment's: each phase calls the module functions its handler calls (case_markdown, neura_chatbot_stream_async,
+save_responses). The models are simulated in process (local_backend.py) unless $MODEL_BACKEND says otherwise.
+
+    python -m benchmarks.bench_neurology_study --concurrency 1,10,50 --questions 3 --output neurology.json
+"""
+import os
+
+# The shared backend is created when model_backend is first imported
+os.environ.setdefault("MODEL_BACKEND", "local")
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+import model_generate
+from benchmarks.neurology import import_neurology_study
+from benchmarks.report import Recorder, compare, version
+from constants import RESULT_STORE_FILENAME
+from mock_openai_server import Distribution
+from model_backend import shared_backend
+from result_store import ResultStore
+from token_counter import count_message_tokens
+
+study = import_neurology_study()
+
+phases = ["case_switch", "chat", "save", "thinking"]
+
+
+async def participant(idx, questions, think_time, recorder, spent):
+    """One participant's way through the 4 cases; spent[phase] adds up the seconds they spent in each phase"""
+    session = str(uuid.uuid4())
+
+    async def think():
+        if think_time:
+            start = time.perf_counter()
+            await asyncio.sleep(random.expovariate(1 / think_time))
+            spent["thinking"] += time.perf_counter() - start
+
+    def timed(phase, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        recorder.latencies[phase].append(elapsed)
+        spent[phase] += elapsed
+        return result
+
+    for case_num, (condition, difficulty) in enumerate(zip(study.case_sequence, study.difficulty_sequence)):
+        case_text = study.problem_texts[case_num]["text"]
+        timed("case_switch", study.case_markdown, case_text)
+        history = []
+        if condition == "Neura":
+            for question in range(questions):
+                await think()
+                start, first_update = time.perf_counter(), None
+                async for history, _ in study.neura_chatbot_stream_async(
+                    f"Participant {idx}, question {question}: what is the most likely localisation?", history,
+                    case_text, session
+                ):
+                    if first_update is None:
+                        first_update = time.perf_counter() - start
+                elapsed = time.perf_counter() - start
+                spent["chat"] += elapsed
+                if history[-1]["content"].startswith("I apologize, but I'm"):
+                    recorder.errors["chat_turn"] += 1
+                    continue
+                recorder.latencies["chat_turn"].append(elapsed)
+                recorder.latencies["chat_first_update"].append(first_update)
+        await think()
+        responses = {f"{field}_{section}": f"Participant {idx}, case {case_num + 1}, {field} {section}"
+                     for section in "abc" for field in ["answer", "helpful"]}
+        responses["case_filename"] = study.problem_texts[case_num]["filename"]
+        timed("save", study.save_responses, session, case_num + 1, f"{condition}_{difficulty}", responses)
+
+
+async def run_level(concurrency, questions, think_time):
+    recorder = Recorder()
+    spent = {phase: 0. for phase in phases}
+    start = time.perf_counter()
+    await asyncio.gather(*[participant(i, questions, think_time, recorder, spent) for i in range(concurrency)])
+    wall_time = time.perf_counter() - start
+    # The answers are committed by the writer thread of the result store, after save_responses returned
+    flush_start = time.perf_counter()
+    study.result_store.flush()
+    total = sum(spent.values())
+    return {
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "participants_per_s": concurrency / wall_time,
+        "flush_after_s": time.perf_counter() - flush_start,
+        "chat_error_rate": recorder.errors["chat_turn"] / max(1, recorder.errors["chat_turn"]
+                                                             + len(recorder.latencies["chat_turn"])),
+        "events": recorder.summary(),
+        "phases": {phase: {"seconds": seconds, "share": seconds / total if total else 0.,
+                           "per_participant_s": seconds / concurrency} for phase, seconds in spent.items()},
+    }
+
+
+def save_throughput(saves, threads):
+    """Answers saved per second by save_responses from threads worker threads (as gradio runs sync handlers), and
+    committed per second by the result store"""
+    responses = {"answer_a": "An answer " * 20, "helpful_a": "Yes", "case_filename": "case_1.html"}
+
+    def save(i):
+        study.save_responses(f"burst-{i % 100}", i % 4 + 1, "Neura_Easy", responses)
+
+    start = time.perf_counter()
+    # save_responses logs every save: not shown here
+    with contextlib.redirect_stdout(io.StringIO()), concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(save, range(saves)))
+    saved = time.perf_counter() - start
+    study.result_store.flush()
+    committed = time.perf_counter() - start
+    return {"saves": saves, "threads": threads, "saved_per_s": saves / saved, "committed_per_s": saves / committed}
+
+
+def case_switch_cost():
+    """Size of each case and microseconds of its conversion to markdown, and tokens of its Neura system prompt"""
+    cases = []
+    for case_num, condition in enumerate(study.case_sequence):
+        text = study.problem_texts[case_num]["text"]
+        runs = 200
+        start = time.perf_counter()
+        for _ in range(runs):
+            study.case_markdown(text)
+        cases.append({
+            "case": case_num + 1,
+            "condition": condition,
+            "characters": len(text),
+            "markdown_us": (time.perf_counter() - start) / runs * 1e6,
+            "prompt_tokens": count_message_tokens(study.build_neura_messages("", [], text), study.NEURA_MODEL),
+        })
+    return cases
+
+
+def print_level(level):
+    print(f"{level['concurrency']:4d} participants: {level['wall_time_s']:7.2f}s, "
+          f"{level['participants_per_s']:6.2f} participants/s, {level['chat_error_rate']:.2%} of the chat turns "
+          f"failed, answers committed {level['flush_after_s'] * 1000:.1f} ms after the last save")
+    for name, event in level["events"].items():
+        if event["count"]:
+            print(f"     {name:18s} n={event['count']:5d}  p50 {event['p50_ms']:8.2f} ms  p90 {event['p90_ms']:8.2f} ms"
+                  f"  p99 {event['p99_ms']:8.2f} ms  errors {event['errors']}")
+    print("     by phase: " + ", ".join(f"{phase} {p['per_participant_s']:.3f}s ({p['share']:.1%})"
+                                        for phase, p in level["phases"].items()))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,10,50", help="comma separated numbers of simultaneous participants")
+    parser.add_argument("--questions", type=int, default=3, help="questions to Neura in each Neura case")
+    parser.add_argument("--think-time", type=float, default=0.2,
+                        help="mean seconds between two events of a participant")
+    parser.add_argument("--first-token-latency", type=Distribution.parse, default="0.3",
+                        help="of the local backend, seconds, a number or a distribution e.g. lognormal:0.3:0.3")
+    parser.add_argument("--tokens-per-second", type=Distribution.parse, default="50",
+                        help="of the local backend, a number or a distribution e.g. normal:50:10")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="of the local backend")
+    parser.add_argument("--saves", type=int, default=2000, help="answers saved at once to measure the save throughput")
+    parser.add_argument("--save-threads", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file for the results")
+    parser.add_argument("--compare", default=None, help="json results of a previous run, to compare with")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if hasattr(shared_backend, "config"):
+        shared_backend.config.update(first_token_latency=args.first_token_latency,
+                                     tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens)
+    model_generate.response_cache.enabled = False
+    saving_path = tempfile.mkdtemp(prefix="neurology_simulation_")
+    study.result_store.close()
+    study.result_store = ResultStore(os.path.join(saving_path, RESULT_STORE_FILENAME))
+
+    results = {"version": version(), "backend": type(shared_backend).__name__, "config": vars(args), "levels": []}
+    results["config"].update(first_token_latency=repr(args.first_token_latency),
+                             tokens_per_second=repr(args.tokens_per_second))
+    try:
+        results["cases"] = case_switch_cost()
+        for case in results["cases"]:
+            print(f"case {case['case']} ({case['condition']}): {case['characters']} characters, converted to markdown"
+                  f" in {case['markdown_us']:.1f} us, Neura system prompt of {case['prompt_tokens']} tokens")
+        for concurrency in [int(n) for n in args.concurrency.split(",")]:
+            level = asyncio.run(run_level(concurrency, args.questions, args.think_time))
+            results["levels"].append(level)
+            print_level(level)
+        results["save_throughput"] = save_throughput(args.saves, args.save_threads)
+        print(f"save throughput: {results['save_throughput']['saved_per_s']:.0f} answers/s saved from "
+              f"{args.save_threads} threads, {results['save_throughput']['committed_per_s']:.0f}/s committed")
+        assert len(study.result_store.records("case_responses")) == \
+            4 * sum(level["concurrency"] for level in results["levels"]) + args.saves, "answers were lost"
+    finally:
+        study.result_store.close()
+        shutil.rmtree(saving_path, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,106 @@
+"""
+Prompt assembly for every problem and model: the former way (the few-shot examples stripped and joined for each
+prompt, then the prompt split back into chat messages with str.replace for the chat models), against the compiled
+few-shot templates with memoized construct_prompt, and construct_messages for the chat models.
+Checks that both give the same prompts and messages, the former prompts being built exactly as before the templates.
+
+    python -m benchmarks.bench_prompt_assembly --rounds 100
+"""
+import time
+
+from data.data_utils.load_problems import load_problems
+from data.data_utils.load_prompts import get_prompt_examples, construct_one_example, construct_prompt, \
+    construct_messages
+from model_generate import prompt_to_messages, legacy_system_prompt, legacy_chat_models
+
+models = ["instructgpt", "chatgpt", "chatgpt4"]
+
+
+def former_construct_prompt(problem_id, problem_text, prompt_examples):
+    # The former construct_prompt, with its own choice of examples
+    tens_digit, ones_digit = divmod(problem_id, 10)
+    indices_of_examples = [10 * tens_digit + (2 if ones_digit == 1 else 1)]
+    total_examples = "\n".join(
+        construct_one_example(prompt_examples[index]["question"].strip(), prompt_examples[index]["answer"].strip())
+        for index in indices_of_examples
+    ).strip()
+    return total_examples + f"\nQuestion: {problem_text.strip()}\nAnswer:"
+
+
+def former_messages(prompt):
+    # The former string round trip of model_generate.generate
+    message_string = prompt.replace("Question:", "<delim>user:")
+    message_string = message_string.replace("Answer:", "<delim>assistant:")
+    messages = [m.strip() for m in message_string.split("<delim>")]
+    conversation = []
+    for message in [m for m in messages if m]:
+        if message.startswith("user:"):
+            conversation.append({"role": "user", "content": message[5:]})
+        elif message.startswith("assistant:"):
+            conversation.append({"role": "assistant", "content": message[10:]})
+    return [{"role": "system", "content": legacy_system_prompt}, conversation[-2]]
+
+
+def former(problems, prompt_examples):
+    requests = []
+    for problem in problems:
+        for model in models:
+            prompt = former_construct_prompt(problem["id"], problem["text"], prompt_examples)
+            requests.append(former_messages(prompt) if model in legacy_chat_models else prompt)
+    return requests
+
+
+def compiled(problems, prompt_examples):
+    requests = []
+    for problem in problems:
+        for model in models:
+            if model in legacy_chat_models:
+                requests.append(construct_messages(problem["id"], problem["text"], prompt_examples,
+                                                   system_prompt=legacy_system_prompt, few_shot=False))
+            else:
+                requests.append(construct_prompt(problem["id"], problem["text"], prompt_examples))
+    return requests
+
+
+def per_round(fn, rounds, *args):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(*args)
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=100)
+    args = parser.parse_args()
+
+    problems = load_problems("./data/problems/")
+    prompt_examples = get_prompt_examples("./data/prompts/")
+    # p60 never had a prompt: its examples would be those of a seventh domain
+    for problem in problems:
+        if problem["id"] == 60:
+            for construct in [former_construct_prompt, construct_prompt]:
+                try:
+                    construct(problem["id"], problem["text"], prompt_examples)
+                except KeyError:
+                    continue
+                raise AssertionError(f"{construct.__name__} built a prompt for p60")
+    problems = [problem for problem in problems if problem["id"] != 60]
+
+    # The prompts are unchanged, and the structured messages are those of the round trip (up to the leading space
+    # the round trip left in the question)
+    for problem in problems:
+        prompt = construct_prompt(problem["id"], problem["text"], prompt_examples)
+        assert prompt == former_construct_prompt(problem["id"], problem["text"], prompt_examples)
+        assert prompt_to_messages(prompt)[-2:] == [m for m in former_messages(prompt)[1:]] + [
+            {"role": "assistant", "content": ""}]
+        structured = construct_messages(problem["id"], problem["text"], prompt_examples,
+                                        system_prompt=legacy_system_prompt, few_shot=False)
+        assert [{**m, "content": m["content"].strip()} for m in former_messages(prompt)] == structured
+
+    n = len(problems) * len(models)
+    for name, fn in [("former", former), ("compiled templates", compiled)]:
+        seconds = per_round(fn, args.rounds, problems, prompt_examples)
+        print(f"{name:24s}{seconds * 1e3:8.3f} ms for {n} prompts ({seconds / n * 1e6:6.2f} us each)")
@@ -0,0 +1,157 @@
+"""
+Client-side rate limiting of the model backend (rate_limiter.py), against the local mock OpenAI server enforcing
+requests and tokens per minute, as the OpenAI API does:
+
+- limits: a cohort of participants chats faster than the limits allow; without the rate limiter the upstream answers
+  429 (retried by the backend), with it every request waits for its turn instead and none is refused
+- fairness: one participant sends a burst of requests, then a few others ask one question each (through the chat
+  handler); with per-participant queues they are served within a few turns, with a single shared (FIFO) queue they
+  wait behind the whole burst
+
+The limits are scaled down (a second's worth of the limits can be used at once, instead of a minute's), for the
+benchmark to take seconds.
+
+    python -m benchmarks.bench_rate_limit --participants 20 --questions 5 --rpm 600 --tpm 30000
+"""
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+import model_generate
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+from rate_limiter import RateLimiter
+from resilience import ModelBackendError, Resilience
+
+model = "gpt-3.5-turbo"
+
+
+def question(participant, i):
+    return [{"role": "user", "content": f"Participant {participant}, question {i}: " + "why is this true? " * (i % 4)}]
+
+
+class DepthSampler:
+    """The largest queue depth and number of waiting participants seen, sampled from another thread"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.max_depth = self.max_participants = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            stats = shared_backend.rate_limiter.stats().get(model)
+            if stats:
+                self.max_depth = max(self.max_depth, stats["queue_depth"])
+                self.max_participants = max(self.max_participants, stats["waiting_participants"])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+async def cohort(participants, questions, max_tokens):
+    """Every participant sends their questions one after the other; :return: latencies of the replies, errors"""
+    latencies, errors = [], []
+
+    async def participant(p):
+        for i in range(questions):
+            start = time.perf_counter()
+            try:
+                await shared_backend.chat_completion(model, question(p, i), f"participant-{p}", max_tokens=max_tokens)
+            except ModelBackendError as e:
+                errors.append(e)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[participant(p) for p in range(participants)])
+    return np.array(latencies), errors
+
+
+def compare_limits(server, limits, participants, questions, max_tokens):
+    for limited in [False, True]:
+        shared_backend.rate_limiter = RateLimiter(limits if limited else {}, burst=1.)
+        shared_backend.resilience = Resilience(backoff_base=0.05, breaker_failures=10 ** 6)
+        time.sleep(1.5)  # for the limits of the upstream to refill after the previous run
+        hits, refused = server.hits, server.faults["limits_exceeded"]
+        start = time.perf_counter()
+        with DepthSampler() as sampler:
+            latencies, errors = asyncio.run(cohort(participants, questions, max_tokens))
+        wall_time = time.perf_counter() - start
+        refused = server.faults["limits_exceeded"] - refused
+        n = participants * questions
+        print(f"  rate limiter {'on ' if limited else 'off'}: {n} requests in {wall_time:.2f}s "
+              f"({n / wall_time:.1f}/s), {server.hits - hits} upstream, {refused} answered 429, "
+              f"{shared_backend.resilience.stats().get('retries', 0)} retries, {len(errors)} failed, "
+              f"latency p50 {np.percentile(latencies, 50):.2f}s p95 {np.percentile(latencies, 95):.2f}s")
+        if limited:
+            stats = shared_backend.rate_limiter.stats()[model]
+            print(f"    queue: {stats['queued']} of {stats['admitted']} requests waited, max depth "
+                  f"{sampler.max_depth} across {sampler.max_participants} participants, wait mean "
+                  f"{stats['wait_mean']:.2f}s p95 {stats['wait_p95']:.2f}s max {stats['wait_max']:.2f}s")
+            assert refused == 0 and not errors, "requests were sent over the limits"
+
+
+async def burst_then_questions(burst, quiet, max_tokens, fair):
+    """:return: seconds each quiet participant waited for their reply"""
+    async def chatty(i):
+        participant = "chatty" if fair else None
+        await shared_backend.chat_completion(model, question("chatty", i), participant, max_tokens=max_tokens)
+
+    async def ask(p):
+        # One question through the study's chat handler, as a participant of the experiment would
+        await asyncio.sleep(0.1)
+        session = {"unique_key": f"quiet-{p}" if fair else None}
+        start = time.perf_counter()
+        await model_generate.chatbot_generate_async(f"Quiet participant {p} asks a question.", Conversation(),
+                                                    "chatgpt", session)
+        return time.perf_counter() - start
+
+    results = await asyncio.gather(*[chatty(i) for i in range(burst)], *[ask(p) for p in range(quiet)])
+    return np.array(results[burst:])
+
+
+def compare_fairness(limits, burst, quiet, max_tokens):
+    waits = {}
+    for fair in [False, True]:
+        shared_backend.rate_limiter = RateLimiter(limits, burst=1.)
+        time.sleep(1.5)
+        waits[fair] = asyncio.run(burst_then_questions(burst, quiet, max_tokens, fair))
+        print(f"  {'per-participant queues' if fair else 'one shared queue      '}: the {quiet} quiet participants "
+              f"waited mean {waits[fair].mean():.2f}s, max {waits[fair].max():.2f}s, behind a burst of {burst}")
+    assert waits[True].max() < waits[False].mean(), "the burst of one participant delayed the others"
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--tpm", type=int, default=30000)
+    parser.add_argument("--max-tokens", type=int, default=40)
+    parser.add_argument("--burst", type=int, default=40, help="requests sent at once by the chatty participant")
+    parser.add_argument("--quiet", type=int, default=5, help="participants asking one question during the burst")
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    limits = {model: {"requests": args.rpm, "tokens": args.tpm}}
+    server = start_mock_server(first_token_latency=args.first_token_latency, rate_limits=limits, rate_limit_burst=1.)
+    shared_backend.api_base = server.url + "/v1"
+    model_generate.response_cache.enabled = False
+    model_generate.generation_params["max_tokens"] = args.max_tokens
+
+    print(f"limits of {model}: {args.rpm} requests and {args.tpm} tokens per minute")
+    compare_limits(server, limits, args.participants, args.questions, args.max_tokens)
+    print("fairness")
+    compare_fairness(limits, args.burst, args.quiet, args.max_tokens)
+    print("OK: no request over the limits, and a burst of one participant does not hold up the others")
+    server.shutdown()
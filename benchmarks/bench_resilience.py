@@ -0,0 +1,203 @@
+"""
+Retries, deadlines, circuit breaking and hedging of the model backend (resilience.py), against the local mock OpenAI
+server with injected faults:
+
+- retries: a share of the requests fail (500) or are rate limited (429); every call must still succeed
+- deadline: the upstream hangs; calls must fail after the deadline, not wait for it
+- request timeout: some requests outlast the timeout of the HTTP request, well within the deadline of the model;
+  they must be retried, not fail as if the deadline had passed
+- circuit breaker: the upstream is down; after a few failures, calls must fail at once without reaching it, and
+  succeed again once it is back
+- handler: a failed turn of the study chat must leave the conversation as it was, for the question to be resent
+- hedging: a few requests are very slow; tail latency with and without hedged requests
+
+    python -m benchmarks.bench_resilience --requests 400 --slow-rate 0.04 --slow-latency 1
+"""
+import asyncio
+import time
+
+import numpy as np
+
+import gradio as gr
+
+import model_generate
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+from resilience import CircuitOpen, DeadlineExceeded, ModelBackendError, Resilience
+
+model = "gpt-3.5-turbo"
+messages = [{"role": "user", "content": "Show that every group of prime order is cyclic."}]
+
+
+def set_faults(server, **faults):
+    server.config.update(error_rate=0., rate_limit_rate=0., slow_rate=0.)
+    server.config.update(faults)
+
+
+async def many_calls(n, concurrency, stream=False):
+    """:return: latencies (time to the first piece for streams), errors"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def call(i):
+        async with semaphore:
+            request = [{"role": "user", "content": f"Question {i}"}]
+            start = time.perf_counter()
+            try:
+                if stream:
+                    async for _ in shared_backend.stream_chat_completion(model, request, max_tokens=16):
+                        latencies.append(time.perf_counter() - start)
+                        break
+                else:
+                    await shared_backend.chat_completion(model, request, max_tokens=16)
+                    latencies.append(time.perf_counter() - start)
+            except ModelBackendError as e:
+                errors.append(e)
+
+    await asyncio.gather(*[call(i) for i in range(n)])
+    return np.array(latencies), errors
+
+
+def percentiles(latencies):
+    return "  ".join(f"p{q} {np.percentile(latencies, q) * 1000:7.1f} ms" for q in [50, 95, 99]) + \
+        f"  max {latencies.max() * 1000:7.1f} ms"
+
+
+def check_retries(server, n):
+    set_faults(server, error_rate=0.15, rate_limit_rate=0.15)
+    for max_retries in [0, 6]:
+        shared_backend.resilience = Resilience(max_retries=max_retries, backoff_base=0.02, backoff_max=0.2,
+                                               breaker_failures=10 ** 6)
+        hits, faults = server.hits, dict(server.faults)
+        _, errors = asyncio.run(many_calls(n, 16))
+        stats = shared_backend.resilience.stats()
+        print(f"  max_retries={max_retries}: {len(errors)}/{n} calls failed, {stats.get('retries', 0)} retries, "
+              f"{server.hits - hits} upstream requests")
+    assert not errors, "calls failed despite the retries"
+
+
+def check_deadline(server):
+    set_faults(server, slow_rate=1., slow_latency=5.)
+    shared_backend.resilience = Resilience(deadlines={model: 0.5})
+    for stream in [False, True]:
+        start = time.perf_counter()
+        _, errors = asyncio.run(many_calls(1, 1, stream=stream))
+        elapsed = time.perf_counter() - start
+        print(f"  {'stream' if stream else 'call'}: {type(errors[0]).__name__} after {elapsed:.2f}s (deadline 0.5s)")
+        assert isinstance(errors[0], DeadlineExceeded) and elapsed < 1.
+
+
+def set_request_timeout(seconds):
+    """The timeout of the HTTP requests of the backend, taken by the session it opens next"""
+    shared_backend.request_timeout = seconds
+    if shared_backend._session is not None:
+        shared_backend.submit(shared_backend._session.close()).result()
+
+
+def check_request_timeout(server, n):
+    set_faults(server, slow_rate=0.3, slow_latency=1.)
+    # A call fails only if its 11 attempts all time out (0.3 ** 11, 2e-6), well within the deadline (11 * 0.35s)
+    shared_backend.resilience = Resilience(deadlines={model: 10.}, max_retries=10, backoff_base=0.01, backoff_max=0.05,
+                                           breaker_failures=10 ** 6)
+    request_timeout = shared_backend.request_timeout
+    set_request_timeout(0.3)
+    try:
+        for stream in [False, True]:
+            retries = shared_backend.resilience.stats().get("retries", 0)
+            _, errors = asyncio.run(many_calls(n, 8, stream=stream))
+            stats = shared_backend.resilience.stats()
+            print(f"  {'stream' if stream else 'call'}: {len(errors)}/{n} calls failed, "
+                  f"{stats.get('retries', 0) - retries} retries of the requests that timed out after 0.3s "
+                  f"(deadline 10s)")
+            assert not errors, errors[0]
+            assert stats.get("retries", 0) > retries and not stats.get("deadlines")
+    finally:
+        set_request_timeout(request_timeout)
+
+
+def check_circuit_breaker(server):
+    set_faults(server, error_rate=1.)
+    shared_backend.resilience = Resilience(max_retries=0, breaker_failures=5, breaker_reset=0.5)
+    hits = server.hits
+    outcomes = []
+    for _ in range(20):
+        start = time.perf_counter()
+        try:
+            shared_backend.chat_completion_sync(model, messages, max_tokens=16)
+        except ModelBackendError as e:
+            outcomes.append((type(e).__name__, time.perf_counter() - start))
+    fast = [elapsed for name, elapsed in outcomes if name == "CircuitOpen"]
+    print(f"  upstream down: {server.hits - hits} of 20 calls reached it, the other {len(fast)} failed fast "
+          f"(mean {np.mean(fast) * 1000:.2f} ms)")
+    assert server.hits - hits == 5 and len(fast) == 15
+
+    set_faults(server)
+    time.sleep(0.5)
+    shared_backend.chat_completion_sync(model, messages, max_tokens=16)
+    print(f"  upstream back: probe call succeeded, circuits {shared_backend.resilience.stats()['circuits']}")
+    assert shared_backend.resilience.breaker(model).state == "closed"
+
+
+def check_handler(server):
+    set_faults(server, error_rate=1.)
+    shared_backend.resilience = Resilience(max_retries=1, backoff_base=0.01, breaker_failures=10 ** 6)
+    for handler in [model_generate.chatbot_generate, model_generate.chatbot_generate_stream]:
+        conversation = Conversation()
+        try:
+            outputs = handler("A question", conversation, "chatgpt")
+            if not isinstance(outputs, tuple):
+                for outputs in outputs:
+                    pass
+        except gr.Error as e:
+            print(f"  {handler.__name__}: gr.Error({str(e)[:60]}...), {len(conversation)} turns left")
+            assert len(conversation) == 0
+        else:
+            raise AssertionError("the handler did not report the failure")
+
+
+def compare_hedging(server, n, concurrency, slow_rate, slow_latency):
+    set_faults(server, slow_rate=slow_rate, slow_latency=slow_latency)
+    for stream in [False, True]:
+        for hedge in [False, True]:
+            shared_backend.resilience = Resilience(hedge=hedge, breaker_failures=10 ** 6)
+            # warm up the latency percentiles, then measure
+            asyncio.run(many_calls(50, concurrency, stream=stream))
+            hits = server.hits
+            latencies, errors = asyncio.run(many_calls(n, concurrency, stream=stream))
+            stats = shared_backend.resilience.stats()
+            print(f"  {'first piece' if stream else 'full reply '} hedging {'on ' if hedge else 'off'}: "
+                  f"{percentiles(latencies)}   {server.hits - hits} upstream requests for {n}, "
+                  f"{stats.get('hedged', 0)} hedged, {stats.get('hedge_wins', 0)} won")
+            assert not errors
+            assert stats.get("hedged", 0) <= shared_backend.resilience.hedge_max_rate * stats["requests"]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.04)
+    parser.add_argument("--slow-latency", type=float, default=1.)
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency, retry_after=0.)
+    shared_backend.api_base = server.url + "/v1"
+    model_generate.response_cache.enabled = False
+
+    print("retries (15% server errors, 15% rate limits)")
+    check_retries(server, args.requests // 2)
+    print("deadline (upstream hangs for 5s)")
+    check_deadline(server)
+    print("request timeout (30% of the requests outlast it)")
+    check_request_timeout(server, 40)
+    print("circuit breaker (upstream down, then back)")
+    check_circuit_breaker(server)
+    print("chat handler (upstream down)")
+    check_handler(server)
+    print(f"hedging ({args.slow_rate:.0%} of the requests {args.slow_latency:g}s slower)")
+    compare_hedging(server, args.requests, args.concurrency, args.slow_rate, args.slow_latency)
+    print("injected faults:", dict(server.faults))
+    server.shutdown()
@@ -0,0 +1,132 @@
+"""
+Write throughput of the study results under concurrent sessions: each session, on its own thread, saves the records
+of a whole study (survey, problem order, then for each problem set the solo solve, problem details and conversation
+rating of every model, the model ranks and the preferences), the way experiment.py does.
+Compares the former one-JSON-file-per-step layout (as it was, without flushing, and with an fsync per file to make
+it crash safe) with the batched ResultStore.
+
+    python -m benchmarks.bench_result_store --sessions 100
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from result_store import ResultStore
+
+model_names = ["chatgpt", "instructgpt", "chatgpt4"]
+
+
+def session_records(session_idx, problem_sets, turns):
+    """(kind, data, problem_set_index, model) of the records of one session"""
+    conversation = {
+        "turns": [{"user": f"User: question {t} " + "x" * 200, "ai": f"AI: answer {t} " + "y" * 800,
+                   "helpfulness": "4", "correctness": "5"} for t in range(turns)],
+        "time_taken": 300.,
+    }
+    records = [
+        ("user_survey_metadata", {"mth_bkgrd": "a", "ai_play_bkgrd": "b", "selected_topic": "Topology"}, None, None),
+        ("problem_ordering", {"problem_order": list(range(problem_sets))}, None, None),
+    ]
+    for problem_set in range(problem_sets):
+        for model in model_names:
+            records.append(("solo_solve", {"solo_solve": "3"}, problem_set, model))
+            records.append(("problem_details", {"text": "p" * 1500, "filename": f"p{session_idx}.md"}, problem_set, model))
+            records.append(("conversation_rating", conversation, problem_set, model))
+        records.append(("model_ranks", dict(zip(model_names, ["1", "2", "3"]), model_presentation_order=model_names),
+                        problem_set, None))
+        records.append(("final_preferences", {"prefence_data": []}, problem_set, None))
+    return records
+
+
+def write_json_files(root, fsync):
+    def write(session_id, kind, data, problem_set_index=None, model=None):
+        # The former layout: problem_set_index_<n>/<model>/<session id>/<kind>.json
+        parts = [root]
+        if problem_set_index is not None:
+            parts.append(f"problem_set_index_{problem_set_index}")
+        if model is not None:
+            parts.append(model)
+        parts.append(session_id)
+        path = os.path.join(*parts)
+        os.makedirs(path, exist_ok=True)
+        if fsync:
+            with open(os.path.join(path, f"{kind}.json"), "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            json.dump(data, open(os.path.join(path, f"{kind}.json"), "w"))
+    return write
+
+
+def run(write, sessions, records_per_session, think_time, finish=None):
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def session(idx):
+        own = []
+        barrier.wait()
+        for kind, data, problem_set_index, model in records_per_session[idx]:
+            if think_time:
+                time.sleep(np.random.uniform(0, think_time))
+            start = time.perf_counter()
+            write(f"session-{idx}", kind, data, problem_set_index=problem_set_index, model=model)
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if finish is not None:
+        # Until everything is on disk
+        finish()
+    wall_time = time.perf_counter() - start
+    latencies = np.array(latencies)
+    return {
+        "records": int(len(latencies)),
+        "wall_time_s": round(wall_time, 3),
+        "records_per_s": round(len(latencies) / wall_time, 1),
+        "write_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "write_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--problem-sets", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--think-time", type=float, default=0., help="max seconds between two writes of a session")
+    args = parser.parse_args()
+
+    records_per_session = [session_records(i, args.problem_sets, args.turns) for i in range(args.sessions)]
+    print(f"{args.sessions} concurrent sessions, {len(records_per_session[0])} records each")
+    print(f"{'':32s}{'records/s':>11s}{'wall (s)':>10s}{'write p50 (ms)':>16s}{'write p95 (ms)':>16s}{'fsyncs':>8s}")
+
+    results = {}
+    for name, fsync in [("json files (no flush)", False), ("json files + fsync", True)]:
+        with tempfile.TemporaryDirectory() as root:
+            results[name] = run(write_json_files(root, fsync), args.sessions, records_per_session, args.think_time)
+            results[name]["fsyncs"] = results[name]["records"] if fsync else 0
+
+    with tempfile.TemporaryDirectory() as root:
+        store = ResultStore(os.path.join(root, "results.sqlite"))
+        results["result store (batched fsync)"] = run(store.write, args.sessions, records_per_session, args.think_time,
+                                                      finish=store.flush)
+        results["result store (batched fsync)"]["fsyncs"] = store.counters["batches"]
+        assert len(store.records()) == sum(len(r) for r in records_per_session)
+        store.close()
+
+    for name, result in results.items():
+        print(f"{name:32s}{result['records_per_s']:11.0f}{result['wall_time_s']:10.2f}"
+              f"{result['write_p50_ms']:16.3f}{result['write_p95_ms']:16.3f}{result['fsyncs']:8d}")
@@ -0,0 +1,59 @@
+"""
+Time to first token of the blocking vs the streaming chatbot handler, against the local mock OpenAI server.
+Also checks that the finished history is identical between the two paths.
+
+    python -m benchmarks.bench_streaming --first-token-latency 0.5 --tokens-per-second 40
+"""
+import time
+
+import model_generate
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+
+
+def time_handler(handler, user_input, model):
+    conversation = Conversation()
+    start = time.perf_counter()
+    first_update = None
+    outputs = handler(user_input, conversation, model)
+    if not isinstance(outputs, tuple):
+        # a generator handler: consume the partial updates
+        for outputs in outputs:
+            if first_update is None:
+                first_update = time.perf_counter() - start
+    total = time.perf_counter() - start
+    if first_update is None:
+        first_update = total
+    return first_update, total, conversation.pairs()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=40.)
+    parser.add_argument("--reply-tokens", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second,
+                               reply_tokens=args.reply_tokens)
+    shared_backend.api_base = server.url + "/v1"
+    # measure the model calls themselves, not the response cache
+    model_generate.response_cache.enabled = False
+
+    user_input = "Show that every group of prime order is cyclic."
+    for model in ["chatgpt4", "instructgpt"]:
+        for name, handler in [("blocking", model_generate.chatbot_generate),
+                              ("streaming", model_generate.chatbot_generate_stream)]:
+            results = [time_handler(handler, user_input, model) for _ in range(args.repeats)]
+            first = sum(r[0] for r in results) / len(results)
+            total = sum(r[1] for r in results) / len(results)
+            print(f"{model:12s} {name:10s} first update {first * 1000:8.1f} ms   full response {total * 1000:8.1f} ms")
+            if name == "blocking":
+                blocking_history = results[0][2]
+            else:
+                assert results[0][2] == blocking_history, "streamed history differs from the blocking one"
+    print("Finished histories are identical between the blocking and streaming handlers")
+    server.shutdown()
@@ -0,0 +1,80 @@
+"""
+Load and query times of data.data_utils.load_taxonomy on annotated_taxonomy.csv repeated to N rows: parsing the csv
+and building the cache, then memory-mapping the cache, against pandas over the raw csv.
+
+    python -m benchmarks.bench_taxonomy --rows 9000
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data.data_utils.load_taxonomy import default_taxonomy_path, is_flagged, load_taxonomy, problems_by_text, \
+    normalise_whitespace, problem_topics
+
+
+def scaled_taxonomy(rows):
+    frame = pd.read_csv(default_taxonomy_path, dtype=str, keep_default_na=False)
+    scaled = frame.iloc[np.arange(rows) % len(frame)].reset_index(drop=True)
+    scaled["Orig Idx"] = np.arange(rows)
+    return scaled
+
+
+def per_call(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=9000)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "annotated_taxonomy.csv")
+        scaled_taxonomy(args.rows).to_csv(path, index=False)
+        print(f"{args.rows} rows, {os.path.getsize(path) / 1e6:.1f} MB csv")
+
+        start = time.perf_counter()
+        taxonomy = load_taxonomy(path)
+        print(f"{'parse csv + build + write cache':40s}{(time.perf_counter() - start) * 1e3:10.1f} ms")
+        print(f"{'cache size':40s}{os.path.getsize(path + '.cache') / 1e6:10.2f} MB")
+        load_time = per_call(lambda: load_taxonomy(path), 20)
+        print(f"{'memory-mapped load':40s}{load_time * 1e3:10.2f} ms")
+
+        start = time.perf_counter()
+        frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+        print(f"{'pandas read_csv':40s}{(time.perf_counter() - start) * 1e3:10.1f} ms")
+
+        taxonomy = load_taxonomy(path)
+        queries = {
+            "definition requests on topology": lambda: taxonomy.rows(categories=["definition"], topic="Topology"),
+            "rows of one category": lambda: taxonomy.rows(categories=["correction"]),
+            "any of 3 categories, one problem": lambda: taxonomy.rows(
+                categories=["definition", "example", "why"], problem_id=12),
+            "by orig idx": lambda: taxonomy.by_orig_idx(args.rows // 2),
+        }
+        print(f"\n{'query':40s}{'indexed (us)':>14s}")
+        for name, query in queries.items():
+            print(f"{name:40s}{per_call(query, args.repeat) * 1e6:14.1f}")
+
+        # The same first query over the DataFrame: flag parsing and problem matching included
+        problem_ids = problems_by_text(os.path.join(os.path.dirname(default_taxonomy_path), "problems"))
+        definition_column = frame.columns[4]
+
+        def pandas_query():
+            topic = frame["problem_declaration"].map(
+                lambda text: problem_topics.get(problem_ids.get(normalise_whitespace(text), -1)))
+            return np.flatnonzero((topic == "Topology") & frame[definition_column].map(is_flagged))
+
+        pandas_time = per_call(pandas_query, 5)
+        print(f"{'pandas, definition requests on topology':40s}{pandas_time * 1e6:14.1f}")
+        assert np.array_equal(pandas_query(), queries["definition requests on topology"]())
+        print("same rows")
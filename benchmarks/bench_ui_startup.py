@@ -0,0 +1,54 @@
+"""
+Startup time and page payload of the experiment interface.
+
+Builds the interface as it is served (a single problem block, refilled per session) and, for comparison, the
+eager layout where one block is built per problem set, then reports the build time, number of components and
+size of the page config every browser downloads.
+
+    python -m benchmarks.bench_ui_startup
+"""
+import gzip
+import json
+import time
+
+
+def page_payload(blocks):
+    config = json.dumps(blocks.get_config_file()).encode("utf-8")
+    return len(config), len(gzip.compress(config))
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    import gradio as gr
+    gradio_import = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import experiment
+    experiment_import = time.perf_counter() - start
+
+    # The eager layout: a problem block per problem set, all built up front
+    start = time.perf_counter()
+    with gr.Blocks() as eager_demo:
+        session_state = gr.State(experiment.new_session())
+        for _ in range(experiment.num_problems_show):
+            experiment.a_single_problem(session_state, display_info=False, is_visible=False)
+    eager_build = time.perf_counter() - start
+
+    # The served layout, rebuilt on its own for a like-for-like build time
+    start = time.perf_counter()
+    with gr.Blocks() as template_demo:
+        session_state = gr.State(experiment.new_session())
+        experiment.a_single_problem(session_state, display_info=False, is_visible=False)
+    template_build = time.perf_counter() - start
+
+    print(f"gradio import                  {gradio_import:8.2f} s")
+    print(f"experiment import (served app) {experiment_import:8.2f} s")
+    print()
+    print(f"{'':28s}{'build (s)':>10s}{'components':>12s}{'config (kB)':>13s}{'gzipped (kB)':>14s}")
+    for name, blocks, build in [
+        (f"eager ({experiment.num_problems_show} problem blocks)", eager_demo, eager_build),
+        ("template (1 problem block)", template_demo, template_build),
+        ("served app (experiment.demo)", experiment.demo, experiment_import),
+    ]:
+        raw, compressed = page_payload(blocks)
+        print(f"{name:28s}{build:10.2f}{len(blocks.blocks):12d}{raw / 1000:13.1f}{compressed / 1000:14.1f}")
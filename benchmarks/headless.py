@@ -0,0 +1,83 @@
+"""
+Headless driver for a gradio 3.x Blocks app: a HeadlessSession plays the part of one browser session,
+setting component values and triggering events through the app's real event handlers
+(Blocks.process_api), with its own copy of every gr.State, as gradio keeps for each session.
+Generator handlers are iterated to the end, like the queue does.
+"""
+import copy
+import time
+
+
+def find(demo, cls=None, **attributes):
+    """The components of demo, in creation order, of class name cls and with the given attribute values"""
+    return [
+        block for block in demo.blocks.values()
+        if (cls is None or type(block).__name__ == cls)
+        and all(getattr(block, name, None) == value for name, value in attributes.items())
+    ]
+
+
+def is_update(value):
+    return isinstance(value, dict) and value.get("__type__") == "update"
+
+
+class HeadlessSession:
+    def __init__(self, demo):
+        self.demo = demo
+        self.state = {
+            block_id: copy.deepcopy(block.value)
+            for block_id, block in demo.blocks.items() if getattr(block, "stateful", False)
+        }
+        self.values = {block_id: copy.deepcopy(getattr(block, "value", None)) for block_id, block in demo.blocks.items()}
+        self.visible = {block_id: getattr(block, "visible", True) for block_id, block in demo.blocks.items()}
+
+    def set(self, component, value):
+        """What the participant typed or selected in component"""
+        self.values[component._id] = value
+
+    def value(self, component):
+        if getattr(component, "stateful", False):
+            return self.state.get(component._id)
+        return self.values[component._id]
+
+    def is_visible(self, component):
+        return self.visible[component._id]
+
+    def _apply(self, dependency, data):
+        for output_id, value in zip(dependency["outputs"], data):
+            if getattr(self.demo.blocks[output_id], "stateful", False):
+                continue  # process_api already stored it in self.state
+            if is_update(value):
+                if "value" in value:
+                    self.values[output_id] = value["value"]
+                if "visible" in value:
+                    self.visible[output_id] = value["visible"]
+            else:
+                self.values[output_id] = value
+
+    async def trigger(self, component, event="click", on_update=None):
+        """
+        Run the handlers of component's event, in the order they were attached
+        :param on_update: called with the elapsed seconds at every update of a generator handler (e.g. streaming)
+        :return: seconds taken by each handler
+        """
+        timings = []
+        for fn_index, dependency in enumerate(self.demo.dependencies):
+            if component._id not in dependency["targets"] or dependency["trigger"] != event:
+                continue
+            inputs = [self.values.get(input_id) for input_id in dependency["inputs"]]
+            iterators = {}
+            start = time.perf_counter()
+            while True:
+                output = await self.demo.process_api(fn_index, inputs, self.state, iterators=iterators)
+                if iterators and not output.get("is_generating"):
+                    # The end of a generator, nothing left to apply
+                    break
+                self._apply(dependency, output["data"])
+                if not output.get("is_generating"):
+                    break
+                if on_update is not None:
+                    on_update(time.perf_counter() - start)
+                iterators = {fn_index: output["iterator"]}
+            timings.append(time.perf_counter() - start)
+        return timings
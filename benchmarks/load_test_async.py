@@ -0,0 +1,104 @@
+"""
+Load test of the chat handler: N simulated participants, each chatting for a few turns, against the local mock
+OpenAI server. Compares the async handler (chatbot_generate_async) with the blocking one (chatbot_generate) run on
+a pool of worker threads the size of gradio's default thread limit, and reports the p50/p95 handler latency.
+
+    python -m benchmarks.load_test_async --participants 200 --turns 3
+"""
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import model_generate
+from constants import model_options
+from conversation import Conversation
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+from rate_limiter import RateLimiter
+
+
+def summarise(latencies, wall_time):
+    latencies = np.array(latencies)
+    return {
+        "requests": int(len(latencies)),
+        "wall_time_s": round(wall_time, 3),
+        "throughput_rps": round(len(latencies) / wall_time, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1),
+        "max_ms": round(float(latencies.max()) * 1000, 1),
+    }
+
+
+async def async_participant(participant_idx, turns, think_time, latencies):
+    model = model_options[participant_idx % len(model_options)]
+    conversation = Conversation()
+    for turn in range(turns):
+        await asyncio.sleep(random.uniform(0, think_time))
+        start = time.perf_counter()
+        await model_generate.chatbot_generate_async(f"Question {turn} from participant {participant_idx}", conversation, model)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_async(participants, turns, think_time):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[async_participant(i, turns, think_time, latencies) for i in range(participants)])
+    return summarise(latencies, time.perf_counter() - start)
+
+
+def threaded_participant(participant_idx, turns, think_time, latencies, pool):
+    # Every turn is a separate gradio event, i.e. a separate job for the worker pool
+    model = model_options[participant_idx % len(model_options)]
+    conversation = Conversation()
+    for turn in range(turns):
+        time.sleep(random.uniform(0, think_time))
+        start = time.perf_counter()
+        pool.submit(model_generate.chatbot_generate, f"Question {turn} from participant {participant_idx}",
+                    conversation, model).result()
+        latencies.append(time.perf_counter() - start)
+
+
+def run_threaded(participants, turns, think_time, worker_threads):
+    latencies = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(worker_threads) as pool, ThreadPoolExecutor(participants) as clients:
+        list(clients.map(lambda i: threaded_participant(i, turns, think_time, latencies, pool), range(participants)))
+    return summarise(latencies, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=1., help="maximum pause between turns, in seconds")
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=0., help="0 for instant generation")
+    parser.add_argument("--worker-threads", type=int, default=40, help="gradio/starlette default thread limit")
+    parser.add_argument("--output", default=None, help="optional json file for the results")
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second)
+    shared_backend.api_base = server.url + "/v1"
+    # measure the model calls themselves, not the response cache
+    model_generate.response_cache.enabled = False
+    # let every simulated participant have a request in flight
+    shared_backend.concurrency_limits = {model: args.participants for model in shared_backend.concurrency_limits}
+    # the mock server has no rate limits (see bench_rate_limit for those), so neither has the client
+    shared_backend.rate_limiter = RateLimiter({})
+
+    results = {
+        "config": vars(args),
+        "async_handler": asyncio.run(run_async(args.participants, args.turns, args.think_time)),
+        "threaded_handler": run_threaded(args.participants, args.turns, args.think_time, args.worker_threads),
+        "upstream_requests": server.hits,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    server.shutdown()
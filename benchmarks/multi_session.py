@@ -0,0 +1,190 @@
+"""
+Multi-client check of experiment.py: N participants go through the study at the same time (instructions, survey,
+then for each model of their first problem set: solo solve, a few chat turns, rating; then the model ranks and the
+next batch), each thinking for a different time, against the local mock OpenAI server.
+Every participant's records in the result store must carry their own answers, under their own id, with time_taken
+values that match their own timings.
+
+    python -m benchmarks.multi_session --sessions 20 --turns 2
+"""
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import experiment
+import model_generate
+from benchmarks.headless import HeadlessSession, find
+from constants import instruction_pages, experience_options, ai_experience_options, solo_solve_options, \
+    usefulness_options, correctness_options, RESULT_STORE_FILENAME
+from mock_openai_server import start_mock_server
+from model_backend import shared_backend
+from result_store import ResultStore
+
+
+class Components:
+    """Handles on the components of experiment.demo that a participant interacts with"""
+
+    def __init__(self, demo):
+        continue_buttons = find(demo, "Button", value="Continue")
+        # Creation order: the first page of each model tab, then the survey page, then the instruction pages
+        self.model_continue = continue_buttons[:-2]
+        self.survey_continue = continue_buttons[-2]
+        self.instruction_continue = continue_buttons[-1]
+        self.maths_experience = find(demo, "Radio", label="What is your level of mathematical expertise?")[0]
+        self.ai_experience = find(
+            demo, "Radio", label="How much have you played with interactive AI-based language models before?"
+        )[0]
+        self.topic = find(demo, "Radio", label="What category of maths problems would you like to evaluate?")[0]
+        self.solo_solve = [radio for radio in find(demo, "Radio") if radio.choices == solo_solve_options]
+        self.interact_with_ai = find(demo, "Button", value="Interact with an AI")
+        self.txt = find(demo, "Textbox", placeholder="Enter text and press the Interact button")
+        self.interact = find(demo, "Button", value="Interact")
+        self.done = find(demo, "Button", value="Done with interaction")
+        self.helpfulness = [radio for radio in find(demo, "Radio") if radio.choices == usefulness_options]
+        self.correctness = [radio for radio in find(demo, "Radio") if radio.choices == correctness_options]
+        self.next_turn = find(demo, "Button", value="Next turn")
+        self.finish_rating = find(demo, "Button", value="Finish rating")
+        self.start_comparing = find(demo, "Button", value="Start comparing different models")
+        self.ranks = find(demo, "Dropdown")
+        self.finish_comparing = find(demo, "Button", value="Finish comparing different models")
+        self.next_batch = find(demo, "Button", value="Go to the next batch of problems")[0]
+        self.session_state = [block for block in demo.blocks.values()
+                              if getattr(block, "stateful", False) and isinstance(block.value, dict)
+                              and "unique_key" in block.value][0]
+
+
+async def participant(idx, components, turns, think_time):
+    """One participant's way through the first problem set; returns what they did, to be checked against the saves"""
+    c = components
+    session = HeadlessSession(experiment.demo)
+    record = {"idx": idx, "windows": {}}
+
+    for _ in instruction_pages:
+        await session.trigger(c.instruction_continue)
+    record["survey"] = {
+        "mth_bkgrd": experience_options[idx % len(experience_options)],
+        "ai_play_bkgrd": ai_experience_options[idx % len(ai_experience_options)],
+        "selected_topic": experiment.problem_topics[idx % len(experiment.problem_topics)],
+    }
+    session.set(c.maths_experience, record["survey"]["mth_bkgrd"])
+    session.set(c.ai_experience, record["survey"]["ai_play_bkgrd"])
+    session.set(c.topic, record["survey"]["selected_topic"])
+    await session.trigger(c.survey_continue)
+    state = session.value(c.session_state)
+    record["unique_key"] = state["unique_key"]
+    record["block"] = state["block"]
+
+    for model_idx in range(len(c.model_continue)):
+        started = time.time()
+        await session.trigger(c.model_continue[model_idx])
+        window_start = time.time()
+        session.set(c.solo_solve[model_idx], solo_solve_options[idx % len(solo_solve_options)])
+        await session.trigger(c.interact_with_ai[model_idx])
+        for turn in range(turns):
+            session.set(c.txt[model_idx], f"Participant {idx} asks question {turn} to model {model_idx}")
+            await session.trigger(c.interact[model_idx])
+        # Each participant takes a different time over each model
+        await asyncio.sleep(think_time * random.uniform(0.5, 1.5))
+        await session.trigger(c.done[model_idx])
+        for turn in range(turns):
+            session.set(c.helpfulness[model_idx], usefulness_options[idx % len(usefulness_options)])
+            session.set(c.correctness[model_idx], correctness_options[idx % len(correctness_options)])
+            if turn < turns - 1:
+                await session.trigger(c.next_turn[model_idx])
+        window_end = time.time()
+        await session.trigger(c.finish_rating[model_idx])
+        # The saved time_taken must lie between these two durations
+        record["windows"][model_idx] = (window_end - window_start, time.time() - started)
+
+    await session.trigger(c.start_comparing[0])
+    for rank in c.ranks:
+        session.set(rank, "2")
+    await session.trigger(c.finish_comparing[0])
+    await session.trigger(c.next_batch)
+    record["final_state"] = session.value(c.session_state)
+    return record
+
+
+def check(record, turns):
+    """The problems with the saves of one participant"""
+    errors = []
+    key = record["unique_key"]
+    store = experiment.result_store
+    survey = store.latest("user_survey_metadata", key)
+    if survey != record["survey"]:
+        errors.append(f"survey answers {survey} instead of {record['survey']}")
+    problem_order = store.latest("problem_ordering", key)["problem_order"]
+    topic_sets = experiment.problem_sets_per_topic[record["survey"]["selected_topic"]]
+    if sorted(problem_order) != sorted(int(x) for x in topic_sets):
+        errors.append(f"problem order {problem_order} is not a permutation of the topic's sets {topic_sets}")
+    if record["final_state"]["problem_set_index"] != 1 or \
+            record["final_state"]["block"]["problem_set_index"] != problem_order[1]:
+        errors.append(f"next batch went to {record['final_state']['block']['problem_set_index']}, "
+                      f"expected {problem_order[1]}")
+
+    for model_idx, (lower, upper) in record["windows"].items():
+        rating = store.latest("conversation_rating", key, record["block"]["problem_set_index"],
+                              record["block"]["model_order"][model_idx])
+        if not lower <= rating["time_taken"] <= upper:
+            errors.append(f"model {model_idx}: time_taken {rating['time_taken']:.3f}s outside [{lower:.3f}, {upper:.3f}]")
+        if len(rating["turns"]) != turns or any(
+            f"Participant {record['idx']} asks" not in turn["user"] for turn in rating["turns"]
+        ):
+            errors.append(f"model {model_idx}: conversation of another participant saved")
+        elif any(not isinstance(turn["prompt_tokens"], int) for turn in rating["turns"]):
+            errors.append(f"model {model_idx}: prompt tokens of the turns not saved")
+    if store.latest("model_ranks", key, record["block"]["problem_set_index"]) is None:
+        errors.append("model ranks not saved")
+    return errors
+
+
+async def run(sessions, turns, think_time):
+    components = Components(experiment.demo)
+    start = time.perf_counter()
+    records = await asyncio.gather(*[participant(i, components, turns, think_time) for i in range(sessions)])
+    wall_time = time.perf_counter() - start
+
+    errors = {record["idx"]: check(record, turns) for record in records}
+    n_keys = len({record["unique_key"] for record in records})
+    if n_keys != sessions:
+        errors["all"] = [f"{n_keys} distinct participant ids for {sessions} sessions"]
+    return records, {idx: e for idx, e in errors.items() if e}, wall_time
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds spent on a model besides chatting")
+    parser.add_argument("--first-token-latency", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=100.)
+    args = parser.parse_args()
+
+    server = start_mock_server(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second,
+                               reply_tokens=16)
+    shared_backend.api_base = server.url + "/v1"
+    model_generate.response_cache.enabled = False
+    experiment.unique_saving_path = tempfile.mkdtemp(prefix="checkmate_sessions_")
+    experiment.result_store = ResultStore(os.path.join(experiment.unique_saving_path, RESULT_STORE_FILENAME))
+
+    try:
+        records, errors, wall_time = asyncio.run(run(args.sessions, args.turns, args.think_time))
+        print(f"{args.sessions} concurrent sessions in {wall_time:.2f}s, saved under {experiment.unique_saving_path}")
+        for record in records[:5]:
+            times = [rating["data"]["time_taken"] for rating in
+                     experiment.result_store.records("conversation_rating", record["unique_key"])]
+            print(f"  session {record['idx']}: {record['unique_key']}  time_taken "
+                  + ", ".join(f"{t:.2f}s" for t in times))
+        if errors:
+            for idx, session_errors in errors.items():
+                print(f"session {idx}:", *session_errors, sep="\n  ")
+            raise SystemExit(1)
+        print(f"OK: {args.sessions} separate participants, every time_taken within its own session's timings")
+    finally:
+        experiment.result_store.close()
+        shutil.rmtree(experiment.unique_saving_path, ignore_errors=True)
+        server.shutdown()
@@ -0,0 +1,59 @@
+"""
+Import of minimal_neurology_study.py for the benchmarks. The study loads its cases (data/Cases_Easy, data/Cases_Hard)
+when it is imported, and they are not part of the repository: when they are missing, the study is imported from a
+temporary directory holding synthetic cases of a similar length, where its results are saved too.
+"""
+import importlib
+import os
+import sys
+import tempfile
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+case_template = """<html><body>
+<h2>Case {number}</h2>
+<p><strong>Presentation:</strong> A {age}-year-old {sex} presents with {complaint} that began {onset}.<br/>{history}</p>
+<p><strong>Examination:</strong> {examination}</p>
+<p>Investigations: {investigations}</p>
+<p>a) Where is the <strong>lesion</strong>?<br/>b) What is the <strong>diagnosis</strong>?<br>c) What next?</p>
+</body></html>
+"""
+complaints = [
+    ("sudden weakness of the right arm and face", "two hours ago"),
+    ("double vision and unsteadiness", "three days ago"),
+    ("progressive numbness of both feet", "over six months"),
+    ("episodes of speech arrest", "a few weeks ago"),
+]
+history = ("The symptoms have not resolved. Past medical history includes hypertension and type 2 diabetes. "
+           "There is no history of head injury. Medications are metformin and ramipril. ") * 4
+examination = ("Cranial nerves are assessed in turn; tone, power, reflexes, coordination and sensation are "
+               "examined in all four limbs, and the gait is observed. ") * 4
+investigations = "Full blood count, renal function and glucose are normal. Imaging is pending. " * 2
+
+
+def write_cases(directory, count=2):
+    for difficulty in ["Easy", "Hard"]:
+        cases = os.path.join(directory, "data", f"Cases_{difficulty}")
+        os.makedirs(cases, exist_ok=True)
+        for i in range(count):
+            complaint, onset = complaints[(i + 2 * (difficulty == "Hard")) % len(complaints)]
+            with open(os.path.join(cases, f"case_{i + 1}.html"), "w", encoding="utf-8") as f:
+                f.write(case_template.format(number=i + 1, age=40 + 7 * i, sex="woman" if i % 2 else "man",
+                                             complaint=complaint, onset=onset, history=history,
+                                             examination=examination, investigations=investigations))
+
+
+def import_neurology_study():
+    """minimal_neurology_study, with the cases of the repository if it has them, else synthetic ones"""
+    if "minimal_neurology_study" in sys.modules or os.path.isdir(os.path.join(repository, "data", "Cases_Easy")):
+        return importlib.import_module("minimal_neurology_study")
+    directory = tempfile.mkdtemp(prefix="neurology_cases_")
+    write_cases(directory)
+    if repository not in sys.path:
+        sys.path.insert(0, repository)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return importlib.import_module("minimal_neurology_study")
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,62 @@
+"""
+Reporting shared by the load benchmarks (simulate_participants.py, bench_neurology_study.py): latency percentiles and
+histograms of each kind of event, and the comparison of a run with the saved JSON results of a previous one.
+"""
+import collections
+import os
+import subprocess
+
+import numpy as np
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+histogram_bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+class Recorder:
+    """Latencies and errors of the events of every participant of a run"""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def summary(self):
+        summary = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            latencies = np.array(self.latencies[name]) * 1000
+            counts = np.histogram(latencies, bins=[0] + histogram_bounds + [np.inf])[0] if len(latencies) else []
+            summary[name] = {
+                "count": len(latencies),
+                "errors": self.errors[name],
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p90_ms": float(np.percentile(latencies, 90)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "max_ms": float(latencies.max()) if len(latencies) else None,
+                "histogram_ms": {f"<={bound}" if bound != np.inf else f">{histogram_bounds[-1]}": int(count)
+                                 for bound, count in zip(histogram_bounds + [np.inf], counts) if count},
+            }
+        return summary
+
+
+def compare(previous, results):
+    """Throughput and p90 latencies of each level, against those of a previous run"""
+    levels = {level["concurrency"]: level for level in previous["levels"]}
+    print(f"compared with {previous.get('version') or 'the previous run'}:")
+    for level in results["levels"]:
+        old = levels.get(level["concurrency"])
+        if old is None:
+            continue
+        print(f"{level['concurrency']:4d} participants: {old['participants_per_s']:.2f} -> "
+              f"{level['participants_per_s']:.2f} participants/s")
+        for name, event in level["events"].items():
+            old_event = old["events"].get(name)
+            if event["count"] and old_event and old_event["count"]:
+                print(f"     {name:18s} p90 {old_event['p90_ms']:8.1f} -> {event['p90_ms']:8.1f} ms "
+                      f"({event['p90_ms'] / old_event['p90_ms'] - 1:+.0%})")
+
+
+def version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
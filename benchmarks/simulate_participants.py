@@ -0,0 +1,209 @@
+"""
+Load benchmark of experiment.py: simulated participants go through the study headless, through the real event graph
+of the app (benchmarks/headless.py): instructions, survey, solo solve, a few chat turns and their ratings with each
+model of the first problem set, model ranks, next batch. For each level of concurrency (participants going through
+the study at the same time), reports
+- throughput: participants and events per second
+- latency of each kind of event: percentiles and a histogram (and the time to the first update of the chat turns)
+- memory per session: size of the gradio state of a session, and growth of the process memory per session
+- error rates: of the participants who could not finish, and of the events that failed
+and saves them as JSON, to compare them between versions (--compare).
+
+The models are simulated in process (local_backend.py) unless $MODEL_BACKEND says otherwise, e.g. MODEL_BACKEND=mock
+to go through the HTTP backend and the mock server.
+
+    python -m benchmarks.simulate_participants --concurrency 1,10,50,100 --turns 2 --output results.json
+    python -m benchmarks.simulate_participants --concurrency 1,10,50,100 --compare results.json
+"""
+import os
+
+# The shared backend is created when model_backend is first imported
+os.environ.setdefault("MODEL_BACKEND", "local")
+
+import asyncio
+import collections
+import gc
+import json
+import pickle
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import experiment
+import model_generate
+from benchmarks.headless import HeadlessSession
+from benchmarks.multi_session import Components
+from benchmarks.report import Recorder, compare, version
+from constants import instruction_pages, experience_options, ai_experience_options, solo_solve_options, \
+    usefulness_options, correctness_options, RESULT_STORE_FILENAME
+from mock_openai_server import Distribution
+from model_backend import shared_backend
+from result_store import ResultStore
+
+
+class EventFailed(Exception):
+    pass
+
+
+async def participant(idx, c, turns, think_time, recorder):
+    """
+    One participant's way through the first problem set and on to the next batch
+    :return: their headless session (kept alive until every participant of the run is done), and whether they finished
+    """
+    session = HeadlessSession(experiment.demo)
+
+    async def event(name, component, on_update=None):
+        start = time.perf_counter()
+        try:
+            await session.trigger(component, on_update=on_update)
+        except Exception as e:
+            recorder.errors[name] += 1
+            raise EventFailed(f"{name}: {type(e).__name__}: {e}") from e
+        recorder.latencies[name].append(time.perf_counter() - start)
+        if think_time:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+
+    try:
+        for _ in instruction_pages:
+            await event("instructions", c.instruction_continue)
+        session.set(c.maths_experience, experience_options[idx % len(experience_options)])
+        session.set(c.ai_experience, ai_experience_options[idx % len(ai_experience_options)])
+        session.set(c.topic, experiment.problem_topics[idx % len(experiment.problem_topics)])
+        await event("survey", c.survey_continue)
+
+        for model_idx in range(len(c.model_continue)):
+            await event("open_model", c.model_continue[model_idx])
+            session.set(c.solo_solve[model_idx], solo_solve_options[idx % len(solo_solve_options)])
+            await event("solo_solve", c.interact_with_ai[model_idx])
+            for turn in range(turns):
+                session.set(c.txt[model_idx], f"Participant {idx} asks question {turn} to model {model_idx}")
+                first_update = []
+                await event("chat_turn", c.interact[model_idx],
+                            on_update=lambda elapsed: first_update or first_update.append(elapsed))
+                if first_update:
+                    recorder.latencies["chat_first_update"].append(first_update[0])
+            await event("done_chatting", c.done[model_idx])
+            for turn in range(turns):
+                session.set(c.helpfulness[model_idx], usefulness_options[(idx + turn) % len(usefulness_options)])
+                session.set(c.correctness[model_idx], correctness_options[(idx + turn) % len(correctness_options)])
+                if turn < turns - 1:
+                    await event("next_turn", c.next_turn[model_idx])
+            await event("finish_rating", c.finish_rating[model_idx])
+
+        await event("start_comparing", c.start_comparing[0])
+        for rank, value in zip(c.ranks, ["1", "2", "3"]):
+            session.set(rank, value)
+        await event("finish_comparing", c.finish_comparing[0])
+        await event("next_batch", c.next_batch)
+    except EventFailed as e:
+        return session, str(e)
+    return session, None
+
+
+def resident_memory():
+    """Bytes of memory the process uses now, or None where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+async def run_level(concurrency, turns, think_time):
+    c = Components(experiment.demo)
+    recorder = Recorder()
+    gc.collect()
+    memory_before = resident_memory()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[participant(i, c, turns, think_time, recorder) for i in range(concurrency)])
+    wall_time = time.perf_counter() - start
+    memory_after = resident_memory()
+
+    sessions = [session for session, _ in results]
+    failures = [failure for _, failure in results if failure is not None]
+    state_bytes = [len(pickle.dumps(session.state)) for session in sessions]
+    events = sum(len(latencies) for name, latencies in recorder.latencies.items() if name != "chat_first_update")
+    failed_events = sum(recorder.errors.values())
+    return {
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "participants_per_s": (concurrency - len(failures)) / wall_time,
+        "events_per_s": events / wall_time,
+        "completed": concurrency - len(failures),
+        "failed": len(failures),
+        "participant_error_rate": len(failures) / concurrency,
+        "event_error_rate": failed_events / (events + failed_events) if events + failed_events else 0.,
+        "failures": sorted(collections.Counter(failures).items(), key=lambda item: -item[1])[:5],
+        "events": recorder.summary(),
+        "memory": {
+            "state_bytes_per_session": float(np.mean(state_bytes)),
+            "state_bytes_max": max(state_bytes),
+            "rss_growth_per_session": (memory_after - memory_before) / concurrency if memory_before else None,
+            "rss_bytes": memory_after,
+        },
+    }
+
+
+def print_level(level):
+    print(f"{level['concurrency']:4d} participants: {level['wall_time_s']:7.2f}s, "
+          f"{level['participants_per_s']:6.2f} participants/s, {level['events_per_s']:7.1f} events/s, "
+          f"{level['failed']} failed ({level['event_error_rate']:.2%} of the events), "
+          f"state {level['memory']['state_bytes_per_session'] / 1e3:.1f} kB/session"
+          + (f", process +{level['memory']['rss_growth_per_session'] / 1e3:.0f} kB/session"
+             if level["memory"]["rss_growth_per_session"] is not None else ""))
+    for name, event in level["events"].items():
+        if event["count"]:
+            print(f"     {name:18s} n={event['count']:5d}  p50 {event['p50_ms']:8.1f} ms  p90 {event['p90_ms']:8.1f} ms"
+                  f"  p99 {event['p99_ms']:8.1f} ms  errors {event['errors']}")
+    for failure, count in level["failures"]:
+        print(f"     {count} x {failure}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,10,50", help="comma separated numbers of simultaneous participants")
+    parser.add_argument("--turns", type=int, default=2, help="chat turns with each model")
+    parser.add_argument("--think-time", type=float, default=0.2,
+                        help="mean seconds between two events of a participant")
+    parser.add_argument("--first-token-latency", type=Distribution.parse, default="0.3",
+                        help="of the local backend, seconds, a number or a distribution e.g. lognormal:0.3:0.3")
+    parser.add_argument("--tokens-per-second", type=Distribution.parse, default="50",
+                        help="of the local backend, a number or a distribution e.g. normal:50:10")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="of the local backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file for the results")
+    parser.add_argument("--compare", default=None, help="json results of a previous run, to compare with")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if hasattr(shared_backend, "config"):
+        shared_backend.config.update(first_token_latency=args.first_token_latency,
+                                     tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens)
+    # Measure the app with every participant asking their own questions, not the response cache
+    model_generate.response_cache.enabled = False
+    experiment.unique_saving_path = tempfile.mkdtemp(prefix="checkmate_simulation_")
+    experiment.result_store = ResultStore(os.path.join(experiment.unique_saving_path, RESULT_STORE_FILENAME))
+
+    results = {"version": version(), "backend": type(shared_backend).__name__, "config": vars(args), "levels": []}
+    results["config"].update(first_token_latency=repr(args.first_token_latency),
+                             tokens_per_second=repr(args.tokens_per_second))
+    try:
+        for concurrency in [int(n) for n in args.concurrency.split(",")]:
+            level = asyncio.run(run_level(concurrency, args.turns, args.think_time))
+            results["levels"].append(level)
+            print_level(level)
+    finally:
+        experiment.result_store.close()
+        shutil.rmtree(experiment.unique_saving_path, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -1,6 +1,123 @@
 MAX_CONVERSATION_LENGTH = 20
 MAX_TOKENS_PER_GENERATION = 512
 SAMPLING_TEMPERATURE = 0.
+# Stream the model responses into the chatbot token by token, instead of waiting for the full completion
+STREAM_GENERATIONS = True
+
+# Number of events the gradio queue processes at once, across all participants
+# (every participant has their own session state, so their events can run concurrently)
+QUEUE_CONCURRENCY_COUNT = 64
+
+# Where the models are served from (model_backend.py, overridden by $MODEL_BACKEND): "openai" (the OpenAI API, or the
+# server at $OPENAI_API_BASE), "mock" (mock_openai_server.py, started in process) or "local" (the replies of the mock
+# generated in process, without HTTP, local_backend.py). The mock and local backends answer after
+# LOCAL_FIRST_TOKEN_LATENCY seconds at LOCAL_TOKENS_PER_SECOND, each a number or drawn for each request (e.g.
+# "lognormal:0.5:0.4", see mock_openai_server.Distribution), with replies of up to LOCAL_REPLY_TOKENS tokens
+MODEL_BACKEND = "openai"
+LOCAL_FIRST_TOKEN_LATENCY = "lognormal:0.5:0.3"
+LOCAL_TOKENS_PER_SECOND = "normal:40:5"
+LOCAL_REPLY_TOKENS = 256
+LOCAL_BACKEND_SEED = 0
+
+# The model behind each option of the study; models in COMPLETION_MODELS are prompted with the conversation as text
+# (completions endpoint), the others get chat messages
+MODEL_NAMES = {
+    "chatgpt": "gpt-3.5-turbo",
+    "chatgpt4": "gpt-4",
+    "instructgpt": "text-davinci-003",
+}
+COMPLETION_MODELS = ["text-davinci-003"]
+
+# Shared async model backend (model_backend.py): size of the keep-alive connection pool,
+# the maximum number of requests in flight per upstream model, and the request timeout in seconds
+MAX_UPSTREAM_CONNECTIONS = 100
+MODEL_CONCURRENCY_LIMITS = {
+    "gpt-4": 32,
+    "gpt-3.5-turbo": 64,
+    "text-davinci-003": 64,
+}
+DEFAULT_MODEL_CONCURRENCY_LIMIT = 32
+REQUEST_TIMEOUT = 120
+
+# Resilience of the model calls (resilience.py): each call, retries included, must finish within the deadline of its
+# model (in seconds); rate limits, server errors and timeouts are retried up to MAX_RETRIES times with exponential
+# backoff and jitter; CIRCUIT_BREAKER_FAILURES consecutive failures stop the calls to a model for CIRCUIT_BREAKER_RESET
+# seconds; with HEDGE_REQUESTS, a request slower than the HEDGE_PERCENTILE latency of its model is sent a second time
+# (at most HEDGE_MAX_RATE of the requests), and the first answer is used
+MODEL_DEADLINES = {
+    "gpt-4": 150,
+    "gpt-3.5-turbo": 90,
+    "text-davinci-003": 90,
+}
+DEFAULT_MODEL_DEADLINE = 120
+MAX_RETRIES = 4
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8.
+CIRCUIT_BREAKER_FAILURES = 5
+CIRCUIT_BREAKER_RESET = 30.
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_RATE = 0.1
+
+# Client-side rate limits (rate_limiter.py): requests and tokens (prompt and max_tokens of the reply) per minute the
+# process sends to each model, to stay under the limits of the OpenAI account instead of being answered 429. Requests
+# over the limits wait in a queue, served in turn across participants, for at most RATE_LIMIT_MAX_WAIT seconds.
+# Only RATE_LIMIT_HEADROOM of each limit is used, as a margin for other clients of the account and for the token
+# estimates. Models not listed are not limited
+RATE_LIMITS = {
+    "gpt-4": {"requests": 200, "tokens": 40000},
+    "gpt-3.5-turbo": {"requests": 3500, "tokens": 90000},
+    "text-davinci-003": {"requests": 3000, "tokens": 250000},
+}
+RATE_LIMIT_HEADROOM = 0.9
+RATE_LIMIT_MAX_WAIT = 60.
+
+# On-disk cache of deterministic (temperature 0) generations, see response_cache.py
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_PATH = "./saved_data/response_cache.sqlite"
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # seconds
+# Identical deterministic generations requested at the same time share one upstream call (single_flight.py)
+COALESCE_IDENTICAL_REQUESTS = True
+
+# Study results are appended to a SQLite store (result_store.py) by a background writer,
+# which commits up to RESULT_STORE_BATCH_SIZE records per fsync, waiting at most RESULT_STORE_FLUSH_INTERVAL seconds
+RESULT_STORE_FILENAME = "results.sqlite"
+RESULT_STORE_BATCH_SIZE = 256
+RESULT_STORE_FLUSH_INTERVAL = 0.05
+# A batch that fails to commit is retried RESULT_STORE_COMMIT_RETRIES times, then with the next batch; reads wait at
+# most RESULT_STORE_READ_TIMEOUT seconds for the queued records, then warn and read what was committed
+RESULT_STORE_COMMIT_RETRIES = 5
+RESULT_STORE_READ_TIMEOUT = 10.
+
+# In-process metrics of the hot paths (metrics.py): latency histograms and counters of requests, tokens, cache hits and
+# errors, served in the Prometheus text format at http://127.0.0.1:METRICS_PORT/metrics and appended as JSON lines to
+# METRICS_DUMP_PATH every METRICS_DUMP_INTERVAL seconds, while a study runs (None for neither)
+METRICS_ENABLED = True
+METRICS_PORT = 9464
+METRICS_DUMP_PATH = "./saved_data/metrics.jsonl"
+METRICS_DUMP_INTERVAL = 60.
+
+# Markdown and LaTeX preview of the messages typed to the models (markdown_preview.py): the rendered previews and drawn
+# formulas kept in memory; with MARKDOWN_LIVE_PREVIEW the preview follows the typing, rendered once the participant
+# paused for MARKDOWN_PREVIEW_DEBOUNCE seconds (the --> button renders it at once)
+MARKDOWN_PREVIEW_CACHE_SIZE = 1000
+MARKDOWN_PREVIEW_FORMULA_CACHE_SIZE = 5000
+MARKDOWN_LIVE_PREVIEW = True
+MARKDOWN_PREVIEW_DEBOUNCE = 0.4
+
+# Conversations longer than the context window of a model (minus MAX_TOKENS_PER_GENERATION for the reply) keep the
+# system prompt, the first exchange and the most recent turns (context_window.py); the turns in between are left out
+# ("truncate"), or listed in a short system note ("summarize"); "none" always sends the whole history
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 4096,
+    "text-davinci-003": 4097,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+CONTEXT_POLICY = "truncate"
+CONTEXT_SUMMARY_CHARS = 160  # of each left out question in the "summarize" note
 
 
 plaintxt_instructions = [
@@ -0,0 +1,79 @@
+"""
+Keeps the chat messages sent to the models within their context window as conversations grow.
+
+The tokens of each message are counted once, on its Turn record (conversation.py), and each reply of the model
+records the context of its request (prompt tokens sent, tokens of the whole conversation, messages left out).
+A ContextPolicy picks the messages to send when the whole conversation does not fit in the token budget of the model:
+the system prompt, the first exchange (where participants give the problem) and the most recent turns are kept;
+"truncate" leaves out the turns in between, "summarize" replaces them by a short system note listing the left out
+questions, and "none" sends everything. (The prompts of the completion model leave system messages out, so that
+it sees a summarized conversation as truncated.)
+"""
+from token_counter import count_tokens, tokens_per_message, tokens_per_reply
+
+context_policies = ["none", "truncate", "summarize"]
+
+
+class ContextPolicy:
+    def __init__(self, policy="truncate", summary_chars=160):
+        assert policy in context_policies
+        self.policy = policy
+        self.summary_chars = summary_chars
+
+    def select(self, messages, counts, budget, model=None):
+        """
+        The messages to send, and what was left out
+        :param messages: system prompt, then alternating user and assistant messages, ending with the newest user one
+        :param counts: tokens of each message
+        :param budget: prompt tokens available (context window minus the tokens reserved for the reply)
+        :return: messages, {"prompt_tokens", "history_tokens", "dropped_messages"}
+        """
+        history_tokens = sum(counts) + tokens_per_reply
+        if self.policy == "none" or history_tokens <= budget:
+            return list(messages), {"prompt_tokens": history_tokens, "history_tokens": history_tokens,
+                                    "dropped_messages": 0}
+
+        # Pinned: system prompt, first exchange; then the newest message and as many recent exchanges as fit
+        pinned = [0, 1, 2] if len(messages) > 4 else [0]
+        used = sum(counts[i] for i in pinned) + counts[-1] + tokens_per_reply
+        if used > budget:
+            pinned = [0]
+            used = counts[0] + counts[-1] + tokens_per_reply
+        recent = [len(messages) - 1]
+        start = len(messages) - 1
+        # Exchanges (user, assistant) before the newest message, from the most recent
+        while start - 2 > pinned[-1] and used + counts[start - 2] + counts[start - 1] <= budget:
+            start -= 2
+            used += counts[start] + counts[start + 1]
+            recent[:0] = [start, start + 1]
+        dropped = list(range(pinned[-1] + 1, recent[0]))
+
+        selected = [messages[i] for i in pinned]
+        if self.policy == "summarize" and dropped:
+            note = self.summary_note([messages[i] for i in dropped], budget - used, model)
+            if note is not None:
+                selected.append(note)
+                used += tokens_per_message + count_tokens(note["content"], model)
+        selected += [messages[i] for i in recent]
+        return selected, {"prompt_tokens": used, "history_tokens": history_tokens, "dropped_messages": len(dropped)}
+
+    def summary_note(self, dropped, available, model=None):
+        """A system message listing the questions of the left out turns, the oldest ones first to go if it is long"""
+        header = "Earlier turns of the conversation were left out. In them, the user asked:"
+        lines = []
+        for message in dropped:
+            if message["role"] == "user":
+                question = " ".join(message["content"].split())
+                if len(question) > self.summary_chars:
+                    question = question[:self.summary_chars].rstrip() + "..."
+                lines.append(f"\n- {question}")
+        # Each line counted once (the token count of the note is about the sum of those of its lines)
+        line_tokens = [count_tokens(line, model) for line in lines]
+        used = tokens_per_message + count_tokens(header, model) + sum(line_tokens)
+        first = 0
+        while first < len(lines) and used > available:
+            used -= line_tokens[first]
+            first += 1
+        if first == len(lines):
+            return None
+        return {"role": "system", "content": header + "".join(lines[first:])}
@@ -0,0 +1,154 @@
+"""
+The conversation of a participant with a model: a list of Turn records (one per message) in the session state,
+instead of "User: ..."/"AI: ..." strings that had to be parsed again on every turn.
+Each record keeps its content without the prefix, when it was written, its tokens (counted once), and for the
+replies of the model, the latency and the context of the request (prompt tokens sent, tokens of the whole
+conversation, messages left out, see context_window.py), and how it was served: when it was asked for, the time to
+its first token, the latency and token usage of the API call, and whether it came from the response cache.
+"""
+import time
+
+from token_counter import count_tokens, tokens_per_message
+
+
+class Turn:
+    """One message of a conversation"""
+    __slots__ = ("role", "content", "timestamp", "tokens", "latency", "prompt_tokens", "history_tokens",
+                 "dropped_messages", "requested_at", "first_token_latency", "upstream_latency", "usage_prompt_tokens",
+                 "usage_completion_tokens", "cache")
+    prefixes = {"user": "User: ", "assistant": "AI: "}
+
+    def __init__(self, role, content, timestamp=None, tokens=None, latency=None, prompt_tokens=None,
+                 history_tokens=None, dropped_messages=None, requested_at=None, first_token_latency=None,
+                 upstream_latency=None, usage_prompt_tokens=None, usage_completion_tokens=None, cache=None):
+        assert role in self.prefixes
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.tokens = tokens
+        self.latency = latency
+        self.prompt_tokens = prompt_tokens
+        self.history_tokens = history_tokens
+        self.dropped_messages = dropped_messages
+        self.requested_at = requested_at
+        self.first_token_latency = first_token_latency
+        self.upstream_latency = upstream_latency
+        self.usage_prompt_tokens = usage_prompt_tokens
+        self.usage_completion_tokens = usage_completion_tokens
+        self.cache = cache
+
+    def display(self):
+        """The message as shown to participants and saved in the results, e.g. "User: ..." """
+        return self.prefixes[self.role] + self.content
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(**record)
+
+    def __repr__(self):
+        return f"Turn({self.role!r}, {self.content[:40]!r})"
+
+
+class Conversation:
+    """User and assistant turns, alternating, starting with the user"""
+    __slots__ = ("turns",)
+
+    def __init__(self, turns=()):
+        self.turns = list(turns)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def ask(self, content):
+        turn = Turn("user", content.strip(), timestamp=time.time())
+        self.turns.append(turn)
+        return turn
+
+    def retract(self):
+        """Take back the newest question, which the model did not answer"""
+        assert self.turns and self.turns[-1].role == "user"
+        return self.turns.pop()
+
+    def answer(self, content, **context):
+        """Add the reply of the model; context: latency, the prompt_tokens, ... of the request and how it was served"""
+        assert self.turns and self.turns[-1].role == "user"
+        turn = Turn("assistant", content.strip(), timestamp=time.time(), **context)
+        self.turns.append(turn)
+        return turn
+
+    @property
+    def n_exchanges(self):
+        """Number of (user, assistant) exchanges, i.e. of turns to rate"""
+        return len(self.turns) // 2
+
+    def exchange(self, index):
+        return self.turns[2 * index], self.turns[2 * index + 1]
+
+    def pairs(self):
+        """The value of the gradio chatbot: (user, assistant) display strings of each exchange"""
+        return [(self.turns[i].display(), self.turns[i + 1].display()) for i in range(0, len(self.turns) - 1, 2)]
+
+    def chat_messages(self, system_prompt=None):
+        messages = [] if system_prompt is None else [{"role": "system", "content": system_prompt}]
+        messages.extend({"role": turn.role, "content": turn.content} for turn in self.turns)
+        return messages
+
+    def token_counts(self, model=None):
+        """Tokens of each message with the chat format overhead, counting only the turns not counted before"""
+        for turn in self.turns:
+            if turn.tokens is None:
+                turn.tokens = count_tokens(turn.content, model)
+        return [tokens_per_message + turn.tokens for turn in self.turns]
+
+    def rated_turns(self, helpfulness, correctness):
+        """The exchanges with their ratings, as saved in the conversation_rating results"""
+        rated = []
+        for index in range(self.n_exchanges):
+            user, ai = self.exchange(index)
+            rated.append({
+                "user": user.display(),
+                "ai": ai.display(),
+                "helpfulness": helpfulness[index],
+                "correctness": correctness[index],
+                "prompt_tokens": ai.prompt_tokens,
+                "history_tokens": ai.history_tokens,
+                "dropped_messages": ai.dropped_messages,
+                "latency": ai.latency,
+                "asked_at": user.timestamp,
+                "answered_at": ai.timestamp,
+                "requested_at": ai.requested_at,
+                "first_token_latency": ai.first_token_latency,
+                "upstream_latency": ai.upstream_latency,
+                "usage_prompt_tokens": ai.usage_prompt_tokens,
+                "usage_completion_tokens": ai.usage_completion_tokens,
+                "cache": ai.cache,
+            })
+        return rated
+
+    @classmethod
+    def from_rated_turns(cls, rated):
+        """The conversation of saved conversation_rating turns"""
+        conversation = cls()
+        for record in rated:
+            for role, key in [("user", "user"), ("assistant", "ai")]:
+                text = record[key]
+                prefix = Turn.prefixes[role]
+                content = text[len(prefix):] if text.startswith(prefix) else text
+                timestamp = record.get("asked_at" if role == "user" else "answered_at")
+                conversation.turns.append(Turn(role, content, timestamp=timestamp))
+            reply = conversation.turns[-1]
+            for name in ["latency", "prompt_tokens", "history_tokens", "dropped_messages", "requested_at",
+                         "first_token_latency", "upstream_latency", "usage_prompt_tokens", "usage_completion_tokens",
+                         "cache"]:
+                setattr(reply, name, record.get(name))
+        return conversation
+
+    def to_list(self):
+        return [turn.to_dict() for turn in self.turns]
+
+    @classmethod
+    def from_list(cls, records):
+        return cls(Turn.from_dict(record) for record in records)
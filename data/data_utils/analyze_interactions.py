@@ -0,0 +1,315 @@
+"""
+Answers to the pre-registered questions of questions_to_ask.txt, over an interactions csv
+(data/mathconverse_parsed_interactions.csv, or the output of export_interactions.py).
+
+The csv is loaded once into NumPy columns: one entry per conversation (model, participant, expertise,
+solo_solve, final rank of the model...) and one entry per turn (conversation, position in the conversation,
+helpfulness, correctness), the stringified rating lists being parsed in bulk rather than row by row.
+Each question is then a group-by over these columns (np.bincount), and its confidence intervals come from
+a cluster bootstrap (resampling whole conversations or participants) computed for every group and a batch
+of replicates at once, as one matrix product.
+
+Run it from the root of the repository:
+    python -m data.data_utils.analyze_interactions --interactions data/mathconverse_parsed_interactions.csv
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from constants import experience_options, model_options
+
+rating_levels = 7  # ratings go from 0 to 6
+text_columns = ["human_interactions", "model_responses"]
+
+
+def parse_number_lists(strings):
+    """(lengths, concatenated values) of stringified lists of numbers such as "[6, 4, None]", None being nan"""
+    inner = strings.str.slice(1, -1).str.strip()
+    non_empty = (inner.str.len() > 0).to_numpy()
+    lengths = np.where(non_empty, inner.str.count(",").to_numpy() + 1, 0)
+    joined = ",".join(inner[non_empty]).replace("None", "nan")
+    values = np.fromstring(joined, dtype=float, sep=",") if joined else np.zeros(0)
+    assert len(values) == lengths.sum(), "malformed rating list"
+    return lengths, values
+
+
+def encode(values, order=()):
+    """(integer codes, labels) of a column, the labels in the given order first, then in order of appearance"""
+    values = pd.Series(values).fillna("MISSING").astype(str)
+    labels = list(order) + [v for v in pd.unique(values) if v not in set(order)]
+    codes = pd.Categorical(values, categories=labels).codes.astype(np.int64)
+    return codes, labels
+
+
+class Interactions:
+    """The columns of an interactions csv, per conversation and per turn"""
+
+    def __init__(self, frame):
+        """:param frame: the csv as a DataFrame, the text columns are not needed"""
+        n_conversations = len(frame)
+        lengths, helpfulness = parse_number_lists(frame["helpfulness_ratings"].astype(str))
+        correctness_lengths, correctness = parse_number_lists(frame["correctness_ratings"].astype(str))
+        assert (lengths == correctness_lengths).all(), "helpfulness and correctness ratings of different lengths"
+
+        self.labels = {}
+        self.model, self.labels["model"] = encode(frame["model"], model_options)
+        self.participant, self.labels["participant"] = encode(frame["uid"])
+        self.expertise, self.labels["expertise"] = encode(frame["mth_bkgrd"], experience_options)
+        self.topic, self.labels["topic"] = encode(frame["selected_topic"])
+        self.solo_solve = pd.to_numeric(frame["solo_solve"], errors="coerce").to_numpy(dtype=float)
+        self.time_taken = frame["time_taken"].to_numpy(dtype=float)
+        self.n_turns = lengths
+        # Rank given to the conversation's model in the final preferences (nan when MISSING)
+        self.final_rank = np.full(n_conversations, np.nan)
+        prefs = frame["final_prefs"].astype(str)
+        for code, model in enumerate(self.labels["model"]):
+            rows = self.model == code
+            if rows.any():
+                ranks = prefs[rows].str.extract(rf"'{model}':\s*(\d+)", expand=False)
+                self.final_rank[rows] = pd.to_numeric(ranks, errors="coerce").to_numpy(dtype=float)
+
+        # Turns: conversation index and position within the conversation
+        self.conversation = np.repeat(np.arange(n_conversations), lengths)
+        starts = np.cumsum(lengths) - lengths
+        self.turn = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        self.is_last = self.turn == np.repeat(lengths - 1, lengths)
+        self.helpfulness = helpfulness
+        self.correctness = correctness
+
+    @classmethod
+    def from_csv(cls, path):
+        header = pd.read_csv(path, nrows=0).columns
+        return cls(pd.read_csv(path, usecols=[c for c in header if c not in text_columns]))
+
+    @property
+    def n_conversations(self):
+        return len(self.n_turns)
+
+    def per_turn(self, conversation_values):
+        return conversation_values[self.conversation]
+
+    def conversation_means(self, turn_values):
+        """Mean over the turns of each conversation (nan for conversations without a rated turn)"""
+        rated = ~np.isnan(turn_values)
+        sums = np.bincount(self.conversation[rated], weights=turn_values[rated], minlength=self.n_conversations)
+        counts = np.bincount(self.conversation[rated], minlength=self.n_conversations)
+        with np.errstate(invalid="ignore"):
+            return sums / counts
+
+
+def poisson_table(bits=16):
+    """Poisson(1) quantiles of 2**bits evenly spaced probabilities, to draw bootstrap weights from random integers"""
+    k = np.arange(20)
+    cdf = np.cumsum(np.exp(-1) / np.cumprod(np.maximum(k, 1)))
+    return np.searchsorted(cdf, (np.arange(2 ** bits) + 0.5) / 2 ** bits).astype(np.uint8)
+
+
+_poisson_weights = poisson_table()
+
+
+def grouped_means(series, n_clusters, n_boot=1000, alpha=0.05, seed=0, batch_size=64):
+    """
+    Means of values by group, with percentile bootstrap confidence intervals over resampled clusters (conversations or
+    participants, so that the turns of one conversation are not taken as independent).
+    This is the Poisson bootstrap: each replicate weights every cluster by a Poisson(1) draw. All the series share the
+    weights, and a batch of replicates is evaluated for every group of every series as one matrix product.
+    :param series: [(values, groups, n_groups, clusters)], the arrays having one entry per value, groups and clusters
+    being integer codes; nan values and negative groups are left out
+    :return: [(means, lower bounds, upper bounds, counts)], one per series, each of length n_groups
+    """
+    sums, counts, widths = [], [], []
+    for values, groups, n_groups, clusters in series:
+        keep = ~np.isnan(values) & (groups >= 0)
+        cells = clusters[keep] * n_groups + groups[keep]
+        sums.append(np.bincount(cells, weights=values[keep], minlength=n_clusters * n_groups)
+                    .reshape(n_clusters, n_groups))
+        counts.append(np.bincount(cells, minlength=n_clusters * n_groups).reshape(n_clusters, n_groups))
+        widths.append(n_groups)
+    sums, counts = np.hstack(sums), np.hstack(counts).astype(float)
+    n = counts.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums.sum(axis=0) / n
+
+    rng = np.random.default_rng(seed)
+    totals = np.hstack([sums, counts]).astype(np.float32)
+    replicates = np.empty((n_boot, len(n)))
+    for start in range(0, n_boot, batch_size):
+        size = min(batch_size, n_boot - start)
+        weights = _poisson_weights[rng.integers(0, len(_poisson_weights), size=(size, n_clusters), dtype=np.uint16)]
+        weighted = weights.astype(np.float32) @ totals
+        with np.errstate(invalid="ignore", divide="ignore"):
+            replicates[start:start + size] = weighted[:, :len(n)] / weighted[:, len(n):]
+    with warnings.catch_warnings():
+        # All-nan slices for groups that are empty in every replicate
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low, high = np.nanpercentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    bounds = np.cumsum([0] + widths)
+    return [(means[a:b], low[a:b], high[a:b], n[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def summary(index, means, low, high, n, name):
+    return pd.DataFrame({name: means, f"{name}_ci_low": low, f"{name}_ci_high": high, "n": n.astype(int)},
+                        index=index)
+
+
+def table(index, named_series, n_clusters, **bootstrap):
+    """
+    Summaries of several values over the same groups side by side, with the counts of the first one
+    :param named_series: [(name, values, groups, clusters)], groups indexing `index`
+    """
+    stats = grouped_means([(values, groups, len(index), clusters) for _, values, groups, clusters in named_series],
+                          n_clusters, **bootstrap)
+    frames = [summary(index, *s, name) for (name, *_), s in zip(named_series, stats)]
+    observed = np.logical_or.reduce([frame["n"].to_numpy() > 0 for frame in frames])
+    result = pd.concat([frames[0]] + [frame.drop(columns="n") for frame in frames[1:]], axis=1)
+    return result[observed]
+
+
+def with_model(data, groups, n_groups):
+    """Codes of (model, group) for turn-level groups, negative where the group is negative (left out)"""
+    return np.where(groups >= 0, data.per_turn(data.model) * n_groups + groups, -1)
+
+
+def model_index(data, levels, name):
+    return pd.MultiIndex.from_product([data.labels["model"], levels], names=["model", name])
+
+
+# The questions
+
+def rating_trajectories(data, max_turns=10, **bootstrap):
+    """How do ratings change over the course of the interaction? Mean rating at each turn, per model"""
+    groups = with_model(data, np.where(data.turn < max_turns, data.turn, -1), max_turns)
+    return table(model_index(data, range(max_turns), "turn"), [
+        ("helpfulness", data.helpfulness, groups, data.conversation),
+        ("correctness", data.correctness, groups, data.conversation),
+    ], data.n_conversations, **bootstrap)
+
+
+def stop_points(data, **bootstrap):
+    """How many steps do participants spend interacting, and when do they stop?"""
+    conversations = np.arange(data.n_conversations)
+    turns = table(pd.Index(data.labels["model"], name="model"), [
+        ("mean_turns", data.n_turns.astype(float), data.model, conversations),
+        ("share_single_turn", (data.n_turns == 1).astype(float), data.model, conversations),
+    ], data.n_conversations, **bootstrap)
+    # Are conversations stopped after a good answer, or after giving up?
+    groups = with_model(data, data.is_last.astype(np.int64), 2)
+    last = table(model_index(data, [False, True], "last_turn"), [
+        ("helpfulness", data.helpfulness, groups, data.conversation),
+        ("correctness", data.correctness, groups, data.conversation),
+    ], data.n_conversations, **bootstrap)
+    return turns, last
+
+
+def helpfulness_correctness_divergence(data, **bootstrap):
+    """Do helpfulness and correctness track together, or are some answers helpful but incorrect (and vice versa)?"""
+    rated = ~np.isnan(data.helpfulness) & ~np.isnan(data.correctness)
+    h, c = data.helpfulness[rated].astype(np.int64), data.correctness[rated].astype(np.int64)
+    crosstab = pd.DataFrame(
+        np.bincount(h * rating_levels + c, minlength=rating_levels ** 2).reshape(rating_levels, rating_levels),
+        index=pd.Index(range(rating_levels), name="helpfulness"),
+        columns=pd.Index(range(rating_levels), name="correctness"),
+    )
+    correlation = float(np.corrcoef(h, c)[0, 1]) if len(h) > 1 else np.nan
+    model = data.per_turn(data.model)
+    shares = table(pd.Index(data.labels["model"], name="model"), [
+        ("helpful_but_incorrect", np.where(rated, (data.helpfulness >= 4) & (data.correctness <= 3), np.nan),
+         model, data.conversation),
+        ("correct_but_unhelpful", np.where(rated, (data.correctness >= 5) & (data.helpfulness <= 2), np.nan),
+         model, data.conversation),
+    ], data.n_conversations, **bootstrap)
+    return correlation, crosstab, shares
+
+
+def preferences(data, **bootstrap):
+    """Is GPT-4 consistently preferred? Mean final rank of each model (1 = preferred) and share ranked first"""
+    return table(pd.Index(data.labels["model"], name="model"), [
+        ("mean_rank", data.final_rank, data.model, data.participant),
+        ("share_ranked_first", np.where(np.isnan(data.final_rank), np.nan, data.final_rank == 1), data.model,
+         data.participant),
+    ], len(data.labels["participant"]), **bootstrap)
+
+
+def spearman(x, y):
+    """Rank correlation of two arrays (average ranks for ties)"""
+    if len(x) < 2:
+        return np.nan
+    return float(np.corrcoef(pd.Series(x).rank().to_numpy(), pd.Series(y).rank().to_numpy())[0, 1])
+
+
+def ratings_vs_preference(data, **bootstrap):
+    """
+    Are helpfulness and correctness predictive of the later preferences?
+    :return: mean conversation ratings by final rank of the model, and {rating: Spearman correlation with the rank}
+    """
+    rank = np.where(np.isnan(data.final_rank), -1, data.final_rank).astype(np.int64)
+    conversations = np.arange(data.n_conversations)
+    means = {name: data.conversation_means(values)
+             for name, values in [("helpfulness", data.helpfulness), ("correctness", data.correctness)]}
+    result = table(pd.Index(range(max(int(rank.max()) + 1, 1)), name="final_rank"), [
+        (f"mean_{name}", values, rank, conversations) for name, values in means.items()
+    ], data.n_conversations, **bootstrap)
+    correlations = {}
+    for name, values in means.items():
+        rated = ~np.isnan(values) & (rank >= 0)
+        correlations[name] = spearman(values[rated], rank[rated])
+    return result[result.index >= 1], correlations
+
+
+def rating_effects(data, factor, labels, name, **bootstrap):
+    """Mean ratings and conversation length by the levels of a conversation-level factor, resampling participants"""
+    turn_factor = data.per_turn(factor)
+    turn_participant = data.per_turn(data.participant)
+    return table(pd.Index(labels, name=name), [
+        ("helpfulness", data.helpfulness, turn_factor, turn_participant),
+        ("correctness", data.correctness, turn_factor, turn_participant),
+        ("mean_turns", data.n_turns.astype(float), factor, data.participant),
+    ], len(data.labels["participant"]), **bootstrap)
+
+
+def expertise_effects(data, **bootstrap):
+    """How does the level of mathematical experience change the ratings and the length of the interactions?"""
+    return rating_effects(data, data.expertise, data.labels["expertise"], "mth_bkgrd", **bootstrap)
+
+
+def solo_solve_effects(data, **bootstrap):
+    """Does the confidence in solving the problem alone change the ratings and the interactions?"""
+    levels = np.where(np.isnan(data.solo_solve), -1, data.solo_solve).astype(np.int64)
+    return rating_effects(data, levels, list(range(rating_levels)), "solo_solve", **bootstrap)
+
+
+def answer_all(data, **bootstrap):
+    turns, last_turn = stop_points(data, **bootstrap)
+    correlation, crosstab, divergence = helpfulness_correctness_divergence(data, **bootstrap)
+    by_rank, rank_correlations = ratings_vs_preference(data, **bootstrap)
+    return {
+        "rating_trajectories": rating_trajectories(data, **bootstrap),
+        "stop_points": turns,
+        "last_turn_ratings": last_turn,
+        "helpfulness_correctness_correlation": correlation,
+        "helpfulness_correctness_crosstab": crosstab,
+        "divergence": divergence,
+        "preferences": preferences(data, **bootstrap),
+        "ratings_by_final_rank": by_rank,
+        "ratings_final_rank_spearman": rank_correlations,
+        "expertise_effects": expertise_effects(data, **bootstrap),
+        "solo_solve_effects": solo_solve_effects(data, **bootstrap),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interactions", default="data/mathconverse_parsed_interactions.csv")
+    parser.add_argument("--n-boot", type=int, default=1000)
+    args = parser.parse_args()
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.precision", 3)
+    pd.set_option("display.max_columns", None)
+    data = Interactions.from_csv(args.interactions)
+    print(f"{data.n_conversations} conversations, {len(data.turn)} turns, {len(data.labels['participant'])} participants")
+    for question, answer in answer_all(data, n_boot=args.n_boot).items():
+        print(f"\n== {question}")
+        print(answer)
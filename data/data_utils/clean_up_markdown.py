@@ -1,40 +1,91 @@
+"""
+Strips ProofWiki links from markdown files, in place: [[Definition:Group|group]] becomes "group", [[Group]]
+becomes "Group", [[Definition:Group]] becomes "Group", and unmatched [[ or ]] outside of math are dropped.
+Math is delimited as with pandoc's tex_math_dollars: $$...$$, or $...$ where the opening $ is followed by a
+non-space, and the closing $ follows a non-space and is not followed by a digit, so that prices ("costs $5 ...
+$10") are not taken for math.
+One regular expression pass over each text, linear in its length; files are cleaned in parallel, and large files
+(e.g. whole ProofWiki dumps) are split at blank lines into chunks cleaned in parallel (neither links nor math
+span blank lines).
+
+    python -m data.data_utils.clean_up_markdown data/prompts data/problems
+"""
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Math spans first, so that they are kept as they are (e.g. commutators $[a, [b, c]]$), then links, then stray brackets
+link_pattern = re.compile(
+    r"(\$\$[^$]*\$\$|\$(?=[^\s$])[^$\n]*(?<=[^\s$])\$(?!\d))"
+    r"|\[\[(?:Definition:)?([^\[\]|\n]*)(?:\|([^\[\]\n]*))?\]\]"
+    r"|\[\[|\]\]"
+)
+chunk_size = 8 * 2 ** 20
+
+
+def replace_link(match):
+    math, target, label = match.groups()
+    if math is not None:
+        return math
+    if label is not None:
+        return label
+    return target or ""
+
+
+def clean_text(text):
+    return link_pattern.sub(replace_link, text)
+
+
+def chunks(text, size=chunk_size):
+    """Pieces of about `size` characters, cut at blank lines"""
+    start = 0
+    while start < len(text):
+        end = text.find("\n\n", start + size)
+        end = len(text) if end == -1 else end + 2
+        yield text[start:end]
+        start = end
+
+
+def clean_file(path, pool=None):
+    """Clean one file in place; returns whether it changed"""
+    with open(path, "r") as f:
+        text = f.read()
+    if pool is not None and len(text) > chunk_size:
+        cleaned = "".join(pool.map(clean_text, chunks(text)))
+    else:
+        cleaned = clean_text(text)
+    if cleaned == text:
+        return False
+    with open(path, "w") as f:
+        f.write(cleaned)
+    return True
+
+
+def clean_paths(paths, jobs=None):
+    """Clean the markdown files of the given directories (or files) in parallel; returns the files that changed"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".md"))
+        else:
+            files.append(path)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        large = [f for f in files if os.path.getsize(f) > chunk_size]
+        changed = [f for f, c in zip(large, [clean_file(f, pool) for f in large]) if c]
+        large_set = set(large)
+        small = [f for f in files if f not in large_set]
+        changed.extend(f for f, c in zip(small, pool.map(clean_file, small, chunksize=16)) if c)
+    return changed
 
-definition_chars = "\[\[Definition:"
-starting_chars = "\[\["
-ending_chars = "\]\]"
 
 if __name__ == "__main__":
-    path_to_clean = "data/prompts"
-    for filename in os.listdir(path_to_clean):
-        if filename.endswith(".md"):
-            with open(os.path.join(path_to_clean, filename), "r") as f:
-                text = f.read()
-                indices_to_del = []
-                for m in re.finditer(definition_chars, text):
-                    start_m = m.start()
-                    first_divisor = text[start_m:].find("|")
-                    first_end = text[start_m:].find("]]")
-
-                    indices_to_del.extend(
-                        list(range(start_m, start_m + first_divisor + 1))
-                    )
-                    indices_to_del.extend(
-                        [start_m + first_end, start_m + first_end + 1]
-                    )
-                altered_text = "".join(
-                    [c for i, c in enumerate(text) if i not in indices_to_del]
-                )
-                # print(text)
-                # print(altered_text)
-                # print("*" * 100)
-
-                for s in [m.start() for m in re.finditer(starting_chars, text)]:
-                    indices_to_del.extend([s, s + 1])
-
-                for s in [m.start() for m in re.finditer(ending_chars, text)]:
-                    indices_to_del.extend([s, s + 1])
-
-            with open(os.path.join(path_to_clean, filename), "w") as f:
-                f.write(altered_text)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", default=["data/prompts"], help="markdown directories or files")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per cpu)")
+    args = parser.parse_args()
+
+    changed = clean_paths(args.paths, jobs=args.jobs)
+    for path in changed:
+        print(f"cleaned {path}")
+    print(f"{len(changed)} files changed")
@@ -0,0 +1,154 @@
+"""
+Build step and loader of the corpus bundle: the problems (markdown and html), the prompt examples, the problem
+categories and the neurology cases compiled into one file, data/corpus.bundle, so that the apps start without
+listing and opening every file of the data directories. Rebuild it after changing the data:
+
+    python -m data.data_utils.corpus_bundle
+
+Layout: magic, header length (8 bytes), json header {version, categories, directories: {directory: {mtime_ns,
+files: {file name: [offset, length, size, mtime_ns]}}}}, then the contents of the files.
+Opening the bundle maps the file and parses the header only; a file is decoded when it is read. The loaders use a
+bundled directory only while its mtime is the one recorded at build time (no file added, removed or renamed), and
+a bundled file only while its size and mtime are those of the file on disk; otherwise they read the directory.
+"""
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+data_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+repo_root = os.path.dirname(data_dir)
+default_bundle_path = os.path.join(data_dir, "corpus.bundle")
+bundled_directories = ["data/problems", "data/problems_html", "data/prompts", "data/Cases_Easy", "data/Cases_Hard"]
+bundled_extensions = (".md", ".html")
+
+bundle_magic = b"CHECKMATE-CORPUS\n"
+BUNDLE_VERSION = 1
+
+
+def directory_key(directory):
+    """Path of a directory relative to the root of the repository, as stored in the bundle"""
+    return os.path.relpath(os.path.abspath(directory), repo_root).replace(os.sep, "/")
+
+
+def build_bundle(bundle_path=default_bundle_path, directories=bundled_directories):
+    """Compile the files of the (existing) directories, relative to the root of the repository, into the bundle"""
+    from data.data_utils.load_problems import categories
+
+    header = {"version": BUNDLE_VERSION, "categories": categories, "directories": {}}
+    contents, offset = [], 0
+    for directory in directories:
+        path = os.path.join(repo_root, directory)
+        if not os.path.isdir(path):
+            continue
+        files = {}
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith(bundled_extensions):
+                continue
+            file_path = os.path.join(path, file_name)
+            with open(file_path, "rb") as f:
+                content = f.read()
+            stat = os.stat(file_path)
+            files[file_name] = [offset, len(content), stat.st_size, stat.st_mtime_ns]
+            contents.append(content)
+            offset += len(content)
+        header["directories"][directory] = {"mtime_ns": os.stat(path).st_mtime_ns, "files": files}
+
+    encoded_header = json.dumps(header).encode("utf-8")
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(bundle_magic + len(encoded_header).to_bytes(8, "little") + encoded_header)
+        for content in contents:
+            f.write(content)
+    os.replace(tmp_path, bundle_path)
+    return header
+
+
+class CorpusBundle:
+    """A bundle file, memory-mapped"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(bundle_magic)] != bundle_magic:
+            raise ValueError(f"{path} is not a corpus bundle")
+        header_start = len(bundle_magic) + 8
+        header_length = int.from_bytes(self._map[len(bundle_magic):header_start], "little")
+        self.header = json.loads(self._map[header_start:header_start + header_length])
+        self.data_start = header_start + header_length
+        if self.header["version"] != BUNDLE_VERSION:
+            raise ValueError(f"{path} is a corpus bundle of version {self.header['version']}")
+        self.categories = {int(k): v for k, v in self.header["categories"].items()}
+
+    def directory(self, directory):
+        """The bundled files of a directory, or None if it is not bundled or files were added or removed since"""
+        key = directory_key(directory)
+        entry = self.header["directories"].get(key)
+        if entry is None:
+            return None
+        try:
+            if os.stat(directory).st_mtime_ns != entry["mtime_ns"]:
+                return None
+        except FileNotFoundError:
+            return None
+        return BundledDirectory(self, directory, entry["files"])
+
+    def read(self, offset, length):
+        start = self.data_start + offset
+        return self._map[start:start + length].decode("utf-8")
+
+
+class BundledDirectory(Mapping):
+    """{file name: text} of a bundled directory, in file name order, each file decoded when read"""
+
+    def __init__(self, bundle, directory, files):
+        self.bundle = bundle
+        self.directory = directory
+        self.files = files
+
+    def __getitem__(self, file_name):
+        offset, length, size, mtime_ns = self.files[file_name]
+        path = os.path.join(self.directory, file_name)
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            # Edited since the bundle was built
+            with open(path, "r") as f:
+                return f.read()
+        return self.bundle.read(offset, length)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+
+_bundles = {}
+
+
+def open_bundle(bundle_path=default_bundle_path):
+    """The bundle, opened once per process; None if there is none (or of another version)"""
+    if bundle_path not in _bundles:
+        try:
+            _bundles[bundle_path] = CorpusBundle(bundle_path)
+        except (OSError, ValueError):
+            _bundles[bundle_path] = None
+    return _bundles[bundle_path]
+
+
+def bundled_directory(directory, bundle_path=default_bundle_path):
+    """{file name: text} of a directory from the bundle, or None when it has to be read from the directory itself"""
+    bundle = open_bundle(bundle_path)
+    return None if bundle is None else bundle.directory(directory)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=default_bundle_path)
+    args = parser.parse_args()
+
+    header = build_bundle(args.output)
+    for directory, entry in header["directories"].items():
+        print(f"{directory}: {len(entry['files'])} files")
+    print(f"wrote {args.output} ({os.path.getsize(args.output) / 1e3:.0f} kB)")
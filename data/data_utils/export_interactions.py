@@ -0,0 +1,318 @@
+"""
+Export the saved study data into the schema of data/mathconverse_parsed_interactions.csv:
+one row per rated conversation, joined with the participant's survey answers, solo-solve
+confidence and final model preferences.
+
+Both kinds of saves are read:
+- the result store (results.sqlite, see result_store.py), read incrementally by record id
+- the directory tree written by earlier versions of experiment.py:
+    <uid>/user_survey_metadata.json, <uid>/problem_ordering.json
+    problem_set_index_<n>/<model>/<uid>/{solo_solve, problem_details, conversation_rating}.json
+    problem_set_index_<n>/<uid>/model_ranks.json
+  scanned and parsed in parallel with a process pool
+
+Re-runs are incremental: a manifest next to the output keeps the mtime and size of every file of every
+session (and the last store record exported), and the rows of the sessions seen so far are cached, so only
+new or changed sessions are read again. When sessions were only added, their rows are appended to the CSV.
+
+Run it from the root of the repository:
+    python -m data.data_utils.export_interactions --saved-data /home/qj213/new_save --output exported/interactions.csv
+"""
+import ast
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from constants import RESULT_STORE_FILENAME
+from result_store import ResultStore
+
+columns = [
+    "model", "human_interactions", "model_responses", "time_taken", "helpfulness_ratings", "correctness_ratings",
+    "solo_solve", "problem_name", "final_prefs", "interaction_set_idx", "uid", "mth_bkgrd", "ai_play_bkgrd",
+    "selected_topic", "seen_problem_sets", "requested_at", "response_latencies", "first_token_latencies",
+    "upstream_latencies", "usage_prompt_tokens", "usage_completion_tokens", "cache_statuses",
+]
+# How each reply was served, one value per turn (None for the turns saved before they were recorded)
+served_columns = {
+    "requested_at": "requested_at", "response_latencies": "latency", "first_token_latencies": "first_token_latency",
+    "upstream_latencies": "upstream_latency", "usage_prompt_tokens": "usage_prompt_tokens",
+    "usage_completion_tokens": "usage_completion_tokens", "cache_statuses": "cache",
+}
+list_columns = ["human_interactions", "model_responses", "helpfulness_ratings", "correctness_ratings",
+                "seen_problem_sets"] + list(served_columns)
+
+problem_set_dir = re.compile(r"problem_set_index_(\d+)$")
+option_number = re.compile(r"\s*\(?(\d+)")
+manifest_version = 2
+
+
+def parse_option(option):
+    """The number of a rating/rank option, e.g. "(6) Definitely helpful" -> 6 or "1 (Most preferrable...)" -> 1"""
+    if isinstance(option, int):
+        return option
+    match = option_number.match(option) if isinstance(option, str) else None
+    return int(match.group(1)) if match else None
+
+
+def conversation_turns(conversation):
+    """(turns, time_taken) of a conversation_rating, in the current or the original flat list format"""
+    if isinstance(conversation, dict):
+        return conversation["turns"], conversation["time_taken"]
+    # [user_0, ai_0, helpfulness_0, correctness_0, ..., user_19, ai_19, helpfulness_19, correctness_19, time_taken]
+    *contents, time_taken = conversation
+    turns = []
+    for i in range(0, len(contents) - 3, 4):
+        user, ai, helpfulness, correctness = contents[i:i + 4]
+        if isinstance(user, str) and user.strip():
+            turns.append({"user": user, "ai": ai, "helpfulness": helpfulness, "correctness": correctness})
+    return turns, time_taken
+
+
+def session_rows(uid, results):
+    """
+    The exported rows of one session
+    :param results: {kind: {(problem_set_index, model): data}}, with None for what is not specific to a
+        problem set or a model
+    """
+    survey = results.get("user_survey_metadata", {}).get((None, None)) or {}
+    problem_order = (results.get("problem_ordering", {}).get((None, None)) or {}).get("problem_order", [])
+    conversations = results.get("conversation_rating", {})
+    rated_sets = {problem_set_index for problem_set_index, _ in conversations}
+    seen_problem_sets = [p for p in problem_order if p in rated_sets] + sorted(rated_sets - set(problem_order))
+
+    rows = []
+    for problem_set_index in seen_problem_sets:
+        ranks = results.get("model_ranks", {}).get((problem_set_index, None))
+        if ranks:
+            final_prefs = {model: parse_option(rank) for model, rank in ranks.items() if model != "model_presentation_order"}
+            model_order = ranks.get("model_presentation_order", [])
+        else:
+            final_prefs, model_order = "MISSING", []
+        models = [model for (p, model) in conversations if p == problem_set_index]
+        models.sort(key=lambda model: (model_order.index(model) if model in model_order else len(model_order), model))
+        for model in models:
+            turns, time_taken = conversation_turns(conversations[(problem_set_index, model)])
+            solo_solve = (results.get("solo_solve", {}).get((problem_set_index, model)) or {}).get("solo_solve")
+            problem = results.get("problem_details", {}).get((problem_set_index, model)) or {}
+            rows.append(dict({
+                "model": model,
+                "human_interactions": [turn["user"] for turn in turns],
+                "model_responses": [turn["ai"] for turn in turns],
+                "time_taken": time_taken,
+                "helpfulness_ratings": [parse_option(turn["helpfulness"]) for turn in turns],
+                "correctness_ratings": [parse_option(turn["correctness"]) for turn in turns],
+                "solo_solve": "MISSING" if parse_option(solo_solve) is None else parse_option(solo_solve),
+                "problem_name": problem.get("name", "MISSING"),
+                "final_prefs": final_prefs,
+                "interaction_set_idx": problem_order.index(problem_set_index) if problem_set_index in problem_order
+                else None,
+                "uid": uid,
+                "mth_bkgrd": survey.get("mth_bkgrd"),
+                "ai_play_bkgrd": survey.get("ai_play_bkgrd"),
+                "selected_topic": survey.get("selected_topic"),
+                "seen_problem_sets": seen_problem_sets,
+            }, **{column: [turn.get(key) for turn in turns] for column, key in served_columns.items()}))
+    return rows
+
+
+# The directory tree
+
+def scan_entries(root, names):
+    """{uid: [(path relative to root, mtime_ns, size)]} of the files under root/<name> for each name"""
+    files = {}
+
+    def add(relpath, entry):
+        stat = entry.stat()
+        uid = os.path.basename(os.path.dirname(relpath))
+        files.setdefault(uid, []).append((relpath, stat.st_mtime_ns, stat.st_size))
+
+    def walk(relpath):
+        with os.scandir(os.path.join(root, relpath)) as entries:
+            for entry in entries:
+                child = os.path.join(relpath, entry.name)
+                if entry.is_dir():
+                    walk(child)
+                elif entry.name.endswith(".json"):
+                    add(child, entry)
+
+    for name in names:
+        walk(name)
+    return files
+
+
+def read_tree_sessions(root, sessions):
+    """The exported rows of the given [(uid, [relpath])] sessions of the tree at root"""
+    rows = []
+    for uid, relpaths in sessions:
+        results = {}
+        for relpath in relpaths:
+            parts = relpath.split(os.sep)
+            kind = os.path.splitext(parts[-1])[0]
+            match = problem_set_dir.match(parts[0])
+            problem_set_index = int(match.group(1)) if match else None
+            model = parts[1] if match and len(parts) == 4 else None
+            with open(os.path.join(root, relpath)) as f:
+                results.setdefault(kind, {})[(problem_set_index, model)] = json.load(f)
+        rows.extend(session_rows(uid, results))
+    return rows
+
+
+def chunks(items, n_chunks):
+    size = max(1, -(-len(items) // n_chunks))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def scan_tree(root, pool, workers):
+    names = sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    files = {}
+    name_chunks = chunks(names, workers * 4)
+    for chunk_files in pool.map(scan_entries, [root] * len(name_chunks), name_chunks):
+        for uid, uid_files in chunk_files.items():
+            files.setdefault(uid, []).extend(uid_files)
+    return files
+
+
+def signature(uid_files):
+    return hashlib.sha1(repr(sorted(uid_files)).encode()).hexdigest()
+
+
+# The result store
+
+def read_store_sessions(store, last_id):
+    """(rows of the sessions with records after last_id, those sessions, largest record id)"""
+    new_records = store.records(after_id=last_id)
+    if not new_records:
+        return [], set(), last_id
+    updated = {record["session_id"] for record in new_records}
+    if last_id == 0:
+        records = new_records
+    else:
+        # The rows of a session depend on all of its records
+        records = [record for uid in updated for record in store.records(session_id=uid)]
+    by_session = {}
+    for record in records:
+        results = by_session.setdefault(record["session_id"], {})
+        results.setdefault(record["kind"], {})[(record["problem_set_index"], record["model"])] = record["data"]
+    rows = [row for uid, results in by_session.items() for row in session_rows(uid, results)]
+    return rows, updated, new_records[-1]["id"]
+
+
+# Output
+
+def to_frame(rows):
+    frame = pd.DataFrame(rows, columns=columns)
+    # Row number within the session, as in the released csv
+    frame.index = frame.groupby("uid").cumcount() if len(frame) else frame.index
+    return frame
+
+
+def write_output(frame, output, append=False):
+    if output.endswith(".parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Writing parquet requires pyarrow (pip install pyarrow), or export to a .csv file")
+        # Lists and dicts as in the csv, so that both files hold the same values
+        frame = frame.copy()
+        for column in list_columns + ["final_prefs", "solo_solve"]:
+            frame[column] = frame[column].map(str)
+        frame.to_parquet(output)
+    elif append:
+        frame.to_csv(output, mode="a", header=False)
+    else:
+        frame.to_csv(output)
+
+
+def export(saved_data, output, store_path=None, workers=None):
+    """
+    Export (incrementally) the sessions of the save tree saved_data and of the result store into output
+    :return: counts of the sessions exported, re-read and removed
+    """
+    workers = workers or os.cpu_count() or 1
+    store_path = store_path or os.path.join(saved_data, RESULT_STORE_FILENAME)
+    manifest_path = output + ".manifest.json"
+    rows_path = output + ".rows.pkl"
+
+    manifest = {"version": manifest_version, "tree": {}, "store_last_id": 0}
+    cached = None
+    if os.path.exists(manifest_path) and os.path.exists(rows_path) and os.path.exists(output):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous.get("version") == manifest_version and previous.get("store_path") == store_path:
+            manifest = previous
+            cached = pd.read_pickle(rows_path)
+
+    with ProcessPoolExecutor(workers) as pool:
+        files = scan_tree(saved_data, pool, workers) if os.path.isdir(saved_data) else {}
+        signatures = {uid: signature(uid_files) for uid, uid_files in files.items()}
+        changed = [uid for uid, sig in signatures.items() if manifest["tree"].get(uid) != sig]
+        removed = [uid for uid in manifest["tree"] if uid not in signatures]
+        to_read = [(uid, [relpath for relpath, _, _ in files[uid]]) for uid in changed]
+        session_chunks = chunks(to_read, workers * 4)
+        tree_rows = [
+            row for chunk_rows in pool.map(read_tree_sessions, [saved_data] * len(session_chunks), session_chunks)
+            for row in chunk_rows
+        ]
+
+    store_rows, store_updated = [], set()
+    if os.path.exists(store_path):
+        store = ResultStore(store_path)
+        store_rows, store_updated, manifest["store_last_id"] = read_store_sessions(store, manifest["store_last_id"])
+
+    replaced = set(changed) | set(removed) | store_updated
+    counts = {"read": len(changed) + len(store_updated), "removed": len(removed)}
+    if cached is not None and not replaced:
+        # Nothing new
+        return dict(counts, sessions=int(cached["uid"].nunique()), rows=len(cached))
+
+    new_frame = to_frame(tree_rows + store_rows)
+    if cached is not None and not (replaced & set(cached["uid"])):
+        # Only new sessions: append them
+        write_output(new_frame, output, append=not output.endswith(".parquet"))
+        frame = pd.concat([cached, new_frame])
+        if output.endswith(".parquet"):
+            write_output(frame, output)
+    else:
+        if cached is not None:
+            frame = pd.concat([cached[~cached["uid"].isin(replaced)], new_frame])
+        else:
+            frame = new_frame
+        directory = os.path.dirname(output)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        write_output(frame, output)
+
+    manifest.update(tree=signatures, store_path=store_path)
+    frame.to_pickle(rows_path)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return dict(counts, sessions=int(frame["uid"].nunique()), rows=len(frame))
+
+
+def load_export(path):
+    """Read an exported csv back, with the lists and dicts parsed"""
+    frame = pd.read_csv(path, index_col=0)
+    for column in list_columns:
+        frame[column] = frame[column].map(ast.literal_eval)
+    frame["final_prefs"] = frame["final_prefs"].map(lambda prefs: prefs if prefs == "MISSING" else ast.literal_eval(prefs))
+    return frame
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--saved-data", required=True, help="saving directory of experiment.py")
+    parser.add_argument("--store", default=None, help=f"result store, defaults to <saved-data>/{RESULT_STORE_FILENAME}")
+    parser.add_argument("--output", default="exported/interactions.csv", help=".csv or .parquet")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = export(args.saved_data, args.output, args.store, args.workers)
+    print(f"{counts['rows']} rows from {counts['sessions']} sessions written to {args.output} "
+          f"({counts['read']} sessions read, {counts['removed']} removed) in {time.perf_counter() - start:.2f}s")
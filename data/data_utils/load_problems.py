@@ -1,5 +1,7 @@
 import os
 
+from data.data_utils.corpus_bundle import bundled_directory
+
 categories = {}
 for i, category in enumerate(
     [
@@ -15,31 +17,43 @@ for i, category in enumerate(
         categories[i * 10 + j + 1] = category
 
 
-def load_problem(problem_dir, use_html=False):
-    """Load a problem from the problem directory."""
+def parse_problem(file_name, problem_text, use_html=False):
+    """A problem from the name and the contents of its file."""
     if use_html:
-        problem_file_name = problem_dir.split("/")[-1].rstrip(".html")
+        problem_file_name = file_name.rstrip(".html")
     else:
-        problem_file_name = problem_dir.split("/")[-1].rstrip(".md")
+        problem_file_name = file_name.rstrip(".md")
     problem_file_name_split = problem_file_name.split("_")
-    print("problem file name: ", problem_file_name_split)
     problem_id = int(problem_file_name_split[0][1:]) # remove the starting "p"
     problem_name = "_".join(problem_file_name_split[1:])
     problem_category = categories[problem_id]
+    return {
+        "id": problem_id,
+        "name": problem_name,
+        "text": problem_text,
+        "category": problem_category,
+    }
+
+
+def load_problem(problem_dir, use_html=False):
+    """Load a problem from the problem directory."""
+    print("problem file name: ", problem_dir.split("/")[-1])
     with open(problem_dir, "r") as f:
-        problem_text = f.read()
-        return {
-            "id": problem_id,
-            "name": problem_name,
-            "text": problem_text,
-            "category": problem_category,
-        }
+        return parse_problem(problem_dir.split("/")[-1], f.read(), use_html=use_html)
 
 
 def load_problems(problems_path, use_html=False):
-    """Load all problems from the problems directory."""
+    """Load all problems from the problems directory, or from the corpus bundle when it is up to date."""
+    bundled = bundled_directory(problems_path)
+    if bundled is not None:
+        problems = [parse_problem(file_name, bundled[file_name], use_html=use_html) for file_name in bundled]
+        return sorted(problems, key=lambda problem: problem["id"])
+
     problems = []
     for problem_dir in sorted(os.listdir(problems_path)):
+        if problem_dir.startswith("."):
+            # e.g. the manifest of render_md_into_html.py
+            continue
         problem_id = int(problem_dir.split("_")[0][1:])
         problem_dir = os.path.join(problems_path, problem_dir)
         assert os.path.isfile(problem_dir)
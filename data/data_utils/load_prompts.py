@@ -1,4 +1,9 @@
+import functools
 import os
+from typing import NamedTuple
+
+from data.data_utils.corpus_bundle import bundled_directory
+from token_counter import count_tokens
 
 
 ones_digit_to_ones_digit_of_examples = {}
@@ -25,15 +30,19 @@ def get_prompt_examples(prompt_dir):
         }
     """
     problem_index_to_info = {}
-    for file in os.listdir(prompt_dir):
+    bundled = bundled_directory(prompt_dir)
+    for file in (bundled if bundled is not None else os.listdir(prompt_dir)):
         if file.endswith(".md"):
             index, question_or_answer = file.rstrip(".md").split("_")
             index = int(index.lstrip("p"))
             assert question_or_answer in ["question", "answer"]
 
-            file_path = os.path.join(prompt_dir, file)
-            with open(file_path, "r") as f:
-                text = f.read().strip()
+            if bundled is not None:
+                text = bundled[file].strip()
+            else:
+                file_path = os.path.join(prompt_dir, file)
+                with open(file_path, "r") as f:
+                    text = f.read().strip()
 
 
             if index not in problem_index_to_info:
@@ -49,7 +58,15 @@ def get_prompt_examples(prompt_dir):
     return problem_index_to_info
 
 
-def construct_prompt(problem_id, problem_text, prompt_examples):
+class FewShotTemplate(NamedTuple):
+    """The few-shot examples that go before the problems of a domain, compiled once"""
+    example_indices: tuple
+    text: str  # "Question: ...\nAnswer: ..." of each example
+    turns: tuple  # ((question, answer), ...)
+    n_tokens: int
+
+
+def indices_of_examples(problem_id):
     """
     For each of the six domains, we prepare 4 examples in the format of (question, answer)
     These correspond to the first 4 problems of each domain, i.e., p1-4, p11-14, p21-24, p31-34, p41-44, p51-54
@@ -58,14 +75,56 @@ def construct_prompt(problem_id, problem_text, prompt_examples):
         for p2, we use p1, p3, and p4 as the prompts
         for p3, we use p1, p2, and p4 as the prompts
         for p4-10, we use p1, p2, and p3 as the prompts
+    The indices are those the study's prompts were built with: p10, p20, ... p50 take their examples from the next
+    domain (p11, p21, ... p51), and p60 has none (its prompt raises KeyError).
     """
     assert 1 <= problem_id <= 60
     tens_digit, ones_digit = divmod(problem_id, 10)
     ones_digit_of_examples = ones_digit_to_ones_digit_of_examples[ones_digit]
-    indices_of_examples = [10 * tens_digit + i for i in ones_digit_of_examples]
+    return tuple(10 * tens_digit + i for i in ones_digit_of_examples)
+
+
+def compile_template(example_indices, prompt_examples):
+    turns = tuple(
+        (prompt_examples[index]["question"].strip(), prompt_examples[index]["answer"].strip())
+        for index in example_indices
+    )
+    text = "\n".join(construct_one_example(question, answer) for question, answer in turns).strip()
+    return FewShotTemplate(example_indices, text, turns, count_tokens(text))
+
+
+# id of a prompt_examples dict: (the dict, {example indices: FewShotTemplate}); the dicts are not modified once loaded
+_templates = {}
+
 
-    total_examples = "\n".join(
-        construct_one_example(prompt_examples[index]["question"].strip(), prompt_examples[index]["answer"].strip()) for index in indices_of_examples
-    ).strip()
-    entire_prompt = total_examples + f"\nQuestion: {problem_text.strip()}\nAnswer:"
-    return entire_prompt
+def few_shot_template(problem_id, prompt_examples):
+    entry = _templates.get(id(prompt_examples))
+    if entry is None or entry[0] is not prompt_examples:
+        entry = _templates[id(prompt_examples)] = (prompt_examples, {})
+    example_indices = indices_of_examples(problem_id)
+    if example_indices not in entry[1]:
+        entry[1][example_indices] = compile_template(example_indices, prompt_examples)
+    return entry[1][example_indices]
+
+
+@functools.lru_cache(maxsize=1024)
+def _assemble_prompt(template, problem_text):
+    return template.text + f"\nQuestion: {problem_text.strip()}\nAnswer:"
+
+
+def construct_prompt(problem_id, problem_text, prompt_examples):
+    """The few-shot prompt of a problem (see indices_of_examples), ending with "Answer:" for the model to complete"""
+    return _assemble_prompt(few_shot_template(problem_id, prompt_examples), problem_text)
+
+
+def construct_messages(problem_id, problem_text, prompt_examples, system_prompt=None, few_shot=True):
+    """
+    The same prompt as chat messages: the examples as user/assistant turns, then the problem as the last user turn
+    """
+    messages = [] if system_prompt is None else [{"role": "system", "content": system_prompt}]
+    if few_shot:
+        for question, answer in few_shot_template(problem_id, prompt_examples).turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+    messages.append({"role": "user", "content": problem_text.strip()})
+    return messages
@@ -0,0 +1,311 @@
+"""
+Loader of data/annotated_taxonomy.csv, the user queries annotated with the categories of the taxonomy.
+
+The csv repeats the whole problem and interaction history on every row, and encodes the category flags as "y",
+"0", "0.0" or free text. Loaded here as columns:
+    - flags: one bitmask per row, bit i set when the row is in category i of `taxonomy_categories`
+    - problem / history / query / note: ids into one table of deduplicated strings (the note being the write-in of
+      the "Other" column, -1 when there is none)
+    - problem_id, topic: the problem of data/problems the declaration is, and its topic
+    - orig_idx: the "Orig Idx" column
+and indices by problem, by topic, by category and by original index.
+The first load writes everything into one binary cache file next to the csv, which later loads memory-map; the
+cache is rebuilt whenever the csv changes.
+
+    taxonomy = load_taxonomy()
+    rows = taxonomy.rows(categories=["definition"], topic="Topology")
+    taxonomy.records(rows)
+"""
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from data.data_utils.load_problems import categories as problem_topics
+
+data_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_taxonomy_path = os.path.join(data_dir, "annotated_taxonomy.csv")
+default_problems_path = os.path.join(data_dir, "problems")
+
+# Short names of the category columns, in the order of the csv
+taxonomy_categories = [
+    "definition",
+    "general_question",
+    "proof_step",
+    "copy_paste",
+    "generality",
+    "correction",
+    "clarification",
+    "why",
+    "example",
+    "non_math",
+    "other",
+]
+topics = list(dict.fromkeys(problem_topics.values()))
+string_columns = ["problem", "history", "query", "note"]
+
+cache_magic = b"CHECKMATE-TAXONOMY-1\n"
+cache_alignment = 64
+
+
+def is_flagged(value):
+    """Whether a cell of a category column marks the row as in the category ("y", a write-in...)"""
+    value = str(value).strip()
+    return value not in ("", "0", "0.0", "nan")
+
+
+def normalise_whitespace(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def problems_by_text(problems_path):
+    """{declaration with normalised whitespace: problem id} of the problems directory (files p<id>_<name>.md)"""
+    problems = {}
+    for file_name in os.listdir(problems_path):
+        if file_name.endswith(".md"):
+            with open(os.path.join(problems_path, file_name), "r") as f:
+                problems[normalise_whitespace(f.read())] = int(file_name.split("_")[0][1:])
+    return problems
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class StringTable:
+    """Deduplicated strings, stored as one utf-8 blob and the offsets of each string in it"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+        self._decoded = {}
+
+    @classmethod
+    def build(cls, columns):
+        """:return: the table, and the ids of the strings of each column (-1 for missing values)"""
+        ids = {}
+        encoded = []
+        column_ids = []
+        for column in columns:
+            codes = np.full(len(column), -1, dtype=np.int32)
+            for i, text in enumerate(column):
+                if text is None:
+                    continue
+                if text not in ids:
+                    ids[text] = len(encoded)
+                    encoded.append(text.encode("utf-8"))
+                codes[i] = ids[text]
+            column_ids.append(codes)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(blob, offsets), column_ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, string_id):
+        if string_id < 0:
+            return None
+        if string_id not in self._decoded:
+            start, end = self.offsets[string_id], self.offsets[string_id + 1]
+            self._decoded[string_id] = self.blob[start:end].tobytes().decode("utf-8")
+        return self._decoded[string_id]
+
+
+def grouped_rows(keys, n_keys):
+    """Index of rows by key, as (rows sorted by key, offsets of each key in them)"""
+    order = np.argsort(keys, kind="stable").astype(np.int32)
+    counts = np.bincount(keys[keys >= 0], minlength=n_keys)
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    # Rows of negative (unknown) keys come first, skip them
+    return order[(keys[order] >= 0)], offsets
+
+
+class Taxonomy:
+    """The annotated queries as arrays, with indices; see the module docstring"""
+
+    def __init__(self, arrays, strings, labels, source):
+        self.arrays = arrays
+        self.strings = strings
+        self.labels = labels
+        self.source = source
+        for name in ["flags", "problem_id", "topic", "orig_idx"] + string_columns:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.flags)
+
+    @classmethod
+    def from_csv(cls, csv_path=default_taxonomy_path, problems_path=default_problems_path):
+        frame = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+        category_columns = list(frame.columns[4:4 + len(taxonomy_categories)])
+        assert frame.columns[4 + len(taxonomy_categories)] == "Orig Idx", "unexpected columns"
+
+        flags = np.zeros(len(frame), dtype=np.uint16)
+        for bit, column in enumerate(category_columns):
+            flags |= frame[column].map(is_flagged).to_numpy(dtype=np.uint16) << bit
+        other = frame[category_columns[-1]]
+        notes = [value.strip() if is_flagged(value) and value.strip() != "y" else None for value in other]
+
+        problem_ids = problems_by_text(problems_path)
+        problem_id = np.array([problem_ids.get(normalise_whitespace(text), -1) for text in frame["problem_declaration"]],
+                              dtype=np.int16)
+        topic = np.array([topics.index(problem_topics[p]) if p > 0 else -1 for p in problem_id], dtype=np.int8)
+
+        strings, (problem, history, query, note) = StringTable.build([
+            list(frame["problem_declaration"]), list(frame["previous_interactions"]), list(frame["user_query"]), notes,
+        ])
+        arrays = {
+            "flags": flags, "problem_id": problem_id, "topic": topic,
+            "orig_idx": frame["Orig Idx"].astype(np.int64).to_numpy(),
+            "problem": problem, "history": history, "query": query, "note": note,
+            "strings_blob": strings.blob, "strings_offsets": strings.offsets,
+        }
+        arrays["by_problem_rows"], arrays["by_problem_offsets"] = grouped_rows(problem_id.astype(np.int64), 61)
+        arrays["by_topic_rows"], arrays["by_topic_offsets"] = grouped_rows(topic.astype(np.int64), len(topics))
+        rows_per_category = [np.flatnonzero(flags & (1 << bit)).astype(np.int32)
+                             for bit in range(len(taxonomy_categories))]
+        arrays["by_category_rows"] = np.concatenate(rows_per_category)
+        arrays["by_category_offsets"] = np.cumsum([0] + [len(r) for r in rows_per_category]).astype(np.int64)
+        arrays["by_orig_idx_order"] = np.argsort(arrays["orig_idx"], kind="stable").astype(np.int32)
+        arrays["by_orig_idx_sorted"] = arrays["orig_idx"][arrays["by_orig_idx_order"]]
+        labels = {"categories": taxonomy_categories, "category_columns": category_columns, "topics": topics}
+        return cls(arrays, strings, labels, source_signature(csv_path))
+
+    # The binary cache: magic, header length (8 bytes), json header, then each array aligned to cache_alignment
+
+    def save(self, cache_path):
+        layout, offset = {}, 0
+        for name, array in self.arrays.items():
+            layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += -(-array.nbytes // cache_alignment) * cache_alignment
+        header = json.dumps({"source": self.source, "labels": self.labels, "arrays": layout}).encode("utf-8")
+        start = -(-(len(cache_magic) + 8 + len(header)) // cache_alignment) * cache_alignment
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cache_magic + len(header).to_bytes(8, "little") + header)
+            for name, array in self.arrays.items():
+                f.seek(start + layout[name]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(start + offset)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def open(cls, cache_path):
+        """Memory-map a cache file written by save"""
+        mapped = np.memmap(cache_path, dtype=np.uint8, mode="r")
+        if mapped[:len(cache_magic)].tobytes() != cache_magic:
+            raise ValueError(f"{cache_path} is not a taxonomy cache")
+        header_length = int.from_bytes(mapped[len(cache_magic):len(cache_magic) + 8].tobytes(), "little")
+        header_end = len(cache_magic) + 8 + header_length
+        header = json.loads(mapped[len(cache_magic) + 8:header_end].tobytes())
+        start = -(-header_end // cache_alignment) * cache_alignment
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"]))
+            offset = start + spec["offset"]
+            arrays[name] = mapped[offset:offset + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+        strings = StringTable(arrays["strings_blob"], arrays["strings_offsets"])
+        return cls(arrays, strings, header["labels"], header["source"])
+
+    # Queries
+
+    def category_mask(self, categories):
+        mask = 0
+        for category in categories:
+            mask |= 1 << self.labels["categories"].index(category)
+        return mask
+
+    def _group(self, name, key):
+        offsets = self.arrays[f"by_{name}_offsets"]
+        return self.arrays[f"by_{name}_rows"][offsets[key]:offsets[key + 1]]
+
+    def rows(self, categories=None, topic=None, problem_id=None, require_all=False):
+        """
+        Rows (sorted positions) in any of the categories (all of them if require_all), of the topic and the problem
+        :param categories: short names of taxonomy_categories
+        :param topic: one of the problem topics (e.g. "Topology")
+        :param problem_id: the number of a problem of data/problems
+        """
+        candidates = None
+        if problem_id is not None:
+            candidates = self._group("problem", problem_id)
+        if topic is not None:
+            topic_rows = self._group("topic", self.labels["topics"].index(topic))
+            candidates = topic_rows if candidates is None else np.intersect1d(candidates, topic_rows,
+                                                                              assume_unique=True)
+        if categories:
+            mask = self.category_mask(categories)
+            if candidates is None:
+                if len(categories) == 1:
+                    return self._group("category", self.labels["categories"].index(categories[0]))
+                candidates = np.arange(len(self), dtype=np.int32)
+            flags = self.flags[candidates]
+            candidates = candidates[(flags & mask) == mask if require_all else (flags & mask) != 0]
+        return np.arange(len(self), dtype=np.int32) if candidates is None else candidates
+
+    def by_orig_idx(self, orig_idx):
+        """Row of an "Orig Idx" value, or None"""
+        position = np.searchsorted(self.arrays["by_orig_idx_sorted"], orig_idx)
+        if position < len(self) and self.arrays["by_orig_idx_sorted"][position] == orig_idx:
+            return int(self.arrays["by_orig_idx_order"][position])
+        return None
+
+    def record(self, row):
+        flags = int(self.flags[row])
+        topic = int(self.topic[row])
+        return {
+            "orig_idx": int(self.orig_idx[row]),
+            "problem_id": int(self.problem_id[row]),
+            "topic": self.labels["topics"][topic] if topic >= 0 else None,
+            "categories": [c for bit, c in enumerate(self.labels["categories"]) if flags & (1 << bit)],
+            **{column: self.strings[int(getattr(self, column)[row])] for column in string_columns},
+        }
+
+    def records(self, rows):
+        return [self.record(row) for row in rows]
+
+
+def load_taxonomy(csv_path=default_taxonomy_path, problems_path=default_problems_path, cache_path=None,
+                  rebuild=False):
+    """
+    The taxonomy, memory-mapped from its cache when the cache matches the csv, otherwise parsed from the csv
+    and cached
+    :param cache_path: defaults to <csv_path>.cache
+    """
+    cache_path = cache_path or f"{csv_path}.cache"
+    if not rebuild and os.path.exists(cache_path):
+        try:
+            taxonomy = Taxonomy.open(cache_path)
+            if taxonomy.source == source_signature(csv_path):
+                return taxonomy
+        except (ValueError, KeyError, json.JSONDecodeError):
+            pass
+    taxonomy = Taxonomy.from_csv(csv_path, problems_path)
+    try:
+        taxonomy.save(cache_path)
+    except OSError:
+        # Read-only data directory: work from the csv
+        pass
+    return taxonomy
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--taxonomy", default=default_taxonomy_path)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    taxonomy = load_taxonomy(args.taxonomy, rebuild=args.rebuild)
+    print(f"{len(taxonomy)} queries, {len(taxonomy.strings)} distinct strings "
+          f"({taxonomy.strings.blob.nbytes / 1e3:.0f} kB)")
+    for topic in taxonomy.labels["topics"]:
+        counts = {c: len(taxonomy.rows(categories=[c], topic=topic)) for c in taxonomy.labels["categories"]}
+        print(f"{topic:20s}", " ".join(f"{c}={n}" for c, n in counts.items() if n))
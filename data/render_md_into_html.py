@@ -1,37 +1,125 @@
+"""
+Renders the markdown problems into the html shown to participants, with pandoc:
+
+    python data/render_md_into_html.py data/problems data/problems_html
+
+The build is incremental: the output directory keeps a manifest of the sha256 of each markdown file it was
+rendered from (and of the pandoc version and options), and only new or changed files are rendered again, by a
+pool of worker processes that each run pandoc and the alt-text pass of their file. Html files whose markdown was
+removed are deleted.
+
+Math is rendered by default as images of latex.codecogs.com (--math webtex), which each participant's browser
+fetches; --math mathml renders it as MathML inside the page instead, so that pages load without any external fetch.
+"""
+import hashlib
+import json
 import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
 from bs4 import BeautifulSoup
 
+manifest_name = ".render_manifest.json"
+math_options = {
+    "webtex": ["--webtex=https://latex.codecogs.com/svg.latex?"],
+    "mathml": ["--mathml"],
+}
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def pandoc_version():
+    return subprocess.run(["pandoc", "--version"], capture_output=True, text=True, check=True).stdout.splitlines()[0]
+
+
+def postprocess(html, math):
+    """Inline math images of webtex are shown inline, with their latex as alt text"""
+    if math != "webtex":
+        return html
+    html = html.replace('<img style="', '<img style="display:inline-block;')
+    soup = BeautifulSoup(html, "html.parser")
+    for img in soup.find_all("img"):
+        img["alt"] = f'${img["alt"]}$'
+    return str(soup)
+
+
+def render(input_path, output_path, math):
+    """Render one markdown file (worker process); returns an error message, or None"""
+    result = subprocess.run(
+        ["pandoc", "-f", "markdown", "-t", "html", *math_options[math], input_path],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        return result.stderr.strip() or f"pandoc exited with {result.returncode}"
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(postprocess(result.stdout, math))
+    os.replace(tmp_path, output_path)
+    return None
+
+
+def build(input_dir, output_dir, math="webtex", jobs=None, force=False):
+    """:return: {"rendered": [...], "unchanged": [...], "removed": [...], "failed": {file name: error}}"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, manifest_name)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    options = {"pandoc": pandoc_version(), "math": math}
+    if manifest.get("options") != options:
+        manifest = {}
+    previous = manifest.get("files", {})
+
+    sources = {filename: file_hash(os.path.join(input_dir, filename))
+               for filename in sorted(os.listdir(input_dir)) if filename.endswith(".md")}
+    outputs = {filename: filename.replace(".md", ".html") for filename in sources}
+    to_render = [filename for filename, digest in sources.items()
+                 if previous.get(filename) != digest or not os.path.exists(os.path.join(output_dir, outputs[filename]))]
+    report = {"rendered": [], "unchanged": [f for f in sources if f not in to_render], "removed": [], "failed": {}}
+
+    files = {filename: previous[filename] for filename in report["unchanged"]}
+    if to_render:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            errors = pool.map(render, [os.path.join(input_dir, f) for f in to_render],
+                              [os.path.join(output_dir, outputs[f]) for f in to_render], [math] * len(to_render))
+            for filename, error in zip(to_render, errors):
+                if error is None:
+                    print("Rendered {} to {}".format(filename, outputs[filename]))
+                    report["rendered"].append(filename)
+                    files[filename] = sources[filename]
+                else:
+                    print("Failed to render {}: {}".format(filename, error))
+                    report["failed"][filename] = error
+
+    for filename in previous:
+        if filename not in sources:
+            output_path = os.path.join(output_dir, filename.replace(".md", ".html"))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            report["removed"].append(filename)
+
+    with open(manifest_path, "w") as f:
+        json.dump({"options": options, "files": files}, f, indent=1)
+    return report
+
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir", help="input markdown directory")
     parser.add_argument("output_dir", help="output html directory")
+    parser.add_argument("--math", choices=list(math_options), default="webtex",
+                        help="mathml renders the math into the pages, with no external image fetches")
+    parser.add_argument("--jobs", type=int, default=None, help="pandoc worker processes (default: one per cpu)")
+    parser.add_argument("--force", action="store_true", help="render every file again")
     args = parser.parse_args()
 
-    input_dir = args.input_dir
-    output_dir = args.output_dir
-
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".md"):
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, filename.replace(".md", ".html"))
-            print("Rendering {} to {}".format(input_path, output_path))
-            os.system("pandoc -f markdown -t html --webtex='https://latex.codecogs.com/svg.latex?' {} -o {}".format(input_path, output_path))
-
-    for filename in os.listdir(output_dir):
-        file_path = os.path.join(output_dir, filename)
-
-        file_content = open(file_path, "r").read()
-        file_content = file_content.replace(
-            '<img style="', '<img style="display:inline-block;'
-        )
-        soup = BeautifulSoup(file_content, "html.parser")
-        for img in soup.find_all("img"):
-            img["alt"] = f'${img["alt"]}$'
-        file_content = str(soup)
-        with open(file_path, "w") as f:
-            f.write(file_content)
+    report = build(args.input_dir, args.output_dir, math=args.math, jobs=args.jobs, force=args.force)
+    print(f"{len(report['rendered'])} rendered, {len(report['unchanged'])} unchanged, {len(report['removed'])} removed, "
+          f"{len(report['failed'])} failed")
+    if report["failed"]:
+        raise SystemExit(1)
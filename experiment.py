@@ -1,16 +1,22 @@
+import asyncio
+import copy
 import gradio as gr
-import json
 import os
 import numpy as np
 import time
 import random
 import uuid
-import matplotlib.pyplot as plt
 
-from model_generate import chatbot_generate
+from conversation import Conversation, Turn
+from model_generate import chatbot_generate_async, chatbot_generate_stream
 from constants import usefulness_options, experience_options, ai_experience_options, instruction_pages, correctness_options, \
     useful_prompt_txt, correctness_prompt_txt, model_options, solo_solve_options, first_rating_instruct_txt
-from constants import MAX_CONVERSATION_LENGTH 
+from constants import STREAM_GENERATIONS, QUEUE_CONCURRENCY_COUNT, RESULT_STORE_FILENAME, RESULT_STORE_BATCH_SIZE, \
+    RESULT_STORE_FLUSH_INTERVAL, RESULT_STORE_COMMIT_RETRIES, RESULT_STORE_READ_TIMEOUT, MARKDOWN_LIVE_PREVIEW, \
+    MARKDOWN_PREVIEW_DEBOUNCE
+from markdown_preview import markdown_preview
+from metrics import metrics, start_metrics_server, start_metrics_dump
+from result_store import ResultStore
 from data.data_utils.load_problems import load_problems
 from data.data_utils.load_prompts import get_prompt_examples
 
@@ -49,8 +55,6 @@ print("NUM BLOCKS OF PROBLEMS: ", num_problems_show)
 problem_texts = load_problems("./data/problems_html/")
 prompts = get_prompt_examples("./data/prompts/")
 
-poss_problems = []
-
 # Set saving directory
 main_saving_path = f"./saved_data/"
 if not os.path.exists(main_saving_path): os.makedirs(main_saving_path)
@@ -64,27 +68,91 @@ random.shuffle(model_order)
 if not os.path.exists(main_saving_path): os.makedirs(main_saving_path)
 
 
-def pipeline_for_model(
-    model: str = "gpt-4",
-    saving_path: str = main_saving_path,
-    problem_index: int = 0,
-    display_info: bool = False,
-    model_idx: int = 0
-):
-    global problem_texts 
-    current_problem = problem_texts[problem_index]
-    current_problem_text = current_problem["text"] # because zero indexed!!!!
+# TODO: Saving directory, should be altered by the survey designer
+cwd = os.getcwd()
+if "collins" in cwd: 
+    unique_saving_path = os.path.join(f"/Users/kcollins/new_save")
+else: 
+    unique_saving_path = os.path.join("/home/qj213/new_save")
+
+if not os.path.exists(unique_saving_path):
+    os.makedirs(unique_saving_path)
+
+# Every answer of every participant goes to one append-only store, see result_store.py
+result_store = ResultStore(
+    os.path.join(unique_saving_path, RESULT_STORE_FILENAME),
+    batch_size=RESULT_STORE_BATCH_SIZE,
+    flush_interval=RESULT_STORE_FLUSH_INTERVAL,
+    commit_retries=RESULT_STORE_COMMIT_RETRIES,
+    read_timeout=RESULT_STORE_READ_TIMEOUT,
+)
+
+
+'''
+The interface holds a single problem block (three model tabs and a final preference tab), built once.
+Which problem set it shows, and with which models, is per session: it lives in the session state ("block")
+and the block's contents are filled from it each time a participant starts a new set of problems.
+'''
+def new_session():
+    """
+    Everything specific to one participant. It is held in a gr.State, which gradio copies for every
+    browser session, so concurrent participants never share it.
+    """
+    return {
+        "unique_key": None,  # participant id, set once the survey is answered
+        "instruct_idx": 0,  # instruction page on display
+        "poss_problems": [],  # problem sets to evaluate, in order
+        "problem_set_index": 0,  # position in poss_problems
+        "block": None,  # problem set on display, see assign_problem_set
+        "start_times": {},  # model_idx -> time the participant started evaluating that model
+        "preview_edits": {},  # model_idx -> edits of the message typed to that model, to preview the last one only
+    }
+
+
+def set_model_order(problem_set_index):
+    # Randomise model order to avoid bias in order preference: once per problem set, the same for every participant
+    fixed_model_order = [model for model in model_order]
+    random.Random(f"{current_uid}/{problem_set_index}").shuffle(fixed_model_order)
+    return fixed_model_order
+
+
+model_order_per_set = {problem_set_index: set_model_order(problem_set_index) for problem_set_index in problem_sets}
+
+
+def assign_problem_set(problem_set_index):
+    # problem_set_index maps to the original problem indexes
+    block_problems = problem_sets[problem_set_index]
+    fixed_model_order = list(model_order_per_set[problem_set_index])
+    return {
+        "problem_set_index": int(problem_set_index),
+        "model_order": fixed_model_order,
+        "problem_indices": [int(x) for x in block_problems[:len(fixed_model_order)]],
+    }
 
-    model_saving_path = os.path.join(
-        saving_path, model
-    )
 
-    os.makedirs(model_saving_path)
+@metrics.instrument("save_model_result")
+def save_model_result(session, model_idx, kind, data):
+    # Save the participant's answers about the model_idx-th model of the problem set on display
+    block = session["block"]
+    result_store.write(session["unique_key"], kind, data,
+                       problem_set_index=block["problem_set_index"], model=block["model_order"][model_idx])
 
-    # save out details of this current problem
 
+def problem_html(problem_text):
+    return '<div style="background-color: white;">'+problem_text.replace('<p>', '<p style="color:black;">')+'</div>'
+
+
+def pipeline_for_model(
+    session_state,
+    display_info: bool = False,
+    model_idx: int = 0
+):
+    """
+    Build the interface for the model_idx-th model of the problem block
+    :return: the components to refill when a new problem set is shown, and a function giving their updates for a block
+    """
     with gr.Column(visible=False) as fifth_page:
-        if model_idx != 2: # note: assumes 3 models to rate
+        if model_idx != 2: # note: assumes 3 models to rate
             done_with_model = gr.HTML('<p style="text-align:center">You have completed the evaluation for this model. Please move on to evaluating the next model.</p>', 
                 visible=False)
         else: 
@@ -97,20 +165,19 @@ def pipeline_for_model(
 
         # Optional conversation "starter" for potentially more step-by-step interactions and better response to user queries
         # This is commented out because we did not explore it in the paper
-        initial_conversation = [
-            # "User: I'm a professional mathematician. So you should trust me if I tell you that you have got something wrong. With that in mind I'd like to see if I can help you solve a problem. Please don't give me an answer straight away, since the danger is that if you try to guess the answer, then your guess will be wrong and you'll end up trying to prove a false statement, and maybe even believing that you have managed to prove it. So instead I'd like you to set out as clearly as possible what your initial goals will be. Once you've done that, I'll tell you what I think.",
-            # "AI: As a mathematical chatbot, my goal is to provide a clear and rigorous proof step by step.",
-        ]
+        initial_conversation = Conversation([
+            # Turn("user", "I'm a professional mathematician. So you should trust me if I tell you that you have got something wrong. With that in mind I'd like to see if I can help you solve a problem. Please don't give me an answer straight away, since the danger is that if you try to guess the answer, then your guess will be wrong and you'll end up trying to prove a false statement, and maybe even believing that you have managed to prove it. So instead I'd like you to set out as clearly as possible what your initial goals will be. Once you've done that, I'll tell you what I think."),
+            # Turn("assistant", 'As a mathematical chatbot, my goal is to provide a clear and rigorous proof step by step.'),
+        ])
         with gr.Row(): 
             # Reminder of what the problem is for the survey participant
-            problem_html_txt = gr.HTML(
-            'As a reminder, the problem is: <p></p>' + '<div style="background-color: white;">'+current_problem_text.replace('<p>', '<p style="color:black;">')+'</div>' + '<p></p>Note, the problem is NOT automatically provided to the model. You will need to provide it, or part of the problem, as desired. You can copy and paste from the problem above. You can optionally render your text in markdown before entering by pressing the --> button (note: the set of LaTeX symbols is restricted). <p></p>After many interactions, you may also need to SCROLL to see new model generations.')
+            problem_html_txt = gr.HTML("")
 
-        chatbot = gr.Chatbot(initial_conversation).style(height=300)
-        # Chat state
+        chatbot = gr.Chatbot(initial_conversation.pairs()).style(height=300)
+        # Chat state: the turns of the conversation, with their timings and token counts
         state = gr.State(initial_conversation)
-        # Model state
-        model_state = gr.State(model)
+        # Model state, filled in when the problem set is shown
+        model_state = gr.State(None)
 
         with gr.Row().style(equal_height=True):
             txt = gr.Textbox(
@@ -123,171 +190,132 @@ def pipeline_for_model(
             md_button = gr.Button("-->", elem_id="warning")
             # Markdown visualiser
             with gr.Box():
-                markdown_visualiser = gr.Markdown(value="Markdown preview", label="Markdown visualiser")
+                # Rendered on the server (markdown_preview.py), shown as is
+                markdown_visualiser = gr.HTML(value="Markdown preview", label="Markdown visualiser")
             
+        @metrics.instrument("render_markdown")
         def render_markdown(text):
-            try:
-                trial = gr.Markdown(text)
-                del trial
-                plt.close()
-            except ValueError as e:
-                plt.close()
-                return gr.update(value=str(e))
-            return gr.update(value=text)
+            return gr.update(value=markdown_preview.render(text))
+
+        async def live_preview(text, session):
+            # Only the last of the edits made within MARKDOWN_PREVIEW_DEBOUNCE seconds is rendered
+            # Each model's tab has its own preview: typing in one does not cancel the preview of another
+            edit = session["preview_edits"][model_idx] = session["preview_edits"].get(model_idx, 0) + 1
+            await asyncio.sleep(MARKDOWN_PREVIEW_DEBOUNCE)
+            if session["preview_edits"][model_idx] != edit:
+                return gr.update()
+            return render_markdown(text)
         
         md_button.click(render_markdown, inputs=[txt], outputs=[markdown_visualiser])
+        if MARKDOWN_LIVE_PREVIEW:
+            # Outside the queue: the waits of the typing participants do not hold up the other events
+            txt.change(live_preview, inputs=[txt, session_state], outputs=[markdown_visualiser], queue=False)
 
         submit_button = gr.Button("Interact")
-        # Comment this out because the user might want to change line via the enter key, instead of interacting
-        # txt.submit(chatbot_generate, [txt, state, model_state], [chatbot, state, txt, submit_button])
+        # Comment this out because the user might want to change line via the enter key, instead of interacting
+        # txt.submit(chatbot_generate, [txt, state, model_state, session_state], [chatbot, state, txt, submit_button])
 
         # Button for submission
-        submit_button.click(chatbot_generate, [txt, state, model_state], [chatbot, state, txt, submit_button])
+        # The streaming handler is a generator, so it relies on the queue being enabled (demo.queue() below)
+        # Gradio 3.x does not accept async generators, so streaming uses the sync generator, which waits on the
+        # shared async backend; without streaming the handler is a coroutine and holds no worker thread at all
+        submit_button.click(chatbot_generate_stream if STREAM_GENERATIONS else chatbot_generate_async,
+                            [txt, state, model_state, session_state], [chatbot, state, txt, submit_button])
 
         # Button to start rating
         finished_button = gr.Button("Done with interaction")
 
-        # A next page burner function to make the current content invisible and the next-page content (rating) visible
-        def next_page(history):
-            parent_path = os.path.join(model_saving_path, unique_key)
-            if not os.path.isdir(parent_path):
-                os.makedirs(parent_path)
-            json.dump(
-                current_problem, 
-                open(os.path.join(model_saving_path, unique_key, "problem_details.json"), "w")
-                )
-            # Rating system of the conversation
-            returned_boxes = []
-            for sentence in history:
-                if sentence.startswith("AI:"):
-                    returned_boxes.append(
-                        gr.Textbox.update(value=sentence, visible=True)
-                    )
-                    returned_boxes.append(
-                        gr.Radio.update(visible=True, interactive=True)
-                    )
-                    returned_boxes.append(
-                        gr.Radio.update(visible=True, interactive=True)
-                    )
-                elif sentence.startswith("User:"):
-                    returned_boxes.append(
-                        gr.Textbox.update(value=sentence, visible=True)
-                    )
-                else:
-                    raise AssertionError
-
-
-            assert len(returned_boxes) % 4 == 0
-            conversation_length = int(len(returned_boxes) / 4)
-
-            returned_boxes = (
-                returned_boxes
-                + [
-                    gr.Textbox.update(visible=False),
-                    gr.Textbox.update(visible=False),
-                    gr.Radio.update(visible=False),
-                    gr.Radio.update(visible=False),
-                ]
-                * (MAX_CONVERSATION_LENGTH - conversation_length)
-                + [gr.Button.update(visible=True), gr.Button.update(visible=False)]
-            )
-            return returned_boxes
-
-        textbox_dict = {}
-        textboxes = []
-        for i in range(MAX_CONVERSATION_LENGTH):
-            # These should follow the format of
+        # Rating of the conversation, one turn at a time
+        # The ratings live in a per-session state, so each request only carries the ratings of the turn on display,
+        # whatever the length of the conversation
+        with gr.Column(visible=False) as rating_page:
+            rating_progress = gr.HTML("")
+            # These follow the format of
             # User: Textbox
             # AI: Textbox
             # Rating of the AI generation: Radio
-            user_content = gr.Textbox(visible=False, show_label=False).style(
-                container=False
-            )
-            ai_content = gr.Textbox(visible=False, show_label=False).style(
-                container=False
-            )
-            ai_rating = third_page_helpfulness_checkbox = gr.Radio(
+            user_content = gr.Textbox(show_label=False, interactive=False).style(container=False)
+            ai_content = gr.Textbox(show_label=False, interactive=False).style(container=False)
+            ai_rating = gr.Radio(
                 choices=usefulness_options,
                 label=useful_prompt_txt,
-                visible=False,
+                interactive=True,
             )
-            ai_corr_rating = third_page_error_checkbox = gr.Radio(
+            ai_corr_rating = gr.Radio(
                 choices=correctness_options,
                 label=correctness_prompt_txt, 
-                visible=False
+                interactive=True,
             )
-            textbox_dict[f"user_content_{i}"] = user_content
-            textbox_dict[f"ai_content_{i}"] = ai_content
-            textbox_dict[f"ai_rating_{i}"] = ai_rating
-            textbox_dict[f"ai_corr_rating_{i}"] = ai_corr_rating
-            textboxes.extend([user_content, ai_content, ai_rating, ai_corr_rating])
+            with gr.Row():
+                previous_turn_button = gr.Button("Previous turn")
+                next_turn_button = gr.Button("Next turn")
+        # {"turn": index of the turn on display, "helpfulness": [rating per turn], "correctness": [rating per turn]}
+        ratings_state = gr.State(None)
+        rating_boxes = [rating_progress, user_content, ai_content, ai_rating, ai_corr_rating]
+
+        def show_turn(conversation, ratings):
+            turn = ratings["turn"]
+            n_turns = len(ratings["helpfulness"])
+            user, ai = conversation.exchange(turn)
+            return [
+                gr.update(value=f'<p style="text-align:center">Turn {turn + 1} of {n_turns}</p>'),
+                gr.update(value=user.display()),
+                gr.update(value=ai.display()),
+                gr.update(value=ratings["helpfulness"][turn]),
+                gr.update(value=ratings["correctness"][turn]),
+            ]
+
+        def record_turn(ratings, helpfulness, correctness):
+            ratings["helpfulness"][ratings["turn"]] = helpfulness
+            ratings["correctness"][ratings["turn"]] = correctness
+            return ratings
+
+        # A next page burner function to make the current content invisible and the next-page content (rating) visible
+        @metrics.instrument("next_page_rating")
+        def next_page(conversation, session):
+            save_model_result(session, model_idx, "problem_details", problem_texts[session["block"]["problem_indices"][model_idx]])
+            n_turns = conversation.n_exchanges
+            if n_turns == 0:
+                # Nothing to rate
+                return [gr.update(visible=False)] + [gr.update() for _ in rating_boxes] + [
+                    gr.update(visible=True), gr.update(visible=False), None
+                ]
+            ratings = {"turn": 0, "helpfulness": [None] * n_turns, "correctness": [None] * n_turns}
+            return [gr.update(visible=True)] + show_turn(conversation, ratings) + [
+                gr.update(visible=True), gr.update(visible=False), ratings
+            ]
+
+        def move_turn(step):
+            def move(conversation, ratings, helpfulness, correctness):
+                ratings = record_turn(ratings, helpfulness, correctness)
+                ratings["turn"] = min(max(ratings["turn"] + step, 0), len(ratings["helpfulness"]) - 1)
+                return show_turn(conversation, ratings) + [ratings]
+            return move
+
+        previous_turn_button.click(move_turn(-1), [state, ratings_state, ai_rating, ai_corr_rating], rating_boxes + [ratings_state])
+        next_turn_button.click(move_turn(1), [state, ratings_state, ai_rating, ai_corr_rating], rating_boxes + [ratings_state])
 
         # Finish rating boxes
         finish_rating_button = gr.Button("Finish rating", visible=False)
 
-        # Currently hardcoded, assuming MAX_INTERACTION_LENGTH=20, can be improved if the coder is more proficient with Gradio
-        def finish_rating(
-            user_content_0, ai_content_0, ai_rating_0, ai_corr_rating_0,
-            user_content_1, ai_content_1, ai_rating_1, ai_corr_rating_1,
-            user_content_2, ai_content_2, ai_rating_2, ai_corr_rating_2,
-            user_content_3, ai_content_3, ai_rating_3, ai_corr_rating_3,
-            user_content_4, ai_content_4, ai_rating_4, ai_corr_rating_4,
-            user_content_5, ai_content_5, ai_rating_5, ai_corr_rating_5,
-            user_content_6, ai_content_6, ai_rating_6, ai_corr_rating_6,
-            user_content_7, ai_content_7, ai_rating_7, ai_corr_rating_7,
-            user_content_8, ai_content_8, ai_rating_8, ai_corr_rating_8,
-            user_content_9, ai_content_9, ai_rating_9, ai_corr_rating_9, 
-            user_content_10, ai_content_10, ai_rating_10, ai_corr_rating_10,
-            user_content_11, ai_content_11, ai_rating_11, ai_corr_rating_11,
-            user_content_12, ai_content_12, ai_rating_12, ai_corr_rating_12,
-            user_content_13, ai_content_13, ai_rating_13, ai_corr_rating_13,
-            user_content_14, ai_content_14, ai_rating_14, ai_corr_rating_14, 
-            user_content_15, ai_content_15, ai_rating_15, ai_corr_rating_15,
-            user_content_16, ai_content_16, ai_rating_16, ai_corr_rating_16,
-            user_content_17, ai_content_17, ai_rating_17, ai_corr_rating_17,
-            user_content_18, ai_content_18, ai_rating_18, ai_corr_rating_18,
-            user_content_19, ai_content_19, ai_rating_19, ai_corr_rating_19,
-        ):
+        @metrics.instrument("finish_rating")
+        def finish_rating(session, conversation, ratings, helpfulness, correctness):
             # save out time taken over course of conversation
-            global start_time
+            start_time = session["start_times"][model_idx]
             time_taken = time.time() - start_time
-            print("time taken: ", time_taken,  time.time(), start_time)
+
+            # The turns with their ratings, and the prompt tokens sent (after truncation) and latency of each reply
+            turns = []
+            if ratings is not None:
+                ratings = record_turn(ratings, helpfulness, correctness)
+                turns = conversation.rated_turns(ratings["helpfulness"], ratings["correctness"])
             
-            parent_path = os.path.join(model_saving_path, unique_key)
-            if not os.path.isdir(parent_path):
-                os.makedirs(parent_path)
-            json.dump(
-                [
-                user_content_0, ai_content_0, ai_rating_0, ai_corr_rating_0,
-                user_content_1, ai_content_1, ai_rating_1, ai_corr_rating_1,
-                user_content_2, ai_content_2, ai_rating_2, ai_corr_rating_2,
-                user_content_3, ai_content_3, ai_rating_3, ai_corr_rating_3,
-                user_content_4, ai_content_4, ai_rating_4, ai_corr_rating_4, 
-                user_content_5, ai_content_5, ai_rating_5, ai_corr_rating_5,
-                user_content_6, ai_content_6, ai_rating_6, ai_corr_rating_6,
-                user_content_7, ai_content_7, ai_rating_7, ai_corr_rating_7,
-                user_content_8, ai_content_8, ai_rating_8, ai_corr_rating_8,
-                user_content_9, ai_content_9, ai_rating_9, ai_corr_rating_9, 
-                user_content_10, ai_content_10, ai_rating_10, ai_corr_rating_10,
-                user_content_11, ai_content_11, ai_rating_11, ai_corr_rating_11,
-                user_content_12, ai_content_12, ai_rating_12, ai_corr_rating_12,
-                user_content_13, ai_content_13, ai_rating_13, ai_corr_rating_13,
-                user_content_14, ai_content_14, ai_rating_14, ai_corr_rating_14, 
-                user_content_15, ai_content_15, ai_rating_15, ai_corr_rating_15,
-                user_content_16, ai_content_16, ai_rating_16, ai_corr_rating_16,
-                user_content_17, ai_content_17, ai_rating_17, ai_corr_rating_17,
-                user_content_18, ai_content_18, ai_rating_18, ai_corr_rating_18,
-                user_content_19, ai_content_19, ai_rating_19, ai_corr_rating_19,
-                    time_taken],
-                open(os.path.join(model_saving_path, unique_key, "conversation_rating.json"), "w")
-            )
+            save_model_result(session, model_idx, "conversation_rating", {"turns": turns, "time_taken": time_taken})
 
             return [gr.update(visible=False),
                 gr.update(visible=True),
                 gr.update(visible=True)]
 
-        textboxes.append(finish_rating_button)
-
         # Button to terminate the experiment
         termination_button = gr.Button("Terminate the experiment", visible=False)
 
@@ -316,37 +344,19 @@ def pipeline_for_model(
                 termination_button,
             ],
         )
-        textboxes.append(termination_button)
 
         # Button to finish rating
         finish_rating_button.click(
             finish_rating, 
-            [
-                textbox_dict["user_content_0"], textbox_dict["ai_content_0"], textbox_dict["ai_rating_0"], textbox_dict["ai_corr_rating_0"],
-                textbox_dict["user_content_1"], textbox_dict["ai_content_1"], textbox_dict["ai_rating_1"], textbox_dict["ai_corr_rating_1"],
-                textbox_dict["user_content_2"], textbox_dict["ai_content_2"], textbox_dict["ai_rating_2"], textbox_dict["ai_corr_rating_2"],
-                textbox_dict["user_content_3"], textbox_dict["ai_content_3"], textbox_dict["ai_rating_3"], textbox_dict["ai_corr_rating_3"],
-                textbox_dict["user_content_4"], textbox_dict["ai_content_4"], textbox_dict["ai_rating_4"], textbox_dict["ai_corr_rating_4"],
-                textbox_dict["user_content_5"], textbox_dict["ai_content_5"], textbox_dict["ai_rating_5"], textbox_dict["ai_corr_rating_5"],
-                textbox_dict["user_content_6"], textbox_dict["ai_content_6"], textbox_dict["ai_rating_6"], textbox_dict["ai_corr_rating_6"],
-                textbox_dict["user_content_7"], textbox_dict["ai_content_7"], textbox_dict["ai_rating_7"], textbox_dict["ai_corr_rating_7"],
-                textbox_dict["user_content_8"], textbox_dict["ai_content_8"], textbox_dict["ai_rating_8"], textbox_dict["ai_corr_rating_8"],
-                textbox_dict["user_content_9"], textbox_dict["ai_content_9"], textbox_dict["ai_rating_9"], textbox_dict["ai_corr_rating_9"],
-                textbox_dict["user_content_10"], textbox_dict["ai_content_10"], textbox_dict["ai_rating_10"], textbox_dict["ai_corr_rating_10"],
-                textbox_dict["user_content_11"], textbox_dict["ai_content_11"], textbox_dict["ai_rating_11"], textbox_dict["ai_corr_rating_11"],
-                textbox_dict["user_content_12"], textbox_dict["ai_content_12"], textbox_dict["ai_rating_12"], textbox_dict["ai_corr_rating_12"],
-                textbox_dict["user_content_13"], textbox_dict["ai_content_13"], textbox_dict["ai_rating_13"], textbox_dict["ai_corr_rating_13"],
-                textbox_dict["user_content_14"], textbox_dict["ai_content_14"], textbox_dict["ai_rating_14"], textbox_dict["ai_corr_rating_14"],
-                textbox_dict["user_content_15"], textbox_dict["ai_content_15"], textbox_dict["ai_rating_15"], textbox_dict["ai_corr_rating_15"],
-                textbox_dict["user_content_16"], textbox_dict["ai_content_16"], textbox_dict["ai_rating_16"], textbox_dict["ai_corr_rating_16"],
-                textbox_dict["user_content_17"], textbox_dict["ai_content_17"], textbox_dict["ai_rating_17"], textbox_dict["ai_corr_rating_17"],
-                textbox_dict["user_content_18"], textbox_dict["ai_content_18"], textbox_dict["ai_rating_18"], textbox_dict["ai_corr_rating_18"],
-                textbox_dict["user_content_19"], textbox_dict["ai_content_19"], textbox_dict["ai_rating_19"], textbox_dict["ai_corr_rating_19"],
-            ],
+            [session_state, state, ratings_state, ai_rating, ai_corr_rating],
             [fourth_page, fifth_page, done_with_model]
         )
 
-        finished_button.click(next_page, state, textboxes)
+        finished_button.click(
+            next_page,
+            [state, session_state],
+            [rating_page] + rating_boxes + [finish_rating_button, termination_button, ratings_state]
+        )
 
     # Content of the second page, mostly instructions
     # Example question: how confident is the participant in solving the problem solo?
@@ -358,7 +368,7 @@ def pipeline_for_model(
 
         with gr.Box(visible=False) as second_page_problem_row:
             gr.Markdown("##### Rendered Latex")
-            gr.HTML('<div style="background-color: white;">'+current_problem_text.replace('<p>', '<p style="color:black;">')+'</div>')
+            second_page_problem_html = gr.HTML("")
 
 
         instruct_txt = gr.HTML(first_rating_instruct_txt, visible=False)
@@ -373,18 +383,10 @@ def pipeline_for_model(
         second_page_button = gr.Button("Interact with an AI", visible=False)
 
         # A next page burner function to make the current content invisible and the next-page content (chat interface) visible
-        def next_page(solo_solve_ease):
-            # Save the participant's answer to the previous question to a unique path
-            truly_unique_path = os.path.join(model_saving_path, unique_key)
-            if not os.path.exists(truly_unique_path):
-                os.makedirs(truly_unique_path)
-
-            print("path: ", os.path.join(truly_unique_path, "solo_solve.json"))
-
-            json.dump(
-                {"solo_solve": solo_solve_ease}, 
-                open(os.path.join(truly_unique_path, "solo_solve.json"), "w")
-            )
+        @metrics.instrument("next_page_chat")
+        def next_page(solo_solve_ease, session):
+            # Save the participant's answer to the previous question
+            save_model_result(session, model_idx, "solo_solve", {"solo_solve": solo_solve_ease})
 
             return {
                 fourth_page: gr.update(visible=True),
@@ -397,7 +399,7 @@ def pipeline_for_model(
 
         second_page_button.click(
             next_page,
-            [solo_solve],
+            [solo_solve, session_state],
             [
                 fourth_page,
                 second_page_first_line,
@@ -415,11 +417,11 @@ def pipeline_for_model(
         first_page_btn_c = gr.Button("Continue", visible=(not display_info))
 
         # A next page burner function to make the current content invisible and the next-page content (intro and question) visible
-        def next_page():
-            global start_time
-            start_time = time.time()
-            print("start time: ", start_time)
+        @metrics.instrument("next_page_problem")
+        def next_page(session):
+            session["start_times"][model_idx] = time.time()
             return {
+                session_state: session,
                 second_page_first_line: gr.update(visible=True),
                 second_page_problem_row: gr.update(visible=True),
                 # second_page_last_lines: gr.update(visible=True),
@@ -432,8 +434,9 @@ def pipeline_for_model(
 
         first_page_btn_c.click(
             next_page,
-            [],
+            [session_state],
             [
+                session_state,
                 second_page_first_line,
                 second_page_problem_row,
                 second_page_button,
@@ -444,20 +447,57 @@ def pipeline_for_model(
             ],
         )
 
-# Function to display a single problem
-def a_single_problem(problem_statement, model_order, display_info=False, is_visible=False, problem_set_index=0, saving_dir="/home/qj213/new_save"):
-    # problem_set_index maps to the original problem indexes
-    block_problems = problem_sets[problem_set_index] 
-    problem_path = os.path.join(saving_dir, f"problem_set_index_{problem_set_index}")
-    fixed_model_order = [model for model in model_order]
-    # Randomise model order to avoid bias in order preference
-    random.shuffle(fixed_model_order)
+    # Everything that has to be reset (and filled with the new problem and model) when a new problem set is shown
+    fill_outputs = [
+        fifth_page, done_with_model, fourth_page, problem_html_txt, chatbot, state, model_state, txt,
+        markdown_visualiser, submit_button, finished_button, finish_rating_button, termination_button,
+        second_page_first_line, second_page_problem_row, second_page_problem_html, instruct_txt, solo_solve,
+        second_page_button, first_page_wellcome_html, first_page_btn_c, rating_page, ratings_state,
+    ] + rating_boxes
+
+    def fill_updates(block):
+        current_problem_text = problem_texts[block["problem_indices"][model_idx]]["text"]
+        return [
+            gr.update(visible=False),  # fifth_page
+            gr.update(visible=False),  # done_with_model
+            gr.update(visible=False),  # fourth_page
+            gr.update(
+                value='As a reminder, the problem is: <p></p>' + problem_html(current_problem_text) + '<p></p>Note, the problem is NOT automatically provided to the model. You will need to provide it, or part of the problem, as desired. You can copy and paste from the problem above. You can optionally render your text in markdown before entering by pressing the --> button (note: the set of LaTeX symbols is restricted). <p></p>After many interactions, you may also need to SCROLL to see new model generations.',
+                visible=True
+            ),  # problem_html_txt
+            gr.update(value=initial_conversation.pairs(), visible=True),  # chatbot
+            copy.deepcopy(initial_conversation),  # state
+            block["model_order"][model_idx],  # model_state
+            gr.update(value="", visible=True),  # txt
+            gr.update(value="Markdown preview"),  # markdown_visualiser
+            gr.update(visible=True),  # submit_button
+            gr.update(visible=True),  # finished_button
+            gr.update(visible=False),  # finish_rating_button
+            gr.update(visible=False),  # termination_button
+            gr.update(visible=False),  # second_page_first_line
+            gr.update(visible=False),  # second_page_problem_row
+            gr.update(value=problem_html(current_problem_text)),  # second_page_problem_html
+            gr.update(visible=False),  # instruct_txt
+            gr.update(value=None, visible=False),  # solo_solve
+            gr.update(visible=False),  # second_page_button
+            gr.update(visible=(not display_info)),  # first_page_wellcome_html
+            gr.update(visible=(not display_info)),  # first_page_btn_c
+            gr.update(visible=False),  # rating_page
+            None,  # ratings_state
+        ] + [gr.update(value=None) for _ in rating_boxes]
+
+    return fill_outputs, fill_updates
+
+# Function to display the problem block
+def a_single_problem(session_state, display_info=False, is_visible=False):
+    fill_outputs = []
+    model_fill_updates = []
     with gr.Column(visible=is_visible) as single_problem_block:
-        # random.shuffle(model_order) # shuffle for each problem
-        for i, model_name in enumerate(fixed_model_order):
+        for i in range(len(model_order)):
             with gr.Tab(f"Model {i+1}"):
-                pipeline_for_model(model_name, display_info=(display_info and i == 0), problem_index=block_problems[i], model_idx=i,
-                                   saving_path=problem_path)
+                outputs, updates = pipeline_for_model(session_state, display_info=(display_info and i == 0), model_idx=i)
+                fill_outputs.extend(outputs)
+                model_fill_updates.append(updates)
 
         with gr.Tab("Final preference"):
             with gr.Row(visible=False) as model_row:
@@ -474,19 +514,18 @@ def a_single_problem(problem_statement, model_order, display_info=False, is_visi
 
                 finish_button = gr.Button("Finish comparing different models")
 
-                def save_model_rank(rank1, rank2, rank3):
+                def save_model_rank(session, rank1, rank2, rank3):
+                    block = session["block"]
                     model_ranks = {}
-                    for model_name, model_rank in zip(fixed_model_order, [rank1, rank2, rank3]):
+                    for model_name, model_rank in zip(block["model_order"], [rank1, rank2, rank3]):
                         model_ranks[model_name] = model_rank
-                    model_ranks["model_presentation_order"] = fixed_model_order
-                    truly_unique_path = os.path.join(problem_path, unique_key)
-                    if not os.path.exists(truly_unique_path):
-                        os.makedirs(truly_unique_path)
-                    json.dump(model_ranks, open(os.path.join(truly_unique_path, "model_ranks.json"), "w"))
+                    model_ranks["model_presentation_order"] = block["model_order"]
+                    result_store.write(session["unique_key"], "model_ranks", model_ranks,
+                                       problem_set_index=block["problem_set_index"])
 
                     return [gr.update(visible=False), gr.update(visible=True)]
                 global next_button
-                finish_button.click(save_model_rank, [model_1_rank, model_2_rank, model_3_rank], [finish_button, next_button])
+                finish_button.click(save_model_rank, [session_state, model_1_rank, model_2_rank, model_3_rank], [finish_button, next_button])
 
             compare_instruct = gr.HTML("You will now rate which model(s) you prefer as a mathematical assistant. 1 = best, 3 = worst. You can assign the same rating if you think two (or more) models tied." + 
                                        "<p></p>Only continue once you have pressed Done Interaction with ALL 3 models, <strong>otherwise there will be an error.</strong>")
@@ -495,22 +534,21 @@ def a_single_problem(problem_statement, model_order, display_info=False, is_visi
 
             # Display the interaction history for each of the model-problem pairs
             # Display a warning message if the user did not interact with a particular problem
-            def compare_models():
+            def compare_models(session):
+                block = session["block"]
                 model_content = []
-                for model in fixed_model_order:
-                    model_path = os.path.join(saving_dir, f"problem_set_index_{problem_set_index}", model)
-                    conversation_path = os.path.join(model_path, unique_key, "conversation_rating.json")
-                    if not os.path.exists(conversation_path): 
-                        print(conversation_path)
-                        print("missing conversation history!!!")
+                for model_name in block["model_order"]:
+                    conversation = result_store.latest(
+                        "conversation_rating", session["unique_key"], block["problem_set_index"], model_name
+                    )
+                    if conversation is None: 
+                        print("missing conversation history!!!", session["unique_key"], block["problem_set_index"], model_name)
                         total_html = f'<p style="text-align:center">MISSING</p>'
                         model_content.append(total_html)
                     else: 
-                        conversation = json.load(open(conversation_path))
-                        total_html = ""
-                        for content in conversation:
-                            if isinstance(content, str) and (content.startswith("User") or content.startswith("AI")):
-                                total_html = total_html + f"{content}<br>"
+                        total_html = "".join(
+                            f"{user}<br>{ai}<br>" for user, ai in Conversation.from_rated_turns(conversation["turns"]).pairs()
+                        )
                         total_html = f'<p style="text-align:center">{total_html}</p>'
                         model_content.append(total_html)
 
@@ -529,46 +567,60 @@ def a_single_problem(problem_statement, model_order, display_info=False, is_visi
 
             start_button.click(
                 compare_models,
-                [],
+                [session_state],
                 [model_row, model_1_all, model_2_all, model_3_all, start_button,compare_instruct, final_rating, model_1_rank, model_2_rank, model_3_rank]
             )
 
-    return single_problem_block
+    fill_outputs.extend([
+        model_row, model_1_all, model_2_all, model_3_all, final_rating, model_1_rank, model_2_rank, model_3_rank,
+        finish_button, compare_instruct, start_button,
+    ])
+
+    def fill_updates(block):
+        """Updates of fill_outputs to show the problem set of block from the start"""
+        updates = []
+        for model_updates in model_fill_updates:
+            updates.extend(model_updates(block))
+        updates.extend([
+            gr.update(visible=False),  # model_row
+            gr.update(value=""),  # model_1_all
+            gr.update(value=""),  # model_2_all
+            gr.update(value=""),  # model_3_all
+            gr.update(visible=False),  # final_rating
+            gr.update(value=None),  # model_1_rank
+            gr.update(value=None),  # model_2_rank
+            gr.update(value=None),  # model_3_rank
+            gr.update(visible=True),  # finish_button
+            gr.update(visible=True),  # compare_instruct
+            gr.update(visible=True),  # start_button
+        ])
+        return updates
+
+    def no_updates():
+        return [gr.update() for _ in fill_outputs]
+
+    return single_problem_block, fill_outputs, fill_updates, no_updates
 
 # Goes to a different batch of 3 (can be altered) problems
 next_button = gr.Button("Go to the next batch of problems", visible=False)
 with gr.Blocks(css="#warning {max-width: 2.5em;}") as demo:
-    global mth_bkgrd, ai_play_bkgrd
-
-    mth_bkgrd=""
-    ai_play_bkgrd = ""
+    # Per participant state, see new_session
+    session_state = gr.State(new_session())
 
-    problem_set_index = 0
     exp_start_button = gr.Button("Start evaluating!", visible=False)
 
-    # TODO: Saving directory, should be altered by the survey designer
-    if "collins" in cwd: 
-        unique_saving_path = os.path.join(f"/Users/kcollins/new_save")
-    else: 
-        unique_saving_path = os.path.join("/home/qj213/new_save")
-
-    if not os.path.exists(unique_saving_path):
-        os.makedirs(unique_saving_path)
-
     # Save survey information about participant background
     # In the prototype, the maths background, experience with ai, and selected topic are asked
-    def save_survey_info(mth_bkgrd, ai_play_bkgrd, topic_sels): 
-        truly_unique_path = os.path.join(unique_saving_path, unique_key)
-        if not os.path.isdir(truly_unique_path):
-            os.makedirs(truly_unique_path)
-        json.dump(
-                {"mth_bkgrd": mth_bkgrd, "ai_play_bkgrd": ai_play_bkgrd, "selected_topic": topic_sels},
-                open(os.path.join(truly_unique_path, "user_survey_metadata.json"), "w")
-            )
+    def save_survey_info(unique_key, mth_bkgrd, ai_play_bkgrd, topic_sels):
+        result_store.write(
+            unique_key, "user_survey_metadata",
+            {"mth_bkgrd": mth_bkgrd, "ai_play_bkgrd": ai_play_bkgrd, "selected_topic": topic_sels},
+        )
         
-    boxes = []
-    for i in range(num_problems_show):
-        boxes.append(a_single_problem(None, model_order, display_info=False, is_visible=False, problem_set_index=i, saving_dir=unique_saving_path))
+    # A single problem block, refilled for every set of problems
+    problem_block, block_fill_outputs, block_fill_updates, block_no_updates = a_single_problem(
+        session_state, display_info=False, is_visible=False
+    )
 
     with gr.Column() as experience_rating_page:
         experience_rating_html = gr.HTML(
@@ -595,67 +647,68 @@ with gr.Blocks(css="#warning {max-width: 2.5em;}") as demo:
         experience_page_btn_c = gr.Button("Continue", visible=False)
 
         # A next page burner function to make the current content invisible and the next-page content (survey starting) visible
-        def next_page(maths_bkgrd_experience, ai_interact_experience, topic_selections):
+        @metrics.instrument("next_page_survey")
+        def next_page(maths_bkgrd_experience, ai_interact_experience, topic_selections, session):
             if (not maths_bkgrd_experience.strip()) or (not ai_interact_experience.strip()) or (not topic_selections.strip()):
-                return [gr.update(visible=True) for _ in range(6)] +  [gr.update(visible=False) for _ in range(num_problems_show)]
+                return [gr.update(visible=True) for _ in range(6)] + [gr.update(visible=False), session] + block_no_updates()
 
-            global unique_key
-            unique_key = str(uuid.uuid4())
+            session["unique_key"] = str(uuid.uuid4())
             
-            save_survey_info(maths_bkgrd_experience, ai_interact_experience, topic_selections)
+            save_survey_info(session["unique_key"], maths_bkgrd_experience, ai_interact_experience, topic_selections)
             
-            global poss_problems
             print("choice: ", topic_selections)
-            poss_problems = problem_sets_per_topic[topic_selections] # maps to the indices of sets of 3 problems avail
+            # maps to the indices of sets of 3 problems avail; copied, so shuffling does not affect other sessions
+            poss_problems = list(problem_sets_per_topic[topic_selections])
             print("poss problems: ", poss_problems)
 
             random.shuffle(poss_problems)
 
-            # make sure that we save out the indices that the participant saw. that way we know the ordering they evaluated in.
-            json.dump(
-                {"problem_order": [int(x) for x in poss_problems]}, # convert b/c of weird numpy saving
-                open(os.path.join(unique_saving_path, unique_key, "problem_ordering.json"), "w")
+            # make sure that we save out the indices that the participant saw. that way we know the ordering they evaluated in.
+            result_store.write(
+                session["unique_key"], "problem_ordering",
+                {"problem_order": [int(x) for x in poss_problems]}, # convert b/c of weird numpy saving
             )
 
-            global problem_set_index
-            problem_set_index = 0
-            updated_boxes = [
-                gr.update(visible=True) if i == poss_problems[0] else gr.update(visible=False) for i in range(num_problems_show)
-            ]
-            final_output = [gr.update(visible=False) for _ in range(6)] + updated_boxes
+            session["poss_problems"] = poss_problems
+            session["problem_set_index"] = 0
+            session["start_times"] = {}
+            session["block"] = assign_problem_set(poss_problems[0])
+            final_output = [gr.update(visible=False) for _ in range(6)] + [gr.update(visible=True), session] \
+                + block_fill_updates(session["block"])
             return final_output
         
         experience_page_btn_c.click(
             next_page,
-            [maths_bkgrd_experience, ai_interact_experience, topic_selections],
-            [experience_rating_html, experience_page_btn_c, topic_selections, maths_bkgrd_experience, ai_interact_experience, warning_message] + boxes
+            [maths_bkgrd_experience, ai_interact_experience, topic_selections, session_state],
+            [experience_rating_html, experience_page_btn_c, topic_selections, maths_bkgrd_experience, ai_interact_experience, warning_message]
+            + [problem_block, session_state] + block_fill_outputs
         )
 
     # Content of the initial instruction pages
-    global instruct_idx
     with gr.Column() as instruct_pgs: 
-        instruct_idx = 0
-        instruction_html = gr.HTML(instruction_pages[instruct_idx])
+        instruction_html = gr.HTML(instruction_pages[0])
         instruction_btn_c = gr.Button("Continue")
 
         instruction_map = {idx: gr.HTML(instruction_page, visible=False) for idx, instruction_page in enumerate(instruction_pages)}
 
-        def update_instruction(): 
-            global instruct_idx
-            instruct_idx += 1
-            if instruct_idx < len(instruction_pages):
+        @metrics.instrument("next_page_instructions")
+        def update_instruction(session):
+            session["instruct_idx"] += 1
+            if session["instruct_idx"] < len(instruction_pages):
                 return {
+                session_state: session,
                 experience_rating_html: gr.update(visible=False), 
                     experience_page_btn_c: gr.update(visible=False),
                     maths_bkgrd_experience: gr.update(visible=False), 
                     ai_interact_experience: gr.update(visible=False),
-                    instruction_html: gr.update(value = instruction_pages[instruct_idx], visible=True),
+                    instruction_html: gr.update(value = instruction_pages[session["instruct_idx"]], visible=True),
                     instruction_btn_c: gr.update(visible=True),
                     topic_selections: gr.update(visible=False)
                 } # not on next page yet
             else: 
-                instruct_idx = 0
+                session["instruct_idx"] = 0
                 return {
+                session_state: session,
                 experience_rating_html: gr.update(visible=True), 
                     experience_page_btn_c: gr.update(visible=True),
                     maths_bkgrd_experience: gr.update(visible=True), 
@@ -667,8 +720,8 @@ with gr.Blocks(css="#warning {max-width: 2.5em;}") as demo:
             
         instruction_btn_c.click(
             update_instruction,
-            [],
-            [experience_rating_html, experience_page_btn_c, maths_bkgrd_experience, ai_interact_experience, instruction_html, instruction_btn_c, topic_selections]   
+            [session_state],
+            [session_state, experience_rating_html, experience_page_btn_c, maths_bkgrd_experience, ai_interact_experience, instruction_html, instruction_btn_c, topic_selections]   
         )
 
     next_button.render()
@@ -676,32 +729,39 @@ with gr.Blocks(css="#warning {max-width: 2.5em;}") as demo:
     # Last page
     finish_page = gr.HTML("Thank you for participating in our study!", visible=False)
 
-    def click():
-        global problem_set_index
+    @metrics.instrument("next_batch")
+    def click(session):
+        poss_problems = session["poss_problems"]
 
-        # save out preferences for the current problem
-        json.dump(
-                {"prefence_data": []}, # convert b/c of weird numpy saving
-                 open(os.path.join(unique_saving_path, unique_key, f"final_preferences_{problem_set_index}.json"), "w")
-            )
+        # save out preferences for the current problem
+        result_store.write(
+            session["unique_key"], "final_preferences", {"prefence_data": []},
+            problem_set_index=session["block"]["problem_set_index"],
+        )
 
-        problem_set_index += 1
+        session["problem_set_index"] += 1
+        problem_set_index = session["problem_set_index"]
 
         # If this is the last batch of problems
         if problem_set_index >= len(poss_problems):
-            return [gr.update(visible=True), gr.update(visible=False)] + [gr.update(visible=False) for _ in range(num_problems_show)]
+            return [gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), session] + block_no_updates()
         
         print("problems: ", poss_problems, poss_problems[problem_set_index])
-        updated_boxes = [
-            gr.update(visible=True) if poss_problems[problem_set_index]==i else gr.update(visible=False) for i in range(num_problems_show)
-        ]
+        session["block"] = assign_problem_set(poss_problems[problem_set_index])
+        session["start_times"] = {}
 
         if problem_set_index == len(poss_problems) - 1: 
             value = "Finish evaluating!"
         else:
             value = "Go to the next batch of problems"
-        return [gr.update(visible=False), gr.update(visible=False, value=value)] + updated_boxes
-    next_button.click(click, inputs=[], outputs=[finish_page, next_button] + boxes)
+        return [gr.update(visible=False), gr.update(visible=False, value=value), gr.update(visible=True), session] \
+            + block_fill_updates(session["block"])
+    next_button.click(click, inputs=[session_state], outputs=[finish_page, next_button, problem_block, session_state] + block_fill_outputs)
+
+# Every participant has their own session state, so events of different sessions can run concurrently
+demo.queue(concurrency_count=QUEUE_CONCURRENCY_COUNT)
 
-demo.queue()
-demo.launch(share=True)
+if __name__ == "__main__":
+    start_metrics_server()
+    start_metrics_dump()
+    demo.launch(share=True)
@@ -0,0 +1,95 @@
+"""
+A model backend that generates the replies in process, for running the studies and load tests offline.
+
+It has the API of the HTTP backend (model_backend.AsyncModelBackend), with the same event loop, concurrency limits,
+rate limiter and resilience around every request, but instead of calling a server it answers with the deterministic
+replies of the mock server (mock_openai_server.py), after a first-token latency and at a speed drawn for each
+request. The draws are seeded by the request, so the same request always takes the same time; the simulated time
+is spent sleeping on the backend loop, so thousands of requests can wait at once without using the CPU.
+Select it with MODEL_BACKEND = "local" in constants.py, or $MODEL_BACKEND=local.
+"""
+import asyncio
+import json
+import random
+
+from constants import LOCAL_FIRST_TOKEN_LATENCY, LOCAL_TOKENS_PER_SECOND, LOCAL_REPLY_TOKENS, LOCAL_BACKEND_SEED
+from mock_openai_server import Distribution, mock_reply, prompt_length, reply_length, sample_timing
+from model_backend import AsyncModelBackend
+from rate_limiter import RateLimiter
+
+
+class LocalModelBackend(AsyncModelBackend):
+    def __init__(
+        self,
+        first_token_latency=LOCAL_FIRST_TOKEN_LATENCY,
+        tokens_per_second=LOCAL_TOKENS_PER_SECOND,
+        reply_tokens=LOCAL_REPLY_TOKENS,
+        prompt_tokens_per_second=0.,
+        seed=LOCAL_BACKEND_SEED,
+        **options
+    ):
+        """
+        :param first_token_latency: seconds before the first token (or whole reply), a number or a Distribution
+        :param tokens_per_second: generation speed, 0 for as fast as possible, a number or a Distribution
+        :param reply_tokens: number of tokens per reply, capped by the request's max_tokens
+        :param prompt_tokens_per_second: speed of reading the prompt, which delays the first token; 0 for no delay
+        :param seed: of the draws of the latencies and speeds
+        :param options: of AsyncModelBackend (concurrency_limits, resilience...); there are no rate limits by default
+        """
+        options.setdefault("rate_limiter", RateLimiter({}))
+        super().__init__(api_base="local", **options)
+        self.config = {
+            "first_token_latency": Distribution.parse(first_token_latency),
+            "tokens_per_second": Distribution.parse(tokens_per_second),
+            "reply_tokens": reply_tokens,
+            "prompt_tokens_per_second": prompt_tokens_per_second,
+        }
+        self.seed = seed
+        self.hits = 0  # requests answered, retries included, like mock_openai_server's
+
+    def _generate(self, endpoint, payload):
+        """The reply pieces of a request, the seconds before the first one and between two of them"""
+        self.hits += 1
+        # The draws do not depend on whether the usage of a stream was asked for
+        request = {key: value for key, value in payload.items() if key != "stream_options"}
+        rng = random.Random(f"{self.seed}:{endpoint}:{json.dumps(request, sort_keys=True)}")
+        first_token, per_token = sample_timing(self.config, rng, prompt_length(payload))
+        seed_text = payload["messages"] if endpoint == "chat/completions" else payload.get("prompt", "")
+        return mock_reply(seed_text, reply_length(payload, self.config["reply_tokens"])), first_token, per_token
+
+    @staticmethod
+    def _usage(payload, pieces):
+        # Counted like the mock server does
+        return {"prompt_tokens": prompt_length(payload), "completion_tokens": len(pieces),
+                "total_tokens": prompt_length(payload) + len(pieces)}
+
+    async def _post_once(self, endpoint, payload, tokens, participant):
+        await self.rate_limiter.acquire(payload["model"], tokens, participant)
+        async with self.semaphore(payload["model"]):
+            pieces, first_token, per_token = self._generate(endpoint, payload)
+            await asyncio.sleep(first_token + per_token * len(pieces))
+        text = "".join(pieces)
+        if endpoint == "chat/completions":
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+        else:
+            choice = {"index": 0, "text": text, "finish_reason": "stop"}
+        return {"model": payload["model"], "choices": [choice], "usage": self._usage(payload, pieces)}
+
+    async def _post_stream_once(self, endpoint, payload, extract, tokens, participant):
+        await self.rate_limiter.acquire(payload["model"], tokens, participant)
+        async with self.semaphore(payload["model"]):
+            pieces, first_token, per_token = self._generate(endpoint, payload)
+            await asyncio.sleep(first_token)
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(per_token)
+                # Through extract, like the events of the HTTP API
+                if endpoint == "chat/completions":
+                    yield extract({"choices": [{"index": 0, "delta": {"content": piece}}]})
+                else:
+                    yield extract({"choices": [{"index": 0, "text": piece}]})
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                extract({"choices": [], "usage": self._usage(payload, pieces)})
+
+    def close(self):
+        pass
@@ -0,0 +1,169 @@
+"""
+Preview of the markdown and LaTeX that participants type before sending it to a model.
+
+The text is rendered to HTML once, on the server, with the markdown-it parser gr.Markdown uses (dollar math,
+footnotes, tables, linkified urls and typographic quotes), except that the HTML is sanitised: raw HTML in the text is
+escaped rather than passed through, formulas are escaped where they are written into the page, and equation labels are
+reduced to word characters.
+Formulas are drawn as SVG by matplotlib's mathtext, the LaTeX subset the preview always supported, without pyplot,
+which is imported only for the first formula.
+
+Previews are memoised by the hash of their text, and drawn formulas by their source, each least recently used beyond
+its maximum number of entries: a participant typing a long message only draws the formula they are editing.
+"""
+import collections
+import hashlib
+import html
+import inspect
+import io
+import re
+import threading
+
+from markdown_it import MarkdownIt
+from mdit_py_plugins.dollarmath import dollarmath_plugin
+from mdit_py_plugins.footnote import footnote_plugin
+
+from constants import MARKDOWN_PREVIEW_CACHE_SIZE, MARKDOWN_PREVIEW_FORMULA_CACHE_SIZE
+from metrics import metrics
+
+FONT_SIZE = 20  # points, of the drawn formulas, which are scaled to the size of the text (1em)
+
+
+class LRU:
+    """Values by key, the least recently used evicted beyond max_entries; get and put are thread safe"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        hit_rate = self.counters["hits"] / lookups if lookups else 0.
+        return dict(self.counters, entries=len(self.entries), hit_rate=hit_rate)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+unsafe_label = re.compile(r"[^\w-]+")
+svg_metadata = re.compile(r"<metadata>.*</metadata>", re.DOTALL)
+svg_width = re.compile(r' width="[^"]+"')
+svg_height = re.compile(r' height="([\d.]+)pt"')
+
+
+class MarkdownPreview:
+    def __init__(self, max_entries=1000, formula_entries=5000):
+        """
+        :param max_entries: rendered previews kept in memory
+        :param formula_entries: drawn formulas kept in memory
+        """
+        self.previews = LRU(max_entries)
+        self.formulas = LRU(formula_entries)
+        self.counters = {"formula_errors": 0}
+        # mathtext and the figures it draws on are not thread safe
+        self._math_lock = threading.Lock()
+        self.md = (
+            MarkdownIt("js-default", {"linkify": True, "typographer": True, "html": False, "breaks": True})
+            .use(dollarmath_plugin, renderer=self.formula, label_normalizer=self.equation_label, allow_digits=False)
+            .use(footnote_plugin)
+            .enable("table")
+        )
+        self.md.add_render_rule("link_open", self._link_open)
+
+    @staticmethod
+    def _link_open(renderer, tokens, idx, options, env):
+        # Links open in a new tab, without giving it access to the study's page
+        tokens[idx].attrSet("target", "_blank")
+        tokens[idx].attrSet("rel", "noopener noreferrer")
+        return renderer.renderToken(tokens, idx, options, env)
+
+    @staticmethod
+    def equation_label(label):
+        """The id of an equation labelled e.g. $$...$$ (eq 1), written as is into the page"""
+        return unsafe_label.sub("-", label)
+
+    def draw(self, formula):
+        """The SVG of a formula drawn by mathtext, sized in em; raises ValueError if mathtext cannot parse it"""
+        from matplotlib import rc_context
+        from matplotlib.font_manager import FontProperties
+        from matplotlib.mathtext import math_to_image
+
+        output = io.StringIO()
+        with self._math_lock, rc_context({"mathtext.fontset": "cm"}):
+            depth = math_to_image(f"${formula}$", output, prop=FontProperties(size=FONT_SIZE), format="svg")
+        svg = output.getvalue()
+        svg = svg_metadata.sub("", svg[svg.index("<svg "):])
+        svg = svg_width.sub("", svg, count=1)
+        svg = svg_height.sub(lambda match: f' height="{float(match.group(1)) / FONT_SIZE:.3f}em"', svg, count=1)
+        # Sit on the baseline of the text around it
+        return svg.replace("<svg ", f'<svg style="vertical-align: {-depth / FONT_SIZE:.3f}em" ', 1)
+
+    def formula(self, formula, options=None):
+        """
+        The HTML of a formula, drawn once, with its source hidden beside it for copying; a formula mathtext cannot
+        draw is shown as its source, with the error as its title
+        """
+        svg = self.formulas.get(formula)
+        if svg is None:
+            try:
+                svg = self.draw(formula)
+            except ValueError as e:
+                self.counters["formula_errors"] += 1
+                return f'<code class="math-error" title="{html.escape(str(e))}">${html.escape(formula)}$</code>'
+            self.formulas.put(formula, svg)
+        return f"<span style='font-size: 0px'>{html.escape(formula)}</span>{svg}"
+
+    def render(self, text):
+        """The sanitised HTML of markdown text, rendered once for every distinct text"""
+        if not text:
+            return ""
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        rendered = self.previews.get(key)
+        if rendered is None:
+            # gr.Markdown unindents the text the same way
+            rendered = self.md.render(inspect.cleandoc(text))
+            self.previews.put(key, rendered)
+        return rendered
+
+    def stats(self):
+        stats = dict(self.counters)
+        for name, cache in [("preview", self.previews), ("formula", self.formulas)]:
+            stats.update({f"{name}_{key}": value for key, value in cache.stats().items()})
+        return stats
+
+    def clear(self):
+        self.previews.clear()
+        self.formulas.clear()
+
+
+markdown_preview = MarkdownPreview(MARKDOWN_PREVIEW_CACHE_SIZE, MARKDOWN_PREVIEW_FORMULA_CACHE_SIZE)
+
+
+def preview_metrics():
+    """Gauges of the caches of the markdown preview"""
+    for key, value in markdown_preview.stats().items():
+        yield f"markdown_preview_{key}", {}, value
+
+
+metrics.add_collector(preview_metrics)
@@ -0,0 +1,309 @@
+"""
+In-process metrics of the hot paths of the studies: how long the model calls, the prompt building, the page handlers,
+the saves and the markdown preview take, and counters of the requests, tokens, cache hits and errors.
+
+Functions are timed with metrics.instrument(name), which keeps them the same kind of function (plain, coroutine,
+generator or async generator, as gradio looks at it); generators also record the time to their first item.
+Observing a value takes a lock and a bisect on the buckets of a histogram, a few microseconds at most.
+Other components report their own statistics through collectors (metrics.add_collector), read when the metrics are.
+
+The metrics are served in the Prometheus text format (start_metrics_server) and appended as JSON lines to a file
+every few seconds (start_metrics_dump).
+"""
+import bisect
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from constants import METRICS_ENABLED, METRICS_PORT, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is above the largest bucket
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated within its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, prefix="checkmate_", enabled=True):
+        """
+        :param prefix: of the names of the metrics
+        :param enabled: if False the instrumented functions are not timed (the counters still count)
+        """
+        self.prefix = prefix
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """:param collector: called when the metrics are read, yields (name, labels, value) of gauges"""
+        self.collectors.append(collector)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    # Timing of functions
+
+    def _done(self, name, start):
+        self.observe("call_seconds", time.perf_counter() - start, call=name)
+
+    def _first(self, name, start):
+        self.observe("first_item_seconds", time.perf_counter() - start, call=name)
+
+    def _failed(self, name, error):
+        self.inc("call_errors_total", call=name, error=type(error).__name__)
+
+    def instrument(self, name):
+        """Decorator recording the duration (and errors) of every call of a function as call_seconds{call=name}"""
+        def decorate(function):
+            if inspect.isasyncgenfunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    items = function(*args, **kwargs)
+                    if not self.enabled:
+                        async for item in items:
+                            yield item
+                        return
+                    start, first = time.perf_counter(), True
+                    try:
+                        async for item in items:
+                            if first:
+                                self._first(name, start)
+                                first = False
+                            yield item
+                    except Exception as e:
+                        self._failed(name, e)
+                        raise
+                    finally:
+                        await items.aclose()
+                        self._done(name, start)
+            elif inspect.isgeneratorfunction(function):
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return (yield from function(*args, **kwargs))
+                    start = time.perf_counter()
+                    items = function(*args, **kwargs)
+                    try:
+                        first = next(items)
+                        self._first(name, start)
+                        yield first
+                        return (yield from items)
+                    except StopIteration as stop:
+                        return stop.value
+                    except Exception as e:
+                        self._failed(name, e)
+                        raise
+                    finally:
+                        items.close()
+                        self._done(name, start)
+            elif inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    except Exception as e:
+                        self._failed(name, e)
+                        raise
+                    finally:
+                        self._done(name, start)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return function(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return function(*args, **kwargs)
+                    except Exception as e:
+                        self._failed(name, e)
+                        raise
+                    finally:
+                        self._done(name, start)
+            return wrapper
+        return decorate
+
+    # Reading
+
+    def _gauges(self):
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    if isinstance(value, (int, float)):
+                        gauges[_key(name, labels)] = float(value)
+            except Exception as e:
+                print(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+        return gauges
+
+    def _copy(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                copy = histograms[key] = Histogram(histogram.buckets)
+                copy.counts, copy.count, copy.sum = list(histogram.counts), histogram.count, histogram.sum
+        return counters, histograms
+
+    def snapshot(self):
+        """Every metric, as a json serialisable dict; the histograms are summarised by estimated quantiles"""
+        counters, histograms = self._copy()
+        return {
+            "time": time.time(),
+            "counters": {_series(self.prefix + name, labels): value for (name, labels), value in counters.items()},
+            "histograms": {
+                _series(self.prefix + name, labels): {
+                    "count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                } for (name, labels), h in histograms.items()
+            },
+            "gauges": {_series(self.prefix + name, labels): value for (name, labels), value in self._gauges().items()},
+        }
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format"""
+        counters, histograms = self._copy()
+        lines, families = [], set()
+
+        def family(name, kind):
+            if name not in families:
+                families.add(name)
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            family(name, "counter")
+            lines.append(f"{_series(self.prefix + name, labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            family(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{_series(self.prefix + name + '_bucket', labels + (('le', le),))} {cumulative}")
+            lines.append(f"{_series(self.prefix + name + '_sum', labels)} {histogram.sum}")
+            lines.append(f"{_series(self.prefix + name + '_count', labels)} {histogram.count}")
+        for (name, labels), value in sorted(self._gauges().items()):
+            family(name, "gauge")
+            lines.append(f"{_series(self.prefix + name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of the process
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1", registry=metrics):
+    """
+    Serve the metrics at http://host:port/metrics, from a daemon thread
+    :return: the running server, or None if port is None or taken
+    """
+    if port is None:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"Metrics not served on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    server.metrics = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_metrics_dump(path=METRICS_DUMP_PATH, interval=METRICS_DUMP_INTERVAL, registry=metrics):
+    """
+    Append a snapshot of the metrics to the JSON lines file at path every interval seconds, from a daemon thread
+    :return: an Event to set to stop the dumps, or None if path is None
+    """
+    if path is None:
+        return None
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                with open(path, "a") as f:
+                    f.write(json.dumps(registry.snapshot()) + "\n")
+            except OSError as e:
+                print(f"Metrics not dumped to {path}: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+    return stopped
@@ -4,8 +4,16 @@ import os
 import numpy as np
 import time
 import random
+import re
 import uuid
-from openai import OpenAI
+
+from constants import QUEUE_CONCURRENCY_COUNT, RESULT_STORE_FILENAME, RESULT_STORE_BATCH_SIZE, \
+    RESULT_STORE_FLUSH_INTERVAL, RESULT_STORE_COMMIT_RETRIES, RESULT_STORE_READ_TIMEOUT
+from metrics import metrics, start_metrics_server, start_metrics_dump
+from result_store import ResultStore
+from data.data_utils.corpus_bundle import bundled_directory
+from model_backend import shared_backend
+from resilience import CircuitOpen, ModelBackendError
 
 # ============================================
 # OPENAI API CONFIGURATION
@@ -13,13 +21,18 @@ from openai import OpenAI
 # TODO: Replace "your-openai-api-key-here" with your actual OpenAI API key
 OPENAI_API_KEY = "your-openai-api-key-here"
 
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# All model calls go through the shared async backend (one keep-alive connection pool for every participant)
+shared_backend.api_key = OPENAI_API_KEY
 
 
 # Simple function to load problems (replaces the custom load_problems)
 def load_problems_simple(problems_dir):
-    """Simple version that loads HTML files from directory"""
+    """Simple version that loads HTML files from directory (or from the corpus bundle when it is up to date)"""
+    bundled = bundled_directory(problems_dir)
+    if bundled is not None:
+        return [{"id": idx, "text": bundled[problem_file], "filename": problem_file}
+                for idx, problem_file in enumerate(f for f in bundled if f.endswith('.html'))]
+
     problems = []
 
     # Get absolute path for debugging
@@ -65,19 +78,13 @@ def load_problems_simple(problems_dir):
     return problems
 
 
-# Neura AI chatbot function using OpenAI API
-def neura_chatbot(message, history, current_case_text):
-    """Neura chatbot that uses OpenAI GPT for intelligent responses"""
-
-    if not message.strip():
-        return history, ""
-
-    try:
-        # Build conversation history for OpenAI API
-        messages = [
-            {
-                "role": "system",
-                "content": f"""You are Neura, an expert neurology AI assistant helping medical students analyze neurological cases. Your role is to guide students through systematic thinking about neurological problems without giving direct answers.
+@metrics.instrument("build_neura_messages")
+def build_neura_messages(message, history, current_case_text):
+    """Build the OpenAI chat messages for Neura: system prompt with the case, previous chat, newest message"""
+    messages = [
+        {
+            "role": "system",
+            "content": f"""You are Neura, an expert neurology AI assistant helping medical students analyze neurological cases. Your role is to guide students through systematic thinking about neurological problems without giving direct answers.
 
 CURRENT CASE BEING ANALYZED:
 {current_case_text}
@@ -92,30 +99,57 @@ GUIDELINES:
 - Use medical terminology appropriately but explain complex concepts
 
 Remember: You're helping them learn to think like neurologists, not just giving them answers."""
-            }
-        ]
+        }
+    ]
+
+    # Add previous conversation history
+    for chat in history:
+        messages.append({
+            "role": chat["role"],
+            "content": chat["content"]
+        })
+
+    # Add current user message
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+# Sampling parameters shared by the blocking and the streaming Neura chatbots
+NEURA_MODEL = "gpt-4"  # You can change to "gpt-3.5-turbo" for faster/cheaper responses
+NEURA_SAMPLING_PARAMS = {
+    "max_tokens": 300,
+    "temperature": 0.7,
+    "presence_penalty": 0.1,
+    "frequency_penalty": 0.1
+}
+NEURA_ERROR_MESSAGE = "I apologize, but I'm having trouble connecting right now. Please try again in a moment."
 
-        # Add previous conversation history
-        for chat in history:
-            messages.append({
-                "role": chat["role"],
-                "content": chat["content"]
-            })
 
-        # Add current user message
-        messages.append({"role": "user", "content": message})
+def neura_error_message(error):
+    """What Neura says when the model did not answer (after the retries of the backend)"""
+    print(f"OpenAI API Error: {str(error)}")  # Log error for debugging
+    if isinstance(error, CircuitOpen):
+        return f"I apologize, but I'm unavailable at the moment. Please try again in {error.retry_after:.0f} seconds."
+    return NEURA_ERROR_MESSAGE
 
-        # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-4",  # You can change to "gpt-3.5-turbo" for faster/cheaper responses
-            messages=messages,
-            max_tokens=300,
-            temperature=0.7,
-            presence_penalty=0.1,
-            frequency_penalty=0.1
-        )
 
-        ai_response = response.choices[0].message.content
+# Neura AI chatbot function using OpenAI API
+@metrics.instrument("neura_chatbot")
+def neura_chatbot(message, history, current_case_text, participant=None):
+    """
+    Neura chatbot that uses OpenAI GPT for intelligent responses
+    :param participant: the session id of the participant, to take turns with the others under the rate limits
+    """
+
+    if not message.strip():
+        return history, ""
+
+    try:
+        # Build conversation history for OpenAI API
+        messages = build_neura_messages(message, history, current_case_text)
+
+        # Call OpenAI API
+        ai_response = shared_backend.chat_completion_sync(NEURA_MODEL, messages, participant, **NEURA_SAMPLING_PARAMS)
 
         # Update conversation history
         new_history = history + [
@@ -125,22 +159,73 @@ Remember: You're helping them learn to think like neurologists, not just giving
 
         return new_history, ""
 
-    except Exception as e:
-        # Fallback error handling
-        error_message = "I apologize, but I'm having trouble connecting right now. Please try again in a moment."
-        print(f"OpenAI API Error: {str(e)}")  # Log error for debugging
-
+    except ModelBackendError as e:
+        # The model did not answer, even after the retries of the backend
         new_history = history + [
             {"role": "user", "content": message},
-            {"role": "assistant", "content": error_message}
+            {"role": "assistant", "content": neura_error_message(e)}
         ]
         return new_history, ""
 
 
-# Global variables
-unique_key = ""
-start_time = time.time()
-current_case = 0
+@metrics.instrument("neura_chatbot_async")
+async def neura_chatbot_async(message, history, current_case_text, participant=None):
+    """Same as neura_chatbot, but awaits the model instead of blocking a worker thread"""
+
+    if not message.strip():
+        return history, ""
+
+    try:
+        ai_response = await shared_backend.chat_completion(
+            NEURA_MODEL,
+            build_neura_messages(message, history, current_case_text),
+            participant,
+            **NEURA_SAMPLING_PARAMS
+        )
+    except ModelBackendError as e:
+        ai_response = neura_error_message(e)
+
+    return history + [
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": ai_response}
+    ], ""
+
+
+@metrics.instrument("neura_chatbot_stream_async")
+async def neura_chatbot_stream_async(message, history, current_case_text, participant=None):
+    """
+    Streaming version of neura_chatbot_async, to be used as a gradio (async) generator handler
+    Yields the partially received response as it arrives; the final yield matches what neura_chatbot returns
+    """
+
+    if not message.strip():
+        yield history, ""
+        return
+
+    pieces = []
+    try:
+        stream = shared_backend.stream_chat_completion(
+            NEURA_MODEL,
+            build_neura_messages(message, history, current_case_text),
+            participant,
+            **NEURA_SAMPLING_PARAMS
+        )
+        async for piece in stream:
+            pieces.append(piece)
+            yield history + [
+                {"role": "user", "content": message},
+                {"role": "assistant", "content": "".join(pieces)}
+            ], ""
+        ai_response = "".join(pieces)
+
+    except ModelBackendError as e:
+        ai_response = neura_error_message(e)
+
+    yield history + [
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": ai_response}
+    ], ""
+
 
 print("=== NEUROLOGY CASE STUDY - LOADING CASES ===")
 
@@ -315,14 +400,22 @@ main_saving_path = "./saved_data/"
 if not os.path.exists(main_saving_path):
     os.makedirs(main_saving_path)
 
+# Responses are appended to one store, written in batches by a background thread (see result_store.py)
+result_store = ResultStore(
+    os.path.join(main_saving_path, RESULT_STORE_FILENAME),
+    batch_size=RESULT_STORE_BATCH_SIZE,
+    flush_interval=RESULT_STORE_FLUSH_INTERVAL,
+    commit_retries=RESULT_STORE_COMMIT_RETRIES,
+    read_timeout=RESULT_STORE_READ_TIMEOUT,
+)
 
-def save_responses(case_num, condition, responses):
-    """Save user responses to file"""
-    try:
-        filename = f"case_{case_num}_{condition}_{int(time.time())}.json"
-        filepath = os.path.join(main_saving_path, filename)
 
+@metrics.instrument("save_responses")
+def save_responses(session_id, case_num, condition, responses):
+    """Save user responses to the result store, as a "case_responses" record of the session"""
+    try:
         data = {
+            "session_id": session_id,
             "case_number": case_num,
             "condition": condition,
             "timestamp": time.time(),
@@ -330,18 +423,34 @@ def save_responses(case_num, condition, responses):
             "case_assignment": CASE_ASSIGNMENT  # Save which specific cases were used
         }
 
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        result_store.write(session_id, "case_responses", data)
 
-        print(f"Responses saved to {filepath}")
+        print(f"Responses of case {case_num} queued for saving to {result_store.path}")
     except Exception as e:
         print(f"Error saving responses: {e}")
 
 
+# Conversion of the case HTML to markdown-friendly text, in order
+case_markdown_rules = [
+    (re.compile(r'<p><strong>(.*?)</strong>(.*?)</p>'), r'**\1**\2\n\n'),
+    (re.compile(r'<p>(.*?)</p>'), r'\1\n\n'),
+    (re.compile(r'<strong>(.*?)</strong>'), r'**\1**'),
+    (re.compile(r'<br/?>'), '\n'),
+]
+
+
+def case_markdown(case_html):
+    """Readable text of a case for Markdown display, from its HTML"""
+    for pattern, replacement in case_markdown_rules:
+        case_html = pattern.sub(replacement, case_html)
+    return case_html
+
+
 def create_interface():
     with gr.Blocks(title="Neurology Case Study") as demo:
 
-        # State variables
+        # State variables, one copy per browser session
+        session_id = gr.State(None)
         case_counter = gr.State(0)
         all_responses = gr.State({})
         chat_history = gr.State([])
@@ -427,6 +536,7 @@ def create_interface():
             """Initialize the study"""
             case_results = load_case(0)
             return (
+                str(uuid.uuid4()),  # session_id
                 gr.update(visible=False),  # welcome_page
                 gr.update(visible=True),  # study_interface
                 0,  # case_counter
@@ -455,13 +565,7 @@ def create_interface():
             case_data = problem_texts[case_num]
 
             # Create readable text from HTML by stripping tags for Markdown display
-            import re
-            case_text = case_data["text"]
-            # Convert HTML to markdown-friendly format
-            case_text = re.sub(r'<p><strong>(.*?)</strong>(.*?)</p>', r'**\1**\2\n\n', case_text)
-            case_text = re.sub(r'<p>(.*?)</p>', r'\1\n\n', case_text)
-            case_text = re.sub(r'<strong>(.*?)</strong>', r'**\1**', case_text)
-            case_text = re.sub(r'<br/?>', '\n', case_text)
+            case_text = case_markdown(case_data["text"])
 
             # Update displays - remove difficulty from header
             condition_markdown = f"## Case {case_num + 1}/4 - {condition}\n*File: {case_data['filename']}*"
@@ -486,7 +590,7 @@ def create_interface():
                 gr.update(value=[], visible=neura_visible)  # chatbot
             )
 
-        def next_case_handler(case_num, responses_dict, ans_a, help_a, ans_b, help_b, ans_c, help_c):
+        def next_case_handler(session, case_num, responses_dict, ans_a, help_a, ans_b, help_b, ans_c, help_c):
             """Handle moving to next case"""
             # Save current responses
             condition = case_sequence[case_num]
@@ -502,7 +606,7 @@ def create_interface():
             }
 
             responses_dict[f"case_{case_num + 1}_{condition}_{difficulty}"] = current_responses
-            save_responses(case_num + 1, f"{condition}_{difficulty}", current_responses)
+            save_responses(session, case_num + 1, f"{condition}_{difficulty}", current_responses)
 
             # Move to next case
             next_case_num = case_num + 1
@@ -544,16 +648,16 @@ def create_interface():
                     responses_dict
                 )
 
-        def handle_chat(message, history):
-            """Handle chat with Neura AI"""
-            # Get current case text for context
-            current_case_num = case_counter.value if hasattr(case_counter, 'value') else 0
+        async def handle_chat(message, history, current_case_num, session):
+            """Handle chat with Neura AI, streaming the response into the chatbot and the chat history"""
+            # Get current case text for context, from this session's case counter
             if current_case_num < len(problem_texts):
                 current_case_text = problem_texts[current_case_num]["text"]
             else:
                 current_case_text = "No case currently loaded."
 
-            return neura_chatbot(message, history, current_case_text)
+            async for new_history, new_message in neura_chatbot_stream_async(message, history, current_case_text, session):
+                yield new_history, new_history, new_message
 
         def clear_chat_history():
             """Clear the chat history"""
@@ -572,7 +676,7 @@ def create_interface():
         # Event handlers
         start_button.click(
             start_study,
-            outputs=[welcome_page, study_interface, case_counter, all_responses,
+            outputs=[session_id, welcome_page, study_interface, case_counter, all_responses,
                      condition_display, case_display, neura_interface,
                      answer_a, helpful_a, answer_b, helpful_b, answer_c, helpful_c,
                      progress_display, chat_history, chatbot]
@@ -580,7 +684,7 @@ def create_interface():
 
         next_button.click(
             next_case_handler,
-            inputs=[case_counter, all_responses, answer_a, helpful_a, answer_b, helpful_b, answer_c, helpful_c],
+            inputs=[session_id, case_counter, all_responses, answer_a, helpful_a, answer_b, helpful_b, answer_c, helpful_c],
             outputs=[condition_display, case_display, neura_interface,
                      answer_a, helpful_a, answer_b, helpful_b, answer_c, helpful_c,
                      progress_display, chat_history, chatbot, case_counter, all_responses]
@@ -600,10 +704,10 @@ def create_interface():
         )
 
         # Chat functionality
-        msg.submit(handle_chat, inputs=[msg, chat_history], outputs=[chatbot, msg])
+        msg.submit(handle_chat, inputs=[msg, chat_history, case_counter, session_id], outputs=[chatbot, chat_history, msg])
         msg.submit(lambda: "", outputs=[msg])
 
-        send_btn.click(handle_chat, inputs=[msg, chat_history], outputs=[chatbot, msg])
+        send_btn.click(handle_chat, inputs=[msg, chat_history, case_counter, session_id], outputs=[chatbot, chat_history, msg])
         send_btn.click(lambda: "", outputs=[msg])
 
         clear_chat.click(clear_chat_history, outputs=[chatbot, chat_history])
@@ -613,6 +717,8 @@ def create_interface():
             outputs=[welcome_page, study_interface, completion_page, case_counter, all_responses]
         )
 
+    # Every session keeps its own state, so events of different participants can run concurrently
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY_COUNT)
     return demo
 
 
@@ -620,6 +726,8 @@ def create_interface():
 if __name__ == "__main__":
     try:
         demo = create_interface()
+        start_metrics_server()
+        start_metrics_dump()
         print("Launching Neurology Case Study interface...")
         demo.launch(share=False, server_name="127.0.0.1", server_port=7860)
     except Exception as e:
@@ -0,0 +1,366 @@
+"""
+A small local stand-in for the OpenAI HTTP API.
+
+It serves /v1/chat/completions and /v1/completions (streaming and non-streaming)
+with deterministic replies, so the platform can be exercised without the network
+or an API key. Point the model backend at it with e.g.
+    model_backend.shared_backend.api_base = server.url + "/v1"
+or run it standalone and set OPENAI_API_BASE=http://127.0.0.1:8001/v1:
+    python mock_openai_server.py --port 8001 --first-token-latency 0.5 --tokens-per-second 40
+The latency and speed can also vary between requests, drawn from a Distribution, e.g.
+    python mock_openai_server.py --first-token-latency lognormal:0.5:0.4 --tokens-per-second normal:40:8
+local_backend.py generates the same replies with the same timings in process, without HTTP.
+
+Faults can be injected, to exercise the retries, deadlines and circuit breakers of the backend: a share of the
+requests fail with a server error (--error-rate), are rate limited (--rate-limit-rate, with a Retry-After header),
+or are answered after an extra delay (--slow-rate, --slow-latency). The rates can be changed while the server runs
+(server.config), e.g. to take the upstream down and up again.
+
+Like the OpenAI API, it can also enforce requests and tokens per minute per model (rate_limits, --rpm/--tpm): a
+request over the limits is answered 429 with the Retry-After of its turn. The tokens of a request are its prompt
+words and its max_tokens; up to rate_limit_burst seconds' worth of the limits can be used at once.
+"""
+import collections
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+filler_words = (
+    "Let us consider the problem carefully and proceed step by step . "
+    "First we recall the relevant definitions , then we apply them to the statement ."
+).split()
+
+
+def mock_reply(messages_or_prompt, n_tokens):
+    """Deterministic reply text of n_tokens whitespace separated tokens"""
+    if isinstance(messages_or_prompt, list):
+        last_user = [m["content"] for m in messages_or_prompt if m.get("role") == "user"]
+        seed_text = last_user[-1] if last_user else ""
+    else:
+        seed_text = messages_or_prompt or ""
+    words = [f"[{len(seed_text)}]"] + [filler_words[i % len(filler_words)] for i in range(n_tokens - 1)]
+    return [w + " " for w in words[:n_tokens]]
+
+
+def prompt_length(request):
+    """Tokens of the prompt of a request, as counted by the mock: its words"""
+    if "messages" in request:
+        text = " ".join(m.get("content", "") for m in request["messages"])
+    else:
+        text = request.get("prompt", "")
+    return len(text.split())
+
+
+def reply_length(request, reply_tokens):
+    """Tokens of the reply to a request: reply_tokens, capped by its max_tokens"""
+    return max(1, min(reply_tokens, request.get("max_tokens") or 16))
+
+
+class Distribution:
+    """
+    A latency or speed drawn for each request: "constant:value" (or just a number), "uniform:low:high",
+    "normal:mean:std", "lognormal:median:sigma" or "exponential:mean"; draws are never negative
+    """
+    n_params = {"constant": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+
+    def __init__(self, kind, *params):
+        if self.n_params.get(kind) != len(params):
+            raise ValueError(f"Unknown distribution {kind}{params}, expected one of {self.n_params}")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, value):
+        """A Distribution from a number, or a "kind:param:param" string"""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, (int, float)):
+            return cls("constant", float(value))
+        kind, *params = value.split(":")
+        if not params:
+            return cls("constant", float(kind))
+        return cls(kind, *map(float, params))
+
+    def sample(self, rng):
+        if self.kind == "constant":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.params)
+        elif self.kind == "lognormal":
+            value = self.params[0] * math.exp(rng.gauss(0., self.params[1]))
+        else:
+            value = rng.expovariate(1. / self.params[0]) if self.params[0] else 0.
+        return max(0., value)
+
+    def __repr__(self):
+        return ":".join([self.kind] + [f"{param:g}" for param in self.params])
+
+
+def sample_timing(config, rng, prompt_tokens):
+    """Seconds before the first token (reading the prompt included) and between two tokens, for one request"""
+    first_token = Distribution.parse(config["first_token_latency"]).sample(rng)
+    if config["prompt_tokens_per_second"]:
+        first_token += prompt_tokens / config["prompt_tokens_per_second"]
+    speed = Distribution.parse(config["tokens_per_second"]).sample(rng)
+    return first_token, 1. / speed if speed > 0 else 0.
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.config["verbose"]:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_rate_limited(self, message, kind, retry_after):
+        body = json.dumps({"error": {"message": message, "type": kind}}).encode("utf-8")
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Retry-After", f"{retry_after:g}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.hits += 1
+            draw, slow_draw = self.server.random.random(), self.server.random.random()
+            first_token, per_token = sample_timing(config, self.server.random, prompt_length(request))
+        if draw < config["error_rate"]:
+            self.server.count_fault("errors")
+            self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+        if draw < config["error_rate"] + config["rate_limit_rate"]:
+            self.server.count_fault("rate_limits")
+            self._send_rate_limited("Injected rate limit", "requests", config["retry_after"])
+            return
+        retry_after = self.server.over_limit(request)
+        if retry_after is not None:
+            self.server.count_fault("limits_exceeded")
+            self._send_rate_limited("Rate limit reached", "tokens", retry_after)
+            return
+        if slow_draw < config["slow_rate"]:
+            self.server.count_fault("slow")
+            time.sleep(config["slow_latency"])
+
+        if self.path.endswith("/chat/completions"):
+            is_chat = True
+            tokens = mock_reply(request.get("messages", []), reply_length(request, config["reply_tokens"]))
+        elif self.path.endswith("/completions"):
+            is_chat = False
+            tokens = mock_reply(request.get("prompt", ""), reply_length(request, config["reply_tokens"]))
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        completion_id = f"mock-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+        usage = {
+            "prompt_tokens": prompt_length(request),
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_length(request) + len(tokens),
+        }
+        time.sleep(first_token)
+
+        if not request.get("stream"):
+            time.sleep(per_token * len(tokens))
+            text = "".join(tokens)
+            if is_chat:
+                choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+            else:
+                choice = {"index": 0, "text": text, "logprobs": None, "finish_reason": "stop"}
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion" if is_chat else "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [choice],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(per_token)
+            if is_chat:
+                delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+                choice = {"index": 0, "delta": delta, "finish_reason": None}
+            else:
+                choice = {"index": 0, "text": token, "logprobs": None, "finish_reason": None}
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk" if is_chat else "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [choice],
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            # As the API does: a last event without choices, with the usage of the whole stream
+            event = {"id": completion_id, "object": "chat.completion.chunk" if is_chat else "text_completion",
+                     "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, config):
+        super().__init__(address, MockOpenAIHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.faults = collections.Counter()
+        self.random = random.Random(config["seed"])
+        self.buckets = {}  # model: [requests left, tokens left, last refill]
+
+    def over_limit(self, request):
+        """None if the request is within the rate limits of its model (and counts against them), else seconds to wait"""
+        limits = self.config["rate_limits"].get(request.get("model"))
+        if not limits:
+            return None
+        tokens = prompt_length(request) + (request.get("max_tokens") or 16)
+        requests_rate, tokens_rate = limits["requests"] / 60, limits["tokens"] / 60
+        burst = self.config["rate_limit_burst"]
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(request["model"], [requests_rate * burst, tokens_rate * burst, now])
+            bucket[0] = min(requests_rate * burst, bucket[0] + (now - bucket[2]) * requests_rate)
+            bucket[1] = min(tokens_rate * burst, bucket[1] + (now - bucket[2]) * tokens_rate)
+            bucket[2] = now
+            if bucket[0] >= 1 and bucket[1] >= tokens:
+                bucket[0] -= 1
+                bucket[1] -= tokens
+                return None
+            return max((1 - bucket[0]) / requests_rate, (tokens - bucket[1]) / tokens_rate, 0.)
+
+    def count_fault(self, kind):
+        with self.lock:
+            self.faults[kind] += 1
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_mock_server(
+    host="127.0.0.1",
+    port=0,
+    first_token_latency=0.,
+    tokens_per_second=0.,
+    reply_tokens=64,
+    verbose=False,
+    prompt_tokens_per_second=0.,
+    error_rate=0.,
+    rate_limit_rate=0.,
+    retry_after=0.,
+    slow_rate=0.,
+    slow_latency=0.,
+    seed=0,
+    rate_limits=None,
+    rate_limit_burst=60.,
+):
+    """
+    Start a mock OpenAI server in a daemon thread
+    :param first_token_latency: seconds before the first token (or whole reply) is sent, a number or a Distribution
+    :param tokens_per_second: generation speed, 0 for as fast as possible, a number or a Distribution
+    :param reply_tokens: number of tokens per reply, capped by the request's max_tokens
+    :param prompt_tokens_per_second: speed of reading the prompt, which delays the first token; 0 for no delay
+    :param error_rate: share of the requests answered with a 500 error
+    :param rate_limit_rate: share of the requests answered with a 429 error, with a Retry-After of retry_after seconds
+    :param slow_rate: share of the requests delayed by slow_latency more seconds
+    :param seed: of the draws of the injected faults
+    :param rate_limits: {model: {"requests": per minute, "tokens": per minute}} to enforce
+    :param rate_limit_burst: seconds' worth of the limits that can be used at once
+    :return: the running server, use server.url for the base url and server.shutdown() to stop it
+    """
+    server = MockOpenAIServer((host, port), {
+        "first_token_latency": Distribution.parse(first_token_latency),
+        "tokens_per_second": Distribution.parse(tokens_per_second),
+        "reply_tokens": reply_tokens,
+        "verbose": verbose,
+        "prompt_tokens_per_second": prompt_tokens_per_second,
+        "error_rate": error_rate,
+        "rate_limit_rate": rate_limit_rate,
+        "retry_after": retry_after,
+        "slow_rate": slow_rate,
+        "slow_latency": slow_latency,
+        "seed": seed,
+        "rate_limits": dict(rate_limits or {}),
+        "rate_limit_burst": rate_limit_burst,
+    })
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-latency", type=Distribution.parse, default="0.5",
+                        help="seconds, a number or a distribution, e.g. lognormal:0.5:0.4")
+    parser.add_argument("--tokens-per-second", type=Distribution.parse, default="40",
+                        help="a number or a distribution, e.g. normal:40:8")
+    parser.add_argument("--reply-tokens", type=int, default=256)
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=0.)
+    parser.add_argument("--error-rate", type=float, default=0.)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.)
+    parser.add_argument("--retry-after", type=float, default=1.)
+    parser.add_argument("--slow-rate", type=float, default=0.)
+    parser.add_argument("--slow-latency", type=float, default=10.)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute allowed for each model, 0 for no limit")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute allowed for each model, 0 for no limit")
+    args = parser.parse_args()
+    rate_limits = {}
+    if args.rpm or args.tpm:
+        limits = {"requests": args.rpm or 10 ** 9, "tokens": args.tpm or 10 ** 12}
+        rate_limits = {model: limits for model in ["gpt-4", "gpt-3.5-turbo", "text-davinci-003"]}
+
+    server = start_mock_server(args.host, args.port, args.first_token_latency, args.tokens_per_second,
+                               args.reply_tokens, verbose=True, prompt_tokens_per_second=args.prompt_tokens_per_second,
+                               error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                               retry_after=args.retry_after, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                               rate_limits=rate_limits)
+    print(f"Mock OpenAI server listening on {server.url}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
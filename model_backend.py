@@ -0,0 +1,360 @@
+"""
+Asynchronous backend for the model API calls.
+
+Every request runs on one background event loop that owns a single keep-alive connection
+pool, with a cap on the number of requests in flight per model. Coroutines awaited from
+another event loop (e.g. the gradio server) and blocking calls from worker threads are both
+bridged onto that loop, so all callers share the same pool and limits.
+The backend talks to the OpenAI-compatible HTTP API directly, so it does not depend on the
+version of the openai package installed. Every request goes through the deadlines, retries,
+circuit breakers and hedging of resilience.py, and waits for its turn under the rate limits of
+its model (rate_limiter.py).
+The shared backend is picked by name (MODEL_BACKEND in constants.py, or $MODEL_BACKEND): the OpenAI
+API, the mock server, or replies generated in process (local_backend.py), to run everything offline.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+
+import aiohttp
+
+from constants import MAX_UPSTREAM_CONNECTIONS, MODEL_CONCURRENCY_LIMITS, DEFAULT_MODEL_CONCURRENCY_LIMIT, \
+    REQUEST_TIMEOUT, MODEL_BACKEND, LOCAL_FIRST_TOKEN_LATENCY, LOCAL_TOKENS_PER_SECOND, LOCAL_REPLY_TOKENS, \
+    LOCAL_BACKEND_SEED
+from metrics import metrics
+from rate_limiter import RateLimiter, request_tokens
+from resilience import ModelBackendError, Resilience
+
+
+_END_OF_STREAM = object()
+
+
+def _chat_piece(event):
+    return event["choices"][0].get("delta", {}).get("content") if event.get("choices") else None
+
+
+def _completion_piece(event):
+    return event["choices"][0].get("text") if event.get("choices") else None
+
+
+def _with_usage(extract, usage):
+    """extract, also copying into usage the token usage the API reports in the last event of a stream"""
+    if usage is None:
+        return extract
+
+    def extract_with_usage(event):
+        if event.get("usage"):
+            usage.update(event["usage"])
+        return extract(event)
+    return extract_with_usage
+
+
+def _stream_payload(payload, usage):
+    # The API only reports the usage of a stream when asked to
+    return payload if usage is None else dict(payload, stream_options={"include_usage": True})
+
+
+def _count_request(model, tokens):
+    # Tokens of the prompt and of the longest reply, as counted by the rate limits
+    metrics.inc("model_requests_total", model=model)
+    metrics.inc("model_tokens_total", tokens, model=model)
+
+
+class AsyncModelBackend:
+    def __init__(
+        self,
+        api_base=None,
+        api_key=None,
+        max_connections=MAX_UPSTREAM_CONNECTIONS,
+        concurrency_limits=None,
+        request_timeout=REQUEST_TIMEOUT,
+        resilience=None,
+        rate_limiter=None,
+    ):
+        """
+        :param api_base: base url of the API, defaults to $OPENAI_API_BASE / $OPENAI_BASE_URL or the OpenAI API
+        :param api_key: defaults to $OPENAI_API_KEY
+        :param max_connections: size of the shared keep-alive connection pool
+        :param concurrency_limits: {model: maximum number of requests in flight}
+        :param request_timeout: seconds before a request is abandoned
+        :param resilience: deadlines, retries, circuit breakers and hedging (resilience.Resilience), by default
+            configured by constants.py
+        :param rate_limiter: requests and tokens per minute per model (rate_limiter.RateLimiter), by default
+            configured by constants.py
+        """
+        self.api_base = api_base or os.environ.get("OPENAI_API_BASE") or os.environ.get("OPENAI_BASE_URL") \
+            or "https://api.openai.com/v1"
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.concurrency_limits = dict(MODEL_CONCURRENCY_LIMITS if concurrency_limits is None else concurrency_limits)
+        self.request_timeout = request_timeout
+        self.resilience = Resilience() if resilience is None else resilience
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        # Only touched from the backend loop
+        self._session = None
+        self._semaphores = {}
+
+    @property
+    def loop(self):
+        """The backend event loop, started in a daemon thread on first use"""
+        if self._loop is None:
+            with self._loop_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="model-backend", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the backend loop, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro):
+        """Await a coroutine on the backend loop from any event loop"""
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def semaphore(self, model):
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(
+                self.concurrency_limits.get(model, DEFAULT_MODEL_CONCURRENCY_LIMIT)
+            )
+        return self._semaphores[model]
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self._session
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key or os.environ.get('OPENAI_API_KEY', '')}"}
+
+    async def _raise_for_status(self, model, response):
+        if response.status != 200:
+            text = await response.text()
+            try:
+                message = json.loads(text)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = text
+            try:
+                retry_after = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                retry_after = None
+            if response.status == 429 and retry_after:
+                self.rate_limiter.hold(model, retry_after)
+            raise ModelBackendError(response.status, message, retry_after=retry_after)
+
+    # The coroutines below run on the backend loop
+
+    @metrics.instrument("model_request")
+    async def _post(self, endpoint, payload, participant=None):
+        tokens = request_tokens(payload)
+        _count_request(payload["model"], tokens)
+        return await self.resilience.call(
+            payload["model"], lambda: self._post_once(endpoint, payload, tokens, participant)
+        )
+
+    @metrics.instrument("model_stream")
+    async def _post_stream(self, endpoint, payload, extract, participant=None):
+        tokens = request_tokens(payload)
+        _count_request(payload["model"], tokens)
+        async for piece in self.resilience.stream(
+            payload["model"], lambda: self._post_stream_once(endpoint, payload, extract, tokens, participant)
+        ):
+            yield piece
+
+    async def _post_once(self, endpoint, payload, tokens, participant):
+        session = await self._get_session()
+        await self.rate_limiter.acquire(payload["model"], tokens, participant)
+        async with self.semaphore(payload["model"]):
+            async with session.post(f"{self.api_base}/{endpoint}", json=payload, headers=self._headers()) as response:
+                await self._raise_for_status(payload["model"], response)
+                return await response.json(content_type=None)
+
+    async def _post_stream_once(self, endpoint, payload, extract, tokens, participant):
+        session = await self._get_session()
+        await self.rate_limiter.acquire(payload["model"], tokens, participant)
+        async with self.semaphore(payload["model"]):
+            async with session.post(f"{self.api_base}/{endpoint}", json=dict(payload, stream=True),
+                                    headers=self._headers()) as response:
+                await self._raise_for_status(payload["model"], response)
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    piece = extract(json.loads(data))
+                    if piece:
+                        yield piece
+
+    async def _pump(self, stream, put):
+        # Forward a stream living on the backend loop to a consumer on another thread or loop
+        try:
+            async for piece in stream:
+                put(piece)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            put(e)
+        else:
+            put(_END_OF_STREAM)
+
+    async def _chat_completion(self, model, messages, participant=None, usage=None, **params):
+        body = await self._post("chat/completions", dict(params, model=model, messages=messages), participant)
+        if usage is not None:
+            usage.update(body.get("usage") or {})
+        return body["choices"][0]["message"]["content"]
+
+    async def _completion(self, model, prompt, participant=None, usage=None, **params):
+        body = await self._post("completions", dict(params, model=model, prompt=prompt), participant)
+        if usage is not None:
+            usage.update(body.get("usage") or {})
+        return body["choices"][0]["text"]
+
+    # Async API, usable from any event loop
+
+    async def chat_completion(self, model, messages, participant=None, usage=None, **params):
+        """
+        The content of a chat completion, params are passed on to the API (max_tokens, temperature...)
+        :param participant: who the request is for (e.g. their session id), to take turns under the rate limits
+        :param usage: a dict to update with the token usage reported by the API (prompt_tokens, completion_tokens)
+        """
+        return await self.run(self._chat_completion(model, messages, participant, usage, **params))
+
+    async def completion(self, model, prompt, participant=None, usage=None, **params):
+        """The text of a (non-chat) completion"""
+        return await self.run(self._completion(model, prompt, participant, usage, **params))
+
+    def stream_chat_completion(self, model, messages, participant=None, usage=None, **params):
+        """Async iterator over the content pieces of a chat completion as they arrive"""
+        return self._iterate_async(lambda: self._post_stream(
+            "chat/completions", _stream_payload(dict(params, model=model, messages=messages), usage),
+            _with_usage(_chat_piece, usage), participant
+        ))
+
+    def stream_completion(self, model, prompt, participant=None, usage=None, **params):
+        """Async iterator over the text pieces of a (non-chat) completion as they arrive"""
+        return self._iterate_async(lambda: self._post_stream(
+            "completions", _stream_payload(dict(params, model=model, prompt=prompt), usage),
+            _with_usage(_completion_piece, usage), participant
+        ))
+
+    async def _iterate_async(self, make_stream):
+        if asyncio.get_running_loop() is self.loop:
+            async for piece in make_stream():
+                yield piece
+            return
+        loop = asyncio.get_running_loop()
+        handoff = asyncio.Queue()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(handoff.put_nowait, item)
+            except RuntimeError:
+                pass  # the consumer stopped early and its loop is closed, the pump is being cancelled
+
+        future = self.submit(self._pump(make_stream(), put))
+        try:
+            while True:
+                item = await handoff.get()
+                if item is _END_OF_STREAM:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    # Blocking API, for worker threads; the waiting happens on the backend loop
+
+    def chat_completion_sync(self, model, messages, participant=None, usage=None, **params):
+        return self.submit(self._chat_completion(model, messages, participant, usage, **params)).result()
+
+    def completion_sync(self, model, prompt, participant=None, usage=None, **params):
+        return self.submit(self._completion(model, prompt, participant, usage, **params)).result()
+
+    def stream_chat_completion_sync(self, model, messages, participant=None, usage=None, **params):
+        return self._iterate_sync(lambda: self._post_stream(
+            "chat/completions", _stream_payload(dict(params, model=model, messages=messages), usage),
+            _with_usage(_chat_piece, usage), participant
+        ))
+
+    def stream_completion_sync(self, model, prompt, participant=None, usage=None, **params):
+        return self._iterate_sync(lambda: self._post_stream(
+            "completions", _stream_payload(dict(params, model=model, prompt=prompt), usage),
+            _with_usage(_completion_piece, usage), participant
+        ))
+
+    def _iterate_sync(self, make_stream):
+        handoff = queue.Queue()
+        future = self.submit(self._pump(make_stream(), handoff.put))
+        try:
+            while True:
+                item = handoff.get()
+                if item is _END_OF_STREAM:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self):
+        """Close the connection pool; the backend can still be used afterwards and will reconnect"""
+        if self._loop is not None and self._session is not None:
+            self.submit(self._session.close()).result()
+
+
+def openai_backend(**options):
+    """The OpenAI API, or the OpenAI-compatible server at $OPENAI_API_BASE"""
+    return AsyncModelBackend(**options)
+
+
+def mock_backend(**options):
+    """The mock OpenAI server (mock_openai_server.py), started in process, with the speed of the local backend"""
+    from mock_openai_server import start_mock_server
+    server = start_mock_server(first_token_latency=LOCAL_FIRST_TOKEN_LATENCY, tokens_per_second=LOCAL_TOKENS_PER_SECOND,
+                               reply_tokens=LOCAL_REPLY_TOKENS, seed=LOCAL_BACKEND_SEED)
+    options.setdefault("rate_limiter", RateLimiter({}))
+    return AsyncModelBackend(api_base=server.url + "/v1", **options)
+
+
+def local_backend(**options):
+    """Replies generated in process, without HTTP (local_backend.py)"""
+    from local_backend import LocalModelBackend
+    return LocalModelBackend(**options)
+
+
+# Backends by name, see MODEL_BACKEND in constants.py; register_backend adds others (e.g. another API)
+backend_factories = {
+    "openai": openai_backend,
+    "mock": mock_backend,
+    "local": local_backend,
+}
+
+
+def register_backend(name, factory):
+    """
+    :param factory: returns a backend (an AsyncModelBackend, or anything with its API) from keyword options
+    """
+    backend_factories[name] = factory
+
+
+def create_backend(name, **options):
+    if name not in backend_factories:
+        raise ValueError(f"Unknown model backend {name!r}, expected one of {sorted(backend_factories)}")
+    return backend_factories[name](**options)
+
+
+# The one backend shared by every chat handler in the process
+shared_backend = create_backend(os.environ.get("MODEL_BACKEND") or MODEL_BACKEND)
@@ -1,53 +1,93 @@
-from constants import model_options, MAX_CONVERSATION_LENGTH, MAX_TOKENS_PER_GENERATION, SAMPLING_TEMPERATURE
+from constants import model_options, MAX_CONVERSATION_LENGTH, MAX_TOKENS_PER_GENERATION, SAMPLING_TEMPERATURE, \
+    USE_RESPONSE_CACHE, RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, CONTEXT_WINDOWS, \
+    CONTEXT_POLICY, CONTEXT_SUMMARY_CHARS, COALESCE_IDENTICAL_REQUESTS, MODEL_NAMES, COMPLETION_MODELS, \
+    DEFAULT_CONTEXT_WINDOW
+
+import re
+import time
 
 import gradio as gr
 import openai 
 
+from context_window import ContextPolicy
+from data.data_utils.load_prompts import construct_prompt, construct_messages
+from metrics import metrics
+from model_backend import ModelBackendError, shared_backend
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from token_counter import count_tokens, tokens_per_message
+
 oai_key = "" # ADD YOUR KEY
 openai.api_key = oai_key
+# The chat functions below go through the shared async backend, which needs the same key
+shared_backend.api_key = oai_key
+
+
+legacy_completion_models = {
+    "codegpt": "code-davinci-002",
+    "textgpt": "text-davinci-003",
+    "instructgpt": "text-davinci-003"
+}
+legacy_chat_models = {
+    "chatgpt": "gpt-3.5-turbo",
+    "chatgpt4": "gpt-4"
+}
+legacy_system_prompt = "You are an assistant to a professional mathematician."
+prompt_turn_pattern = re.compile(r"(Question:|Answer:)")
+prompt_turn_roles = {"Question:": "user", "Answer:": "assistant"}
+
+
+def prompt_to_messages(prompt):
+    """The "Question: ... Answer: ..." turns of a few-shot prompt as chat messages, in one pass over the prompt"""
+    pieces = prompt_turn_pattern.split(prompt)
+    if pieces[0].strip():
+        raise AssertionError(pieces[0].strip())
+    return [
+        {"role": prompt_turn_roles[label], "content": (label + content).strip()[len(label):]}
+        for label, content in zip(pieces[1::2], pieces[2::2])
+    ]
+
+
+def generate_completion(model, prompt):
+    completion = openai.Completion.create(
+        model=legacy_completion_models[model],
+        prompt=prompt,
+        max_tokens=256,
+        temperature=0,
+        stop=["Question:"]
+    )
+    return completion.choices[0].text
+
+
+def generate_chat(model, conversation):
+    sentence = openai.ChatCompletion.create(
+        model=legacy_chat_models[model],
+        messages=conversation,
+        max_tokens=256
+    )
+    return sentence.choices[0].message.content
 
 
 def generate(model, prompt):
     assert model in model_options
-    if model == "codegpt" or model == "textgpt" or model == "instructgpt":
-        oai_model_name = {
-            "codegpt": "code-davinci-002",
-            "textgpt": "text-davinci-003",
-            "instructgpt": "text-davinci-003"
-        }
-        completion = openai.Completion.create(
-            model=oai_model_name[model],
-            prompt=prompt,
-            max_tokens=256,
-            temperature=0,
-            stop=["Question:"]
-        )
-        return completion.choices[0].text
-    elif model == "chatgpt" or model == "chatgpt4":
-        oai_model_name = {
-            "chatgpt": "gpt-3.5-turbo",
-            "chatgpt4": "gpt-4"
-        }
-        message_string = prompt.replace("Question:", "<delim>user:")
-        message_string = message_string.replace("Answer:", "<delim>assistant:")
-        messages = message_string.split("<delim>")
-        messages = [m.strip() for m in messages]
-        messages = [m for m in messages if m]
-        conversation = []
-        for message in messages:
-            if message.startswith("user:"):
-                conversation.append({"role": "user", "content": message[5:]})
-            elif message.startswith("assistant:"):
-                conversation.append({"role": "assistant", "content": message[10:]})
-            else:
-                raise AssertionError(message)
-        conversation = [{"role": "system", "content": "You are an assistant to a professional mathematician."}, conversation[-2]]
-        sentence = openai.ChatCompletion.create(
-            model=oai_model_name[model],
-            messages=conversation,
-            max_tokens=256
-        )
-        return sentence.choices[0].message.content
+    if model in legacy_completion_models:
+        return generate_completion(model, prompt)
+    elif model in legacy_chat_models:
+        # Only the question of the problem is sent to the chat models (the last message being the empty answer)
+        conversation = [{"role": "system", "content": legacy_system_prompt}, prompt_to_messages(prompt)[-2]]
+        return generate_chat(model, conversation)
+    else:
+        raise NotImplementedError
+
+
+def generate_for_problem(model, problem_id, problem_text, prompt_examples):
+    """Same as generate(model, construct_prompt(...)), the chat messages being built without going through the prompt"""
+    assert model in model_options
+    if model in legacy_completion_models:
+        return generate_completion(model, construct_prompt(problem_id, problem_text, prompt_examples))
+    elif model in legacy_chat_models:
+        return generate_chat(model, construct_messages(problem_id, problem_text, prompt_examples,
+                                                       system_prompt=legacy_system_prompt, few_shot=False))
     else:
         raise NotImplementedError
 
@@ -78,18 +118,154 @@ def legacy_chatbot_generate(user_input, history=[]):
 ########################################
 # The above should not be used anymore #
 ########################################
-def query_a_chat_completion(model, messages):
-    assert model in ["gpt-3.5-turbo", "gpt-4"]
-    completion = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        max_tokens=MAX_TOKENS_PER_GENERATION,
-        temperature=SAMPLING_TEMPERATURE
+# Sampling parameters of every chat generation
+generation_params = {
+    "max_tokens": MAX_TOKENS_PER_GENERATION,
+    "temperature": SAMPLING_TEMPERATURE
+}
+
+# Deterministic generations are served from disk when the same (model, messages, params) was seen before
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL,
+                               enabled=USE_RESPONSE_CACHE)
+
+
+# Identical deterministic requests in flight at the same time share one upstream call
+single_flight = SingleFlight(shared_backend.submit)
+
+
+def backend_metrics():
+    """Gauges of the response cache, of the coalesced requests, and of the resilience and rate limits of the backend"""
+    for key, value in response_cache.stats().items():
+        yield f"response_cache_{key}", {}, value
+    for key, value in single_flight.stats().items():
+        yield f"single_flight_{key}", {}, value
+    stats = shared_backend.resilience.stats()
+    for model, state in stats.pop("circuits").items():
+        yield "circuit_open", {"model": model}, state == "open"
+    for key, value in stats.items():
+        yield f"resilience_{key}", {}, value
+    for model, model_stats in shared_backend.rate_limiter.stats().items():
+        for key, value in model_stats.items():
+            yield f"rate_limit_{key}", {"model": model}, value
+
+
+metrics.add_collector(backend_metrics)
+
+
+def flight_key(model, messages):
+    """Requests with the same key get the same response; sampled generations are never shared"""
+    if not COALESCE_IDENTICAL_REQUESTS or generation_params["temperature"] > 0:
+        return None
+    return ResponseCache.make_key(model, messages, **generation_params)
+
+
+def upstream_pieces(model, messages, stream, participant=None, upstream=None):
+    """
+    The async iterator of the pieces of a generation from the shared backend (a single piece if not streamed)
+    :param upstream: a dict to fill with the token usage reported by the API, when the call was sent (sent_at) and
+        how long it took (latency)
+    """
+    if model in COMPLETION_MODELS:
+        prompt = construct_pretend_prompt(messages)
+        if stream:
+            pieces = shared_backend.stream_completion(model, prompt, participant, upstream, **generation_params)
+        else:
+            pieces = _whole(shared_backend.completion(model, prompt, participant, upstream, **generation_params))
+    elif stream:
+        pieces = shared_backend.stream_chat_completion(model, messages, participant, upstream, **generation_params)
+    else:
+        pieces = _whole(shared_backend.chat_completion(model, messages, participant, upstream, **generation_params))
+    return pieces if upstream is None else _timed(pieces, upstream)
+
+
+async def _whole(response):
+    yield await response
+
+
+async def _timed(pieces, upstream):
+    upstream["sent_at"] = time.time()
+    start = time.perf_counter()
+    async for piece in pieces:
+        yield piece
+    upstream["latency"] = time.perf_counter() - start
+
+
+def start_generation(model, messages, stream=False, participant=None, served=None):
+    """
+    The cached response of a request, or the flight of its generation: started now, or the identical one in flight
+    :param participant: who asks (the id of their session), to take turns with the others under the rate limits;
+        a flight joined by several participants waits its turn as the one who started it
+    :param served: a dict to fill with how the request is served: "cache" ("hit", "miss", "coalesced" when it joined
+        an identical request in flight, or "bypass" for requests that cannot be cached) and "upstream" (the token
+        usage and latency of the upstream call, once it is done, see upstream_pieces)
+    :return: (response, None) on a cache hit, else (None, flight)
+    """
+    cache_key = response_cache.key_for(model, messages, **generation_params)
+    response = response_cache.get(cache_key)
+    if response is not None:
+        if served is not None:
+            served.update(cache="hit", upstream={})
+        return response, None
+    upstream = {}
+    flight = single_flight.join(
+        flight_key(model, messages),
+        lambda: upstream_pieces(model, messages, stream, participant, upstream),
+        on_complete=lambda response: response_cache.put(cache_key, model, response),
+        upstream=upstream,
     )
-    return completion.choices[0].message.content
+    if served is not None:
+        if flight.upstream is not upstream:
+            served["cache"] = "coalesced"
+        else:
+            served["cache"] = "bypass" if cache_key is None else "miss"
+        served["upstream"] = flight.upstream
+    return None, flight
+
 
-def pretend_a_chat_completion(model, messages):
-    assert model == "text-davinci-003"
+def generation(model, messages, participant=None, served=None):
+    response, flight = start_generation(model, messages, participant=participant, served=served)
+    return response if flight is None else flight.result()
+
+async def generation_async(model, messages, participant=None, served=None):
+    response, flight = start_generation(model, messages, participant=participant, served=served)
+    return response if flight is None else await flight.result_async()
+
+def stream_generation(model, messages, participant=None, served=None):
+    # A cache hit is delivered as a single piece
+    response, flight = start_generation(model, messages, stream=True, participant=participant, served=served)
+    if flight is None:
+        yield response
+        return
+    yield from flight.follow()
+
+async def stream_generation_async(model, messages, participant=None, served=None):
+    response, flight = start_generation(model, messages, stream=True, participant=participant, served=served)
+    if flight is None:
+        yield response
+        return
+    async for piece in flight.follow_async():
+        yield piece
+
+
+def query_a_chat_completion(model, messages, participant=None, served=None):
+    assert model not in COMPLETION_MODELS
+    return generation(model, messages, participant, served)
+
+async def query_a_chat_completion_async(model, messages, participant=None, served=None):
+    assert model not in COMPLETION_MODELS
+    return await generation_async(model, messages, participant, served)
+
+def stream_a_chat_completion(model, messages, participant=None, served=None):
+    """Same as query_a_chat_completion, but yields the content pieces as they arrive"""
+    assert model not in COMPLETION_MODELS
+    yield from stream_generation(model, messages, participant, served)
+
+async def stream_a_chat_completion_async(model, messages, participant=None, served=None):
+    assert model not in COMPLETION_MODELS
+    async for piece in stream_generation_async(model, messages, participant, served):
+        yield piece
+
+def construct_pretend_prompt(messages):
     # Create an instruction prompt
     prompt = "Help a professional mathematician solve a problem:\n"
     for message in messages:
@@ -100,68 +276,222 @@ def pretend_a_chat_completion(model, messages):
         else:
             pass
     prompt += "AI:"
-    # print(prompt)
-    completion = openai.Completion.create(
-        model=model,
-        prompt=prompt,
-        max_tokens=MAX_TOKENS_PER_GENERATION,
-        temperature=SAMPLING_TEMPERATURE
-    )
-    return completion["choices"][0]["text"]
+    return prompt
+
+def pretend_a_chat_completion(model, messages, participant=None, served=None):
+    assert model in COMPLETION_MODELS
+    return generation(model, messages, participant, served)
+
+async def pretend_a_chat_completion_async(model, messages, participant=None, served=None):
+    assert model in COMPLETION_MODELS
+    return await generation_async(model, messages, participant, served)
+
+def stream_pretend_a_chat_completion(model, messages, participant=None, served=None):
+    """Same as pretend_a_chat_completion, but yields the text pieces as they arrive"""
+    assert model in COMPLETION_MODELS
+    yield from stream_generation(model, messages, participant, served)
 
+async def stream_pretend_a_chat_completion_async(model, messages, participant=None, served=None):
+    assert model in COMPLETION_MODELS
+    async for piece in stream_generation_async(model, messages, participant, served):
+        yield piece
 
-def chatbot_generate(user_newest_input, history, model):
+
+# convert to openai model format
+actual_model_names = MODEL_NAMES
+
+
+chat_system_prompt = "You are a helpful assistant to a professional mathematician."
+context_policy = ContextPolicy(CONTEXT_POLICY, summary_chars=CONTEXT_SUMMARY_CHARS)
+
+
+def context_budget(actual_model):
+    """Prompt tokens a model can take, leaving room for the longest reply"""
+    return CONTEXT_WINDOWS.get(actual_model, DEFAULT_CONTEXT_WINDOW) - MAX_TOKENS_PER_GENERATION
+
+
+@metrics.instrument("prepare_context")
+def prepare_context(conversation, actual_model):
+    """
+    The chat messages to send for the newest turn of the conversation, within the context budget of the model
+    :return: the chat messages, and the context of the request ({"prompt_tokens", "history_tokens",
+        "dropped_messages"}) to record on the reply
+    """
+    chat_messages = conversation.chat_messages(chat_system_prompt)
+    counts = [tokens_per_message + count_tokens(chat_system_prompt, actual_model)]
+    counts += conversation.token_counts(actual_model)
+    return context_policy.select(chat_messages, counts, context_budget(actual_model), actual_model)
+
+
+def participant_of(session):
+    return session["unique_key"] if session else None
+
+
+def chatbot_outputs(conversation):
+    pairs = conversation.pairs()
+
+    # Whether the textbox and the submit button should be hidden
+    if conversation.n_exchanges >= MAX_CONVERSATION_LENGTH:
+        return pairs, conversation, gr.update(visible=False), gr.update(visible=False)
+    else:
+        return pairs, conversation, gr.update(visible=True), gr.update(visible=True)
+
+
+def unanswered(conversation, error):
+    """The error shown when the model did not answer; the question is taken back, for the participant to send again"""
+    conversation.retract()
+    return gr.Error(f"The model did not answer ({error.message}). Please send your message again.")
+
+
+def reply_record(served, requested_at, latency, first_token_latency):
+    """
+    What to record on a reply besides its text: when it was asked for (epoch seconds), how long the participant waited
+    for it and for its first piece, and how it was served (see start_generation): the latency and the token usage of
+    the upstream call, and whether it came from the response cache
+    """
+    upstream = served.get("upstream", {})
+    return {
+        "requested_at": requested_at,
+        "latency": latency,
+        "first_token_latency": first_token_latency,
+        "upstream_latency": upstream.get("latency"),
+        "usage_prompt_tokens": upstream.get("prompt_tokens"),
+        "usage_completion_tokens": upstream.get("completion_tokens"),
+        "cache": served.get("cache"),
+    }
+
+
+@metrics.instrument("chatbot_generate")
+def chatbot_generate(user_newest_input, conversation, model, session=None):
     """
     Generate the next response from the chatbot
     :param user_newest_input: The newest input from the user
-    :param history: The history of the conversation
-        list[str], where each element starts with "User:" or "AI:"
-    :return: The chatbot state, the history, the text, the submit button
-    """
-    # convert to openai model format
-    actual_model = {
-        "chatgpt": "gpt-3.5-turbo",
-        "chatgpt4": "gpt-4",
-        "instructgpt": "text-davinci-003"
-    }[model]
-
-    # Update the history with newest user input
-    history.append(f"User: {user_newest_input.strip()}")
-
-    # construct chat messages
-    chat_messages = [{"role": "system", "content": "You are a helpful assistant to a professional mathematician."}]
-    for hist in history:
-        if hist.startswith("User:"):
-            chat_messages.append(
-                {
-                    "role": "user",
-                    "content": hist[5:].strip()
-                }
-            )
-        elif hist.startswith("AI:"):
-            chat_messages.append(
-                {
-                    "role": "assistant",
-                    "content": hist[3:].strip()
-                }
-            )
-        else:
-            raise NotImplementedError
-    
+    :param conversation: The conversation so far (conversation.Conversation), updated in place
+    :param session: The session state of the participant (experiment.new_session), to take turns with the other
+        participants under the rate limits of the model
+    :return: The chatbot state, the conversation, the text, the submit button
+    """
+    actual_model = actual_model_names[model]
+    participant = participant_of(session)
+
+    # Update the conversation with newest user input
+    conversation.ask(user_newest_input)
+
+    # construct chat messages, within the context window of the model
+    chat_messages, context = prepare_context(conversation, actual_model)
+    requested_at, start, served = time.time(), time.perf_counter(), {}
+
     # Get the generation from OpenAI
-    if actual_model in ["gpt-3.5-turbo", "gpt-4"]:
-        ai_newest_output = query_a_chat_completion(actual_model, chat_messages)
-    elif actual_model == "text-davinci-003":
-        ai_newest_output = pretend_a_chat_completion(actual_model, chat_messages)
+    try:
+        if actual_model in COMPLETION_MODELS:
+            ai_newest_output = pretend_a_chat_completion(actual_model, chat_messages, participant, served)
+        else:
+            ai_newest_output = query_a_chat_completion(actual_model, chat_messages, participant, served)
+    except ModelBackendError as error:
+        raise unanswered(conversation, error)
+
+    # Update the conversation with newest AI output; the whole reply arrives at once
+    latency = time.perf_counter() - start
+    conversation.answer(ai_newest_output, **context, **reply_record(served, requested_at, latency, latency))
+    return chatbot_outputs(conversation)
+
+
+@metrics.instrument("chatbot_generate_stream")
+def chatbot_generate_stream(user_newest_input, conversation, model, session=None):
+    """
+    Streaming version of chatbot_generate, to be used as a gradio generator handler
+    Yields partial chatbot updates as the tokens arrive; the final yield (and the saved conversation)
+    is identical to what chatbot_generate returns
+    """
+    actual_model = actual_model_names[model]
+    participant = participant_of(session)
+
+    question = conversation.ask(user_newest_input)
+    chat_messages, context = prepare_context(conversation, actual_model)
+    requested_at, start, served = time.time(), time.perf_counter(), {}
+
+    if actual_model in COMPLETION_MODELS:
+        stream = stream_pretend_a_chat_completion(actual_model, chat_messages, participant, served)
     else:
-        raise NotImplementedError
-    
-    # Update the history with newest AI output
-    history.append(f"AI: {ai_newest_output.strip()}")
-    conversations = [(history[i], history[i+1]) for i in range(0, len(history)-1, 2)]
+        stream = stream_a_chat_completion(actual_model, chat_messages, participant, served)
 
-    # Whether the textbox and the submit button should be hidden
-    if len(history) >= 2*MAX_CONVERSATION_LENGTH:
-        return conversations, history, gr.update(visible=False), gr.update(visible=False)
+    pairs = conversation.pairs()
+    pieces, first_token_latency = [], None
+    try:
+        for piece in stream:
+            if first_token_latency is None:
+                first_token_latency = time.perf_counter() - start
+            pieces.append(piece)
+            partial = "".join(pieces).strip()
+            yield pairs + [(question.display(), f"AI: {partial}")], conversation, gr.update(), gr.update()
+    except ModelBackendError as error:
+        # Clear the partial reply from the chatbot before showing the error
+        error = unanswered(conversation, error)
+        yield chatbot_outputs(conversation)
+        raise error
+
+    record = reply_record(served, requested_at, time.perf_counter() - start, first_token_latency)
+    conversation.answer("".join(pieces), **context, **record)
+    yield chatbot_outputs(conversation)
+
+
+@metrics.instrument("chatbot_generate_async")
+async def chatbot_generate_async(user_newest_input, conversation, model, session=None):
+    """
+    Same as chatbot_generate, but awaits the model instead of blocking a gradio worker thread
+    """
+    actual_model = actual_model_names[model]
+    participant = participant_of(session)
+
+    conversation.ask(user_newest_input)
+    chat_messages, context = prepare_context(conversation, actual_model)
+    requested_at, start, served = time.time(), time.perf_counter(), {}
+
+    try:
+        if actual_model in COMPLETION_MODELS:
+            ai_newest_output = await pretend_a_chat_completion_async(actual_model, chat_messages, participant, served)
+        else:
+            ai_newest_output = await query_a_chat_completion_async(actual_model, chat_messages, participant, served)
+    except ModelBackendError as error:
+        raise unanswered(conversation, error)
+
+    # The whole reply arrives at once
+    latency = time.perf_counter() - start
+    conversation.answer(ai_newest_output, **context, **reply_record(served, requested_at, latency, latency))
+    return chatbot_outputs(conversation)
+
+
+@metrics.instrument("chatbot_generate_stream_async")
+async def chatbot_generate_stream_async(user_newest_input, conversation, model, session=None):
+    """
+    Async generator version of chatbot_generate_stream, for gradio versions that accept async generator handlers
+    """
+    actual_model = actual_model_names[model]
+    participant = participant_of(session)
+
+    question = conversation.ask(user_newest_input)
+    chat_messages, context = prepare_context(conversation, actual_model)
+    requested_at, start, served = time.time(), time.perf_counter(), {}
+
+    if actual_model in COMPLETION_MODELS:
+        stream = stream_pretend_a_chat_completion_async(actual_model, chat_messages, participant, served)
     else:
-        return conversations, history, gr.update(visible=True), gr.update(visible=True)
+        stream = stream_a_chat_completion_async(actual_model, chat_messages, participant, served)
+
+    pairs = conversation.pairs()
+    pieces, first_token_latency = [], None
+    try:
+        async for piece in stream:
+            if first_token_latency is None:
+                first_token_latency = time.perf_counter() - start
+            pieces.append(piece)
+            partial = "".join(pieces).strip()
+            yield pairs + [(question.display(), f"AI: {partial}")], conversation, gr.update(), gr.update()
+    except ModelBackendError as error:
+        error = unanswered(conversation, error)
+        yield chatbot_outputs(conversation)
+        raise error
+
+    record = reply_record(served, requested_at, time.perf_counter() - start, first_token_latency)
+    conversation.answer("".join(pieces), **context, **record)
+    yield chatbot_outputs(conversation)
@@ -0,0 +1,167 @@
+"""
+Client-side rate limiting of the model calls, for the whole process: every upstream request waits for its turn
+under the requests and tokens per minute allowed for its model (constants.RATE_LIMITS), instead of being sent anyway
+and answered 429 when many participants chat at once.
+
+Each model has two token buckets, refilled continuously: one of requests, one of tokens (the prompt tokens and the
+max_tokens of the reply, which is what OpenAI counts against the limit). A request goes at once if both buckets have
+enough left and nobody is waiting; otherwise it joins the queue of its participant. The queues are served in turn,
+one request per participant per round, so a participant sending many requests only delays their own.
+Used by the backend (model_backend.py) before every upstream request, retries and hedged requests included, on the
+backend event loop.
+"""
+import asyncio
+import collections
+import time
+
+from constants import RATE_LIMITS, RATE_LIMIT_HEADROOM, RATE_LIMIT_MAX_WAIT
+from resilience import Overloaded
+from token_counter import count_message_tokens, count_tokens
+
+
+def request_tokens(payload):
+    """Tokens a request counts against the limit of its model: its prompt, and the longest reply it allows"""
+    model = payload["model"]
+    if "messages" in payload:
+        prompt_tokens = count_message_tokens(payload["messages"], model)
+    else:
+        prompt_tokens = count_tokens(payload["prompt"], model)
+    return prompt_tokens + (payload.get("max_tokens") or 16)
+
+
+class TokenBucket:
+    """`rate` units per minute, of which up to `burst` seconds' worth can be saved up"""
+
+    def __init__(self, rate, burst=60.):
+        self.rate = rate / 60.
+        self.capacity = self.rate * burst
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount):
+        """Seconds before `amount` units are available (a request larger than the capacity waits for a full bucket)"""
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0., (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class ModelQueue:
+    """The buckets of one model, and the requests waiting for them, queued per participant"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, burst=60.):
+        self.requests = TokenBucket(requests_per_minute, burst)
+        self.tokens = TokenBucket(tokens_per_minute, burst)
+        self.participants = collections.OrderedDict()  # participant: deque of (future, tokens), in turn order
+        self.dispatcher = None
+        self.held_until = 0.
+        self.admitted = 0
+        self.queued = 0
+        self.overloaded = 0
+        self.waits = collections.deque(maxlen=1000)  # seconds waited by the recently admitted requests
+
+    def delay(self, tokens):
+        return max(self.held_until - time.monotonic(), self.requests.delay(1), self.tokens.delay(tokens))
+
+    def take(self, tokens):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def depth(self):
+        return sum(not future.done() for waiting in list(self.participants.values()) for future, _ in waiting)
+
+
+class RateLimiter:
+    def __init__(self, limits=None, headroom=RATE_LIMIT_HEADROOM, max_wait=RATE_LIMIT_MAX_WAIT, burst=60.):
+        """
+        :param limits: {model: {"requests": per minute, "tokens": per minute}}, models not listed are not limited
+        :param headroom: share of the limits to use
+        :param max_wait: seconds a request may wait for its turn before failing with Overloaded
+        :param burst: seconds' worth of the limits that can be used at once, after a quiet period
+        """
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self.headroom = headroom
+        self.max_wait = max_wait
+        self.burst = burst
+        # Only touched from the backend loop
+        self.queues = {}
+
+    def queue(self, model):
+        """The queue of a model, None if it is not limited"""
+        if model not in self.queues and model in self.limits:
+            limit = self.limits[model]
+            self.queues[model] = ModelQueue(limit["requests"] * self.headroom, limit["tokens"] * self.headroom,
+                                           self.burst)
+        return self.queues.get(model)
+
+    async def acquire(self, model, tokens, participant=None):
+        """
+        Wait until a request of `tokens` tokens may be sent to the model
+        :param participant: who the request is for, e.g. the id of their session; requests without one share a queue
+        """
+        queue = self.queue(model)
+        if queue is None:
+            return
+        start = time.monotonic()
+        if not queue.participants and queue.delay(tokens) == 0:
+            queue.take(tokens)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            queue.participants.setdefault(participant, collections.deque()).append((future, tokens))
+            queue.queued += 1
+            if queue.dispatcher is None or queue.dispatcher.done():
+                queue.dispatcher = asyncio.ensure_future(self._dispatch(queue))
+            try:
+                await asyncio.wait_for(future, self.max_wait)
+            except asyncio.TimeoutError:
+                queue.overloaded += 1
+                raise Overloaded(model, self.max_wait) from None
+        queue.admitted += 1
+        queue.waits.append(time.monotonic() - start)
+
+    async def _dispatch(self, queue):
+        """Admit the waiting requests as the buckets allow, taking the participants in turn"""
+        while queue.participants:
+            participant, waiting = next(iter(queue.participants.items()))
+            future, tokens = waiting[0]
+            if future.done():
+                # Gave up waiting (deadline of the call, participant gone)
+                waiting.popleft()
+            else:
+                delay = queue.delay(tokens)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                queue.take(tokens)
+                waiting.popleft()
+                future.set_result(None)
+                # Their next request comes after those of everyone else waiting
+                queue.participants.move_to_end(participant)
+            if not waiting:
+                del queue.participants[participant]
+
+    def hold(self, model, seconds):
+        """Send nothing more to the model for a while, e.g. after it answered 429 with a Retry-After"""
+        queue = self.queue(model)
+        if queue is not None:
+            queue.held_until = max(queue.held_until, time.monotonic() + seconds)
+
+    def stats(self):
+        """Per limited model: requests admitted, how many had to queue or gave up, the queue now, and wait times"""
+        stats = {}
+        for model, queue in list(self.queues.items()):
+            waits = sorted(queue.waits)
+            stats[model] = {
+                "admitted": queue.admitted,
+                "queued": queue.queued,
+                "overloaded": queue.overloaded,
+                "queue_depth": queue.depth(),
+                "waiting_participants": len(queue.participants),
+                "wait_mean": sum(waits) / len(waits) if waits else 0.,
+                "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.,
+                "wait_max": waits[-1] if waits else 0.,
+            }
+        return stats
@@ -0,0 +1,390 @@
+"""
+Deadlines, retries, circuit breaking and hedging of the model calls, used by the backend (model_backend.py) around
+every upstream request, on the backend event loop.
+
+- Every call, retries included, finishes within the deadline of its model (DeadlineExceeded otherwise).
+- Rate limits (429), server errors (5xx), timeouts and connection errors are retried with exponential backoff and
+  full jitter (or after the Retry-After of the response, if longer). Streams are only retried before their first
+  piece: what was shown to the participant cannot be taken back.
+- After a number of consecutive failures (rate limits aside), the circuit of the model opens: calls fail at once
+  (CircuitOpen) instead of waiting on an unhealthy upstream, until a single probe call succeeds after a cooldown.
+- Optionally, a request still unanswered (a stream without its first piece) after the p95 latency of its model is
+  sent again, and the first answer is used; the share of hedged requests is capped.
+"""
+import asyncio
+import collections
+import random
+import time
+
+import aiohttp
+
+from constants import MODEL_DEADLINES, DEFAULT_MODEL_DEADLINE, MAX_RETRIES, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, \
+    CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET, HEDGE_REQUESTS, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, \
+    HEDGE_MAX_RATE
+
+retryable_statuses = {429, 500, 502, 503, 504}
+
+
+class ModelBackendError(Exception):
+    """An error response from the model API"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"Model API error {status}: {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(ModelBackendError):
+    def __init__(self, model, deadline):
+        super().__init__(504, f"{model} did not answer within {deadline:g}s")
+
+
+class CircuitOpen(ModelBackendError):
+    def __init__(self, model, retry_after):
+        super().__init__(503, f"{model} is failing, not calling it for {retry_after:.0f}s", retry_after=retry_after)
+
+
+class Overloaded(ModelBackendError):
+    """The request waited too long for its turn under the client-side rate limits (rate_limiter.py)"""
+
+    def __init__(self, model, waited):
+        super().__init__(429, f"too many requests to {model}, not sent within {waited:g}s")
+
+
+def as_backend_error(error):
+    """Timeouts and connection failures as ModelBackendError, to be retried like server errors"""
+    if isinstance(error, ModelBackendError):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        return ModelBackendError(504, "request timed out")
+    if isinstance(error, (aiohttp.ClientError, OSError)):
+        return ModelBackendError(502, f"connection failed: {error}")
+    return None
+
+
+class CircuitBreaker:
+    """Closed, open after `failures` consecutive failures, half-open (one probe call) after `reset` seconds"""
+
+    def __init__(self, failures=CIRCUIT_BREAKER_FAILURES, reset=CIRCUIT_BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def check(self, model):
+        """Raises CircuitOpen if the call must not be made"""
+        if self.state == "open":
+            remaining = self.opened_at + self.reset - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpen(model, remaining)
+            self.state = "half-open"
+        if self.state == "half-open":
+            if self.probing:
+                raise CircuitOpen(model, self.reset)
+            self.probing = True
+
+    def success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half-open" or self.consecutive_failures >= self.failures:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """The call ended without telling whether the upstream is healthy (e.g. a client error)"""
+        self.probing = False
+
+
+class LatencyTracker:
+    """Recent latencies of the successful calls of a model, for the hedging threshold"""
+
+    def __init__(self, size=200):
+        self.latencies = collections.deque(maxlen=size)
+
+    def add(self, latency):
+        self.latencies.append(latency)
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class Resilience:
+    def __init__(self, deadlines=None, default_deadline=DEFAULT_MODEL_DEADLINE, max_retries=MAX_RETRIES,
+                 backoff_base=RETRY_BACKOFF_BASE, backoff_max=RETRY_BACKOFF_MAX, breaker_failures=CIRCUIT_BREAKER_FAILURES,
+                 breaker_reset=CIRCUIT_BREAKER_RESET, hedge=HEDGE_REQUESTS, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, hedge_max_rate=HEDGE_MAX_RATE):
+        """
+        :param deadlines: {model: seconds a call may take, retries included}
+        :param max_retries: retries after the first attempt
+        :param backoff_base: the n-th retry waits a random time up to min(backoff_max, backoff_base * 2 ** n)
+        :param breaker_failures: consecutive failures that open the circuit of a model
+        :param breaker_reset: seconds the circuit stays open before a probe call
+        :param hedge: whether to send a second request when the first is slower than the hedge_percentile latency
+            (once hedge_min_samples latencies were seen), for at most hedge_max_rate of the requests
+        """
+        self.deadlines = dict(MODEL_DEADLINES if deadlines is None else deadlines)
+        self.default_deadline = default_deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_max_rate = hedge_max_rate
+        # Only touched from the backend loop
+        self.breakers = {}
+        self.trackers = {}
+        self.counters = collections.Counter()
+        self.hedges_reserved = 0
+
+    def breaker(self, model):
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+        return self.breakers[model]
+
+    def tracker(self, model, kind):
+        if (model, kind) not in self.trackers:
+            self.trackers[(model, kind)] = LatencyTracker()
+        return self.trackers[(model, kind)]
+
+    def deadline(self, model):
+        return self.deadlines.get(model, self.default_deadline)
+
+    def backoff(self, retry, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+        return max(delay, error.retry_after or 0.)
+
+    def hedge_delay(self, model, kind):
+        """Seconds after which to hedge a request, or None"""
+        # The hedges being considered count against the cap, or concurrent requests could all hedge at once
+        budget = self.hedge_max_rate * self.counters["requests"]
+        if not self.hedge or self.counters["hedged"] + self.hedges_reserved >= budget:
+            return None
+        tracker = self.tracker(model, kind)
+        if len(tracker.latencies) < self.hedge_min_samples:
+            return None
+        return tracker.percentile(self.hedge_percentile)
+
+    async def should_hedge(self, model, kind, tasks):
+        """
+        Wait for the hedge delay of the model, with a hedge reserved under the cap meanwhile
+        :return: whether the request (tasks) is still unanswered and must be sent again; the reserved hedge is given
+            back otherwise
+        """
+        delay = self.hedge_delay(model, kind)
+        if delay is None:
+            return False
+        self.hedges_reserved += 1
+        hedge = False
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            hedge = not done
+        finally:
+            self.hedges_reserved -= 1
+            if hedge:
+                self.counters["hedged"] += 1
+        return hedge
+
+    async def _retrying(self, model, attempt, settle=True):
+        """
+        Run attempt() until it succeeds, or fails in a way not worth retrying, within the deadline of the model
+        :param settle: whether its success tells that the model is healthy; if not (a stream that has only begun),
+            the caller reports to the circuit breaker of the model how the call ended
+        """
+        loop = asyncio.get_running_loop()
+        deadline = self.deadline(model)
+        end = loop.time() + deadline
+        breaker = self.breaker(model)
+        self.counters["requests"] += 1
+        retry = 0
+        while True:
+            breaker.check(model)
+            # The timeouts of the attempt itself (e.g. of the HTTP request) are retried, not the deadline
+            task = await _until(end, attempt())
+            if task is None:
+                breaker.failure()
+                self.counters["deadlines"] += 1
+                raise DeadlineExceeded(model, deadline)
+            try:
+                result = task.result()
+            except Overloaded:
+                # Never reached the model: says nothing of its health, and retrying would only queue it again
+                breaker.release()
+                self.counters["overloaded"] += 1
+                raise
+            except Exception as e:
+                error = as_backend_error(e)
+                if error is None:
+                    breaker.release()
+                    raise
+                if error.status == 429:
+                    self.counters["rate_limited"] += 1
+                    breaker.release()
+                elif error.status in retryable_statuses:
+                    breaker.failure()
+                else:
+                    breaker.release()
+                delay = self.backoff(retry, error)
+                if error.status not in retryable_statuses or retry >= self.max_retries or loop.time() + delay >= end:
+                    if error is e:
+                        raise
+                    raise error from e
+                self.counters["retries"] += 1
+                retry += 1
+                await asyncio.sleep(delay)
+                continue
+            if settle:
+                breaker.success()
+            return result
+
+    async def call(self, model, request):
+        """The result of request() (a coroutine function, one upstream request), with retries and hedging"""
+        return await self._retrying(model, lambda: self._hedged(model, request))
+
+    async def _hedged(self, model, request):
+        tracker = self.tracker(model, "complete")
+        start = time.monotonic()
+        first = asyncio.ensure_future(request())
+        tasks = {first}
+        try:
+            if await self.should_hedge(model, "complete", tasks):
+                tasks.add(asyncio.ensure_future(request()))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.counters["hedge_wins"] += 1
+                        tracker.add(time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, model, open_stream):
+        """
+        The pieces of open_stream() (an async generator, one upstream streaming request), retried and hedged on
+        its first piece; later pieces must each arrive before the deadline
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.deadline(model)
+        upstream, first = await self._retrying(model, lambda: self._first_piece(model, open_stream), settle=False)
+        # The model is only healthy if the stream ends well: one that reliably stalls must open its circuit
+        breaker = self.breaker(model)
+        settled = False
+        try:
+            if first is None:
+                breaker.success()
+                settled = True
+                return
+            yield first
+            while True:
+                task = await _until(end, upstream.__anext__())
+                if task is None:
+                    breaker.failure()
+                    settled = True
+                    self.counters["deadlines"] += 1
+                    raise DeadlineExceeded(model, self.deadline(model))
+                try:
+                    piece = task.result()
+                except StopAsyncIteration:
+                    breaker.success()
+                    settled = True
+                    return
+                except Exception as e:
+                    error = as_backend_error(e)
+                    if error is None:
+                        raise
+                    if error.status in retryable_statuses and error.status != 429:
+                        breaker.failure()
+                        settled = True
+                    if error is e:
+                        raise
+                    raise error from e
+                yield piece
+        finally:
+            if not settled:
+                # Closed by the caller, or failed in a way that says nothing of the model
+                breaker.release()
+            await upstream.aclose()
+
+    async def _first_piece(self, model, open_stream):
+        """(stream, its first piece or None if empty) of the first of one or two (hedged) requests to send a piece"""
+        tracker = self.tracker(model, "first_piece")
+        start = time.monotonic()
+        streams = {}
+
+        def launch():
+            stream = open_stream()
+            task = asyncio.ensure_future(_next_or_none(stream))
+            streams[task] = stream
+            return task
+
+        first = launch()
+        tasks = {first}
+        try:
+            if await self.should_hedge(model, "first_piece", tasks):
+                tasks.add(launch())
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.counters["hedge_wins"] += 1
+                        tracker.add(time.monotonic() - start)
+                        winner = streams.pop(task)
+                        return winner, task.result()
+                    error = task.exception()
+                    await streams.pop(task).aclose()
+            raise error
+        finally:
+            # The streams that lost the race (or were still waiting on their first piece)
+            for task, stream in streams.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+    def stats(self):
+        return dict(self.counters, circuits={model: breaker.state for model, breaker in self.breakers.items()})
+
+
+async def _until(end, awaitable):
+    """
+    The task of awaitable once done, or None if it was not done by the loop time end (it is cancelled then); unlike
+    asyncio.wait_for, timeouts raised by awaitable itself are not mistaken for the end
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=max(0., end - asyncio.get_running_loop().time()))
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        elif not task.cancelled():
+            # Retrieved, in case the caller was cancelled as it ended
+            task.exception()
+    return task if done else None
+
+
+async def _next_or_none(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
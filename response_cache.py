@@ -0,0 +1,128 @@
+"""
+On-disk cache of model generations, stored in SQLite.
+
+Entries are keyed by a canonical hash of (model, messages, max_tokens, temperature), evicted
+least-recently-used beyond max_entries and expired after ttl seconds. Sampled generations
+(temperature > 0) are not deterministic, so they bypass the cache.
+Expired entries are never served; they are deleted when the cache is opened and whenever the number of entries
+(counted in memory, so a store costs no query) goes beyond max_entries, before the least recently used ones, a tenth
+of max_entries at a time, so that a full cache is not counted again on every store.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    def __init__(self, path, max_entries=10000, ttl=7 * 24 * 3600, enabled=True):
+        """
+        :param path: sqlite file, created (with its directory) on first use
+        :param max_entries: least recently used entries beyond this are evicted
+        :param ttl: seconds after which an entry is no longer served, None to keep entries forever
+        :param enabled: if False every lookup is a bypass
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.counters = {"hits": 0, "misses": 0, "bypasses": 0, "stores": 0, "evictions": 0}
+        self._connection = None
+        # Entries in the table, counted when it is opened; an upper bound, as a store may replace an entry
+        self._entries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_access REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self._connection = connection
+            self._evict(time.time())
+        return self._connection
+
+    @staticmethod
+    def make_key(model, messages, max_tokens, temperature):
+        canonical = json.dumps(
+            {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": float(temperature)},
+            sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def key_for(self, model, messages, max_tokens, temperature, **other_params):
+        """
+        The cache key of a generation, or None if it must bypass the cache
+        (cache disabled, sampling with temperature > 0, or extra sampling parameters)
+        """
+        if not self.enabled or temperature > 0 or other_params:
+            with self._lock:
+                self.counters["bypasses"] += 1
+            return None
+        return self.make_key(model, messages, max_tokens, temperature)
+
+    def get(self, key):
+        """The cached response for key, or None"""
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.counters["misses"] += 1
+                return None
+            self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.counters["hits"] += 1
+        return row[0]
+
+    def put(self, key, model, response):
+        if key is None:
+            return
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self.counters["stores"] += 1
+            self._entries += 1
+            if self._entries > self.max_entries:
+                self._evict(now)
+
+    def _evict(self, now):
+        """Delete the expired entries, then the least recently used down to nine tenths of max_entries"""
+        connection = self._connection
+        evicted = 0
+        if self.ttl is not None:
+            evicted += connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        self._entries = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if self._entries > self.max_entries:
+            keep = self.max_entries - self.max_entries // 10
+            evicted += connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (self._entries - keep,),
+            ).rowcount
+            self._entries = keep
+        self.counters["evictions"] += evicted
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return dict(self.counters, hit_rate=self.counters["hits"] / lookups if lookups else 0.)
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses")
+            self._entries = 0
@@ -0,0 +1,244 @@
+"""
+Append-only store of the study results, in SQLite (WAL mode).
+
+Handlers call write(), which only queues the record. A background writer thread commits the queued
+records in batches, one transaction (and so one fsync) per batch, so many concurrent sessions share
+each fsync. A committed record survives a crash of the process or of the machine; records are never
+updated in place, a later record of the same kind and scope supersedes the earlier ones.
+Reads (records(), latest(), sessions()) first wait for the records already queued, so a session always
+reads its own writes.
+A batch that cannot be committed (e.g. disk full, database locked) is retried a few times, then kept in memory and
+retried with the next batch, and the flushes waiting for it are told it failed: a broken database hangs neither the
+writer nor the readers, which warn and read what was committed.
+"""
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+
+from metrics import metrics
+
+
+class Waiter:
+    """A flush (or stop) of the writer, done once the records queued before it were committed or failed to be"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class ResultStore:
+    def __init__(self, path, batch_size=256, flush_interval=0.05, commit_retries=5, read_timeout=10.):
+        """
+        :param path: sqlite file, created (with its directory) on first use
+        :param batch_size: maximum number of records committed in one transaction
+        :param flush_interval: seconds the writer waits for more records before committing a batch
+        :param commit_retries: retries, a second apart, of a batch that failed to commit before it is put off to the
+            next batch
+        :param read_timeout: seconds the reads wait for the queued records to be committed
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.commit_retries = commit_retries
+        self.read_timeout = read_timeout
+        self.counters = {"records": 0, "batches": 0, "commit_errors": 0}
+        self.last_error = None
+        # Records of the batches that failed to commit, retried with the next one
+        self._unsaved = []
+        self._queue = queue.Queue()
+        self._connection = None
+        self._writer = None
+        self._start_lock = threading.Lock()
+        # Serialises the use of the connection between the writer and the readers
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Every commit is fsynced: with WAL, that is one sequential write per batch
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, kind TEXT NOT NULL, "
+            "problem_set_index INTEGER, model TEXT, created_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS records_session ON records (session_id, kind)")
+        connection.execute("CREATE INDEX IF NOT EXISTS records_kind ON records (kind)")
+        return connection
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            with self._start_lock:
+                if self._connection is None:
+                    self._connection = self._connect()
+        return self._connection
+
+    def _start_writer(self):
+        if self._writer is None:
+            with self._start_lock:
+                if self._writer is None:
+                    writer = threading.Thread(target=self._run, name="result-store-writer", daemon=True)
+                    writer.start()
+                    atexit.register(self.close)
+                    self._writer = writer
+
+    def write(self, session_id, kind, data, problem_set_index=None, model=None):
+        """
+        Queue a record, returns immediately
+        :param kind: what the record is, e.g. "solo_solve" or "conversation_rating"
+        :param data: anything json serialisable
+        :param problem_set_index, model: the scope of the record within the session, if any
+        """
+        self._start_writer()
+        self._queue.put((
+            "record",
+            (session_id, kind, None if problem_set_index is None else int(problem_set_index), model, time.time(),
+             json.dumps(data)),
+        ))
+
+    def flush(self, timeout=None):
+        """
+        Block until every record queued so far is committed
+        :return: False if they were not committed within timeout seconds, or failed to be (see last_error)
+        """
+        if self._writer is None:
+            return not self._unsaved
+        waiter = Waiter()
+        self._queue.put(("flush", waiter))
+        return waiter.done.wait(timeout) and waiter.error is None
+
+    def close(self, timeout=30.):
+        """
+        Commit the queued records and stop the writer; writing again starts a new one
+        :return: False if the records were not all committed within timeout seconds (the writer is then left running)
+        """
+        if self._writer is None:
+            if not self._unsaved:
+                return True
+            # Records that an earlier close could not save: try them again
+            self._start_writer()
+        waiter = Waiter()
+        self._queue.put(("stop", waiter))
+        if not waiter.done.wait(timeout):
+            print(f"Result store {self.path}: the queued records were not committed within {timeout:g}s of closing")
+            return False
+        self._writer = None
+        if waiter.error is not None:
+            print(f"Result store {self.path}: {len(self._unsaved)} records could not be saved ({waiter.error})")
+            return False
+        return True
+
+    # Writer thread
+
+    def _run(self):
+        while True:
+            batch, waiters, stop = [], [], False
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item[0] == "record":
+                    batch.append(item[1])
+                else:
+                    waiters.append(item[1])
+                    stop = item[0] == "stop"
+                if waiters or len(batch) >= self.batch_size:
+                    # Somebody is waiting: commit now
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            error = self._commit(self._unsaved + batch) if batch or self._unsaved else None
+            for waiter in waiters:
+                waiter.error = error
+                waiter.done.set()
+            if stop:
+                return
+
+    @metrics.instrument("result_store_commit")
+    def _commit(self, batch):
+        """:return: None once the batch is committed, else the error of its last attempt"""
+        self._unsaved = []
+        for attempt in range(self.commit_retries + 1):
+            if attempt:
+                time.sleep(1.)
+            try:
+                connection = self.connection
+                with self._lock:
+                    connection.execute("BEGIN")
+                    try:
+                        connection.executemany(
+                            "INSERT INTO records (session_id, kind, problem_set_index, model, created_at, data) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", batch
+                        )
+                        connection.execute("COMMIT")
+                    except BaseException:
+                        connection.execute("ROLLBACK")
+                        raise
+                self.counters["records"] += len(batch)
+                self.counters["batches"] += 1
+                metrics.inc("results_saved_total", len(batch))
+                return None
+            except sqlite3.Error as e:
+                # e.g. disk full or database locked: keep the records and retry rather than lose them
+                self.counters["commit_errors"] += 1
+                self.last_error = e
+                traceback.print_exc()
+        self._unsaved = batch
+        return self.last_error
+
+    def _flush_for_reading(self):
+        if not self.flush(self.read_timeout):
+            print(f"Result store {self.path}: reading without the records not committed yet "
+                  f"({self.last_error or f'still queued after {self.read_timeout:g}s'})")
+
+    # Reader API
+
+    def records(self, kind=None, session_id=None, problem_set_index=None, model=None, after_id=0):
+        """
+        The records matching the given fields, oldest first, as dicts
+        {"id", "session_id", "kind", "problem_set_index", "model", "created_at", "data"}
+        :param after_id: only records with a larger id, to read incrementally
+        """
+        self._flush_for_reading()
+        conditions, parameters = ["id > ?"], [after_id]
+        for column, value in [("kind", kind), ("session_id", session_id),
+                              ("problem_set_index", problem_set_index), ("model", model)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        connection = self.connection
+        with self._lock:
+            rows = connection.execute(
+                "SELECT id, session_id, kind, problem_set_index, model, created_at, data FROM records "
+                f"WHERE {' AND '.join(conditions)} ORDER BY id", parameters
+            ).fetchall()
+        return [
+            {"id": row[0], "session_id": row[1], "kind": row[2], "problem_set_index": row[3], "model": row[4],
+             "created_at": row[5], "data": json.loads(row[6])}
+            for row in rows
+        ]
+
+    def latest(self, kind, session_id, problem_set_index=None, model=None):
+        """The data of the most recent matching record, or None"""
+        matching = self.records(kind, session_id, problem_set_index, model)
+        return matching[-1]["data"] if matching else None
+
+    def sessions(self):
+        """The ids of the sessions with at least one record, in order of their first record"""
+        self._flush_for_reading()
+        connection = self.connection
+        with self._lock:
+            rows = connection.execute(
+                "SELECT session_id FROM records GROUP BY session_id ORDER BY MIN(id)"
+            ).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,160 @@
+"""
+Single-flight generations: concurrent identical requests share one upstream call.
+
+When several participants paste the same problem statement as their first query, the identical deterministic
+requests (same model, messages and parameters) join the one already in flight instead of each calling the model.
+A Flight is driven on the backend event loop, independently of who waits on it, so a participant closing the page
+does not cancel the generation the others are waiting for; every waiter (blocking, async or streaming) gets all the
+pieces received so far, then the next ones as they arrive.
+"""
+import asyncio
+import threading
+
+
+class Flight:
+    """One upstream generation, and the pieces of it received so far"""
+
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.condition = threading.Condition()
+        self.listeners = []  # called (from the backend loop) whenever a piece arrives or the flight lands
+        self.upstream = {}  # what is known of the upstream call (token usage, latency), for every waiter
+
+    def publish(self, piece):
+        with self.condition:
+            self.pieces.append(piece)
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def follow(self):
+        """The pieces of the generation, blocking the calling thread until each arrives"""
+        index = 0
+        while True:
+            with self.condition:
+                while index == len(self.pieces) and not self.done:
+                    self.condition.wait()
+                pieces, done, error = self.pieces[index:], self.done, self.error
+            index += len(pieces)
+            yield from pieces
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    async def follow_async(self):
+        """Same as follow, awaiting the pieces on the running event loop"""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def listener():
+            try:
+                loop.call_soon_threadsafe(changed.set)
+            except RuntimeError:
+                pass  # the waiting loop was closed
+
+        with self.condition:
+            self.listeners.append(listener)
+        try:
+            index = 0
+            while True:
+                changed.clear()
+                with self.condition:
+                    pieces, done, error = self.pieces[index:], self.done, self.error
+                index += len(pieces)
+                for piece in pieces:
+                    yield piece
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+                await changed.wait()
+        finally:
+            with self.condition:
+                self.listeners.remove(listener)
+
+    def result(self):
+        return "".join(self.follow())
+
+    async def result_async(self):
+        return "".join([piece async for piece in self.follow_async()])
+
+
+class SingleFlight:
+    def __init__(self, submit):
+        """
+        :param submit: schedules a coroutine on the backend event loop (model_backend.AsyncModelBackend.submit)
+        """
+        self.submit = submit
+        self.in_flight = {}
+        self.counters = {"requests": 0, "upstream": 0, "coalesced": 0, "errors": 0, "max_waiters": 0}
+        self._lock = threading.Lock()
+
+    def join(self, key, make_stream, on_complete=None, upstream=None):
+        """
+        The flight of a request: the one in flight with the same key, or a new one
+        :param key: identifies identical requests, None for a request that must not be shared (e.g. sampled)
+        :param make_stream: returns the async iterator of the pieces of the upstream generation
+        :param on_complete: called (in a worker thread) with the full response once it arrived, before the flight
+            lands, e.g. to cache it; requests made after that are served by the cache
+        :param upstream: the dict make_stream fills with what it learns of the upstream call, kept as the
+            flight.upstream of a new flight; a request that joins a flight in the air gets the flight's own
+        """
+        with self._lock:
+            self.counters["requests"] += 1
+            flight = self.in_flight.get(key) if key is not None else None
+            if flight is not None:
+                flight.waiters += 1
+                self.counters["coalesced"] += 1
+                self.counters["max_waiters"] = max(self.counters["max_waiters"], flight.waiters)
+                return flight
+            flight = Flight()
+            flight.waiters = 1
+            if upstream is not None:
+                flight.upstream = upstream
+            self.counters["upstream"] += 1
+            if key is not None:
+                self.in_flight[key] = flight
+        self.submit(self._drive(key, flight, make_stream, on_complete))
+        return flight
+
+    async def _drive(self, key, flight, make_stream, on_complete):
+        try:
+            async for piece in make_stream():
+                flight.publish(piece)
+            if on_complete is not None:
+                await asyncio.get_running_loop().run_in_executor(None, on_complete, "".join(flight.pieces))
+        except BaseException as error:
+            # Every waiter gets the error (cancellation included, e.g. when the backend loop stops)
+            self._land(key, flight, error)
+            if not isinstance(error, Exception):
+                raise
+        else:
+            self._land(key, flight)
+
+    def _land(self, key, flight, error=None):
+        with self._lock:
+            if key is not None and self.in_flight.get(key) is flight:
+                del self.in_flight[key]
+            if error is not None:
+                self.counters["errors"] += 1
+        flight.finish(error)
+
+    def stats(self):
+        with self._lock:
+            requests = self.counters["requests"]
+            return dict(self.counters, in_flight=len(self.in_flight),
+                        coalesced_rate=self.counters["coalesced"] / requests if requests else 0.)
@@ -0,0 +1,43 @@
+"""
+Token counts of prompts and chat messages, with tiktoken when it is installed (pip install tiktoken), otherwise
+with an approximation: one token per punctuation or symbol character and per chunk of up to 4 word characters, which
+is close to the BPE counts of English and LaTeX text.
+"""
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+approximate_token_pattern = re.compile(r"\w{1,4}|[^\w\s]")
+# Tokens added by the chat format around each message, and to prime the reply (as counted by OpenAI's cookbook)
+tokens_per_message = 4
+tokens_per_reply = 3
+
+_encodings = {}
+
+
+def encoding_for(model):
+    """The tiktoken encoding of a model, or None to approximate"""
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # Unknown model name, or the encoding files cannot be downloaded
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text, model=None):
+    encoding = encoding_for(model)
+    if encoding is None:
+        return len(approximate_token_pattern.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model=None):
+    """Prompt tokens of a list of chat messages"""
+    return sum(tokens_per_message + count_tokens(m["content"], model) for m in messages) + tokens_per_reply